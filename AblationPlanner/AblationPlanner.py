@@ -1,5 +1,12 @@
 import os
+import sys
+import json
+import shutil
 import unittest
+import multiprocessing
+import concurrent.futures
+import collections
+import contextlib
 import logging
 import numpy as np
 import vtk, qt, ctk, slicer
@@ -7,6 +14,26 @@ from slicer.ScriptedLoadableModule import *
 from slicer.util import VTKObservationMixin
 import time 
 import vtkSegmentationCorePython as vtkSegmentationCore 
+from vtk.util import numpy_support
+from AblationPlannerLib.ParametricZones import EllipsoidProfile
+from AblationPlannerLib.ProbePoses import probePosesFromEndPoints, rotationMatricesFromVectors
+from AblationPlannerLib import TrajectoryOptimizer
+from AblationPlannerLib import BatchProcessing
+from AblationPlannerLib import PlacementUncertainty
+from AblationPlannerLib.Profiling import PipelineProfiler
+from AblationPlannerLib.MarginStatistics import computeMarginStatistics, vertexAreas
+from AblationPlannerLib.SurfaceDistanceFiles import surfaceDistanceArrays, writeSurfaceDistances
+from AblationPlannerLib.Registration import registerPoints, registrationErrors
+from AblationPlannerLib.VolumeCoverage import computeVolumeCoverage
+from AblationPlannerLib.DistanceFields import SignedDistanceField, gridPoints
+from AblationPlannerLib.ProfileCache import ProfileCache, ProfileEntry, fileContentHash
+from AblationPlannerLib.PlanCache import PlanCache, PlanEvaluation, planKey, pointsDigest, quantizeEndPoints
+from AblationPlannerLib.StructureProximity import splitStructureValues, structureProximities
+from AblationPlannerLib.WatchFolder import FolderWatcher, Series
+
+# Records the timing of the pipeline stages when enabled (see AblationPlannerLogic.setTimingEnabled)
+profiler = PipelineProfiler(lambda: {"nodeCount": slicer.mrmlScene.GetNumberOfNodes(), "processMemory": processMemoryUsage()},
+  lambda result: describePipelineResult(result))
 
 #
 # AblationPlanner
@@ -21,7 +48,7 @@ class AblationPlanner(ScriptedLoadableModule):
     ScriptedLoadableModule.__init__(self, parent)
     self.parent.title = "AblationPlanner"  # TODO: make this more human readable by adding spaces
     self.parent.categories = ["Quantification"]  # TODO: set categories (folders where the module shows up in the module selector)
-    self.parent.dependencies = ["ModelToModelDistance"]  # TODO: add here list of module names that this module requires
+    self.parent.dependencies = []  # TODO: add here list of module names that this module requires
     self.parent.contributors = ["Nathaniel Rex (Brown University), Scott Collins (Rhode Island Hospital), Ben Hsieh (Rhode Island Hospital)"]  # TODO: replace with "Firstname Lastname (Organization)"
     # TODO: update with short description of the module and a link to online module documentation
     self.parent.helpText = """
@@ -121,7 +148,8 @@ class AblationPlannerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
             (self.ui.endPointsMarkupsSelector,"EndPoints"),
             (self.ui.nativeFiducialsSelector, "NativeFiducials"),
             (self.ui.newFiducialSelector, "NewFiducials"),
-            (self.ui.tumorSegmentSelector, "InputTumor")
+            (self.ui.tumorSegmentSelector, "InputTumor"),
+            (self.ui.entryRegionSelector, "EntryRegion")
             ]
 
     # Set scene in MRML widgets. Make sure that in Qt designer the top-level qMRMLWidget's
@@ -149,30 +177,64 @@ class AblationPlannerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     # (in the selected parameter node).
   
     # Buttons
-    self.ui.PushButton_7.connect('clicked(bool)', self.onHardenButton) 
-    self.ui.PushButton_6.connect('clicked(bool)', self.onTranslateButton) 
-    self.ui.PushButton.connect('clicked(bool)', self.onProbeButton)
-    self.ui.PushButton_2.connect('clicked(bool)', self.onTumorButton)
-    self.ui.PushButton_3.connect('clicked(bool)', self.onMarginButton)
-    self.ui.PushButton_4.connect('clicked(bool)', self.onColorButton)
-    self.ui.PushButton_5.connect('clicked(bool)', self.onReColorButton)
-    self.ui.PushButton_8.connect('clicked(bool)', self.onLineButton)
+    self.ui.PushButton_7.connect('clicked()', self.onHardenButton) 
+    self.ui.PushButton_6.connect('clicked()', self.onTranslateButton) 
+    self.ui.PushButton.connect('clicked()', self.onProbeButton)
+    self.ui.PushButton_2.connect('clicked()', self.onTumorButton)
+    self.ui.PushButton_3.connect('clicked()', self.onMarginButton)
+    self.ui.PushButton_4.connect('clicked()', self.onColorButton)
+    self.ui.PushButton_5.connect('clicked()', self.onReColorButton)
+    self.ui.PushButton_8.connect('clicked()', self.onLineButton)
+    self.ui.optimizeButton.connect('clicked()', self.onOptimizeButton)
+    self.ui.uncertaintyButton.connect('clicked()', self.onUncertaintyButton)
+    self.ui.proximityButton.connect('clicked()', self.onProximityButton)
+    self.ui.watchButton.connect('toggled(bool)', self.onWatchButton)
+    self.ui.exportTimingButton.connect('clicked()', self.onExportTimingButton)
+    self.ui.surfaceDistancesTableButton.connect('clicked()', self.onSurfaceDistancesTableButton)
+    self.ui.previewButton.connect('clicked()', self.onPreviewButton)
+    self.ui.cancelEvaluationButton.connect('clicked()', self.onCancelEvaluationButton)
+    self.ui.registrationScaleCheckBox.connect("toggled(bool)", self.onRegistrationFiducialsModified)
+    self.ui.exportDistancesButton.connect('clicked()', self.onExportDistancesButton)
+    self.ui.loadProfileButton.connect('clicked()', self.onLoadProfileButton)
+    self.ui.timingCheckBox.connect("toggled(bool)", self.onTimingToggled)
+    self.ui.cProfileCheckBox.connect("toggled(bool)", self.onTimingToggled)
 
     self.ui.parameterNodeSelector.addAttribute("vtkMRMLScriptedModuleNode", "ModuleName", self.moduleName)
     self.setParameterNode(self.logic.getParameterNode())
 
     for nodeSelector, roleName in self.nodeSelectors:
         nodeSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.updateParameterNodeFromGUI)
+    self.ui.marginThresholdsLineEdit.connect("editingFinished()", self.updateParameterNodeFromGUI)
+    self.ui.statisticsThresholdsLineEdit.connect("editingFinished()", self.updateParameterNodeFromGUI)
+    self.ui.distanceBackendComboBox.addItem("In-process (fast)", "InProcess")
+    self.ui.distanceBackendComboBox.addItem("ModelToModelDistance CLI (reference)", "ModelToModelDistance")
+    self.ui.distanceBackendComboBox.connect("currentIndexChanged(int)", self.updateParameterNodeFromGUI)
+    self.ui.ellipsoidProfileCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+    self.ui.ellipsoidSemiAxesLineEdit.connect("editingFinished()", self.updateParameterNodeFromGUI)
+    self.ui.ellipsoidTipOffsetSpinBox.connect("valueChanged(double)", self.updateParameterNodeFromGUI)
+    self.ui.historyLengthSpinBox.connect("valueChanged(int)", self.updateParameterNodeFromGUI)
+    self.ui.volumeCoverageCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+    self.ui.shellMarginSpinBox.connect("valueChanged(double)", self.updateParameterNodeFromGUI)
     # Make sure parameter node is initialized (needed for module reload)
     #self.initializeParameterNode()
     self.endPoints_positions = []
-    self.fromDrag = False
     self.probeNodeIDs = []
+    self.registrationFiducialNodes = []
+    self.observedTumorNode = None
+    self.tumorMarginUpdatePending = False
+    # while an end point is dragged the probes are previewed at most once per frame budget (s)
+    self.dragFrameBudget = 1.0 / 30
+    self.observedEndPointsNode = None
+    self.endPointsDragging = False
+    self.dragPreviewPending = False
+    self.lastDragPreviewTime = 0.0
     self.updateGUIFromParameterNode()
 
 
   def cleanup(self):
+    self.logic.stopWatching()
     self.removeObservers()
+    profiler.topLevelSpanFinishedCallback = None
 
   #def enter(self):
     """
@@ -247,7 +309,7 @@ class AblationPlannerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     self.ui.endPointsMarkupsSelector.blockSignals(wasBlocked)
 
     wasBlocked = self.ui.nativeFiducialsSelector.blockSignals(True)
-    self.ui.nativeFiducialsSelector.setCurrentNode(self._parameterNode.GetNodeReference("NativeFiducialsƒ"))
+    self.ui.nativeFiducialsSelector.setCurrentNode(self._parameterNode.GetNodeReference("NativeFiducials"))
     self.ui.nativeFiducialsSelector.blockSignals(wasBlocked)
 
     wasBlocked = self.ui.newFiducialSelector.blockSignals(True)
@@ -258,6 +320,46 @@ class AblationPlannerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     self.ui.tumorSegmentSelector.setCurrentNode(self._parameterNode.GetNodeReference("InputTumor"))
     self.ui.tumorSegmentSelector.blockSignals(wasBlocked)
 
+    wasBlocked = self.ui.entryRegionSelector.blockSignals(True)
+    self.ui.entryRegionSelector.setCurrentNode(self._parameterNode.GetNodeReference("EntryRegion"))
+    self.ui.entryRegionSelector.blockSignals(wasBlocked)
+
+    wasBlocked = self.ui.marginThresholdsLineEdit.blockSignals(True)
+    self.ui.marginThresholdsLineEdit.text = self._parameterNode.GetParameter("MarginThresholds")
+    self.ui.marginThresholdsLineEdit.blockSignals(wasBlocked)
+    wasBlocked = self.ui.statisticsThresholdsLineEdit.blockSignals(True)
+    self.ui.statisticsThresholdsLineEdit.text = self._parameterNode.GetParameter("StatisticsThresholds")
+    self.ui.statisticsThresholdsLineEdit.blockSignals(wasBlocked)
+
+    wasBlocked = self.ui.distanceBackendComboBox.blockSignals(True)
+    self.ui.distanceBackendComboBox.currentIndex = max(0, self.ui.distanceBackendComboBox.findData(self._parameterNode.GetParameter("DistanceBackend")))
+    self.ui.distanceBackendComboBox.blockSignals(wasBlocked)
+
+    wasBlocked = self.ui.ellipsoidProfileCheckBox.blockSignals(True)
+    self.ui.ellipsoidProfileCheckBox.checked = self._parameterNode.GetParameter("ProfileType") == "Ellipsoid"
+    self.ui.ellipsoidProfileCheckBox.blockSignals(wasBlocked)
+
+    wasBlocked = self.ui.ellipsoidSemiAxesLineEdit.blockSignals(True)
+    self.ui.ellipsoidSemiAxesLineEdit.text = self._parameterNode.GetParameter("EllipsoidSemiAxes")
+    self.ui.ellipsoidSemiAxesLineEdit.blockSignals(wasBlocked)
+
+    wasBlocked = self.ui.ellipsoidTipOffsetSpinBox.blockSignals(True)
+    self.ui.ellipsoidTipOffsetSpinBox.value = float(self._parameterNode.GetParameter("EllipsoidTipOffset") or 0)
+    self.ui.ellipsoidTipOffsetSpinBox.blockSignals(wasBlocked)
+
+    wasBlocked = self.ui.historyLengthSpinBox.blockSignals(True)
+    self.ui.historyLengthSpinBox.value = int(self._parameterNode.GetParameter("HistoryLength") or 0)
+    self.ui.historyLengthSpinBox.blockSignals(wasBlocked)
+
+    wasBlocked = self.ui.volumeCoverageCheckBox.blockSignals(True)
+    self.ui.volumeCoverageCheckBox.checked = self._parameterNode.GetParameter("VolumeCoverage") == "true"
+    self.ui.volumeCoverageCheckBox.blockSignals(wasBlocked)
+
+    wasBlocked = self.ui.shellMarginSpinBox.blockSignals(True)
+    self.ui.shellMarginSpinBox.value = float(self._parameterNode.GetParameter("ShellMargin") or 0)
+    self.ui.shellMarginSpinBox.blockSignals(wasBlocked)
+    self.ui.shellMarginSpinBox.enabled = self.ui.volumeCoverageCheckBox.checked
+    self.ui.probeNodeSelector.enabled = not self.ui.ellipsoidProfileCheckBox.checked
 
     self.updatingGUIFromParameterNode = False
 
@@ -272,62 +374,127 @@ class AblationPlannerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     for nodeSelector, roleName in self.nodeSelectors:
         self._parameterNode.SetNodeReferenceID(roleName, nodeSelector.currentNodeID)
 
+    self._parameterNode.SetParameter("MarginThresholds", self.ui.marginThresholdsLineEdit.text)
+    self._parameterNode.SetParameter("StatisticsThresholds", self.ui.statisticsThresholdsLineEdit.text)
+    self._parameterNode.SetParameter("DistanceBackend", self.ui.distanceBackendComboBox.currentData)
+    self._parameterNode.SetParameter("ProfileType", "Ellipsoid" if self.ui.ellipsoidProfileCheckBox.checked else "Segmentation")
+    self._parameterNode.SetParameter("EllipsoidSemiAxes", self.ui.ellipsoidSemiAxesLineEdit.text)
+    self._parameterNode.SetParameter("EllipsoidTipOffset", str(self.ui.ellipsoidTipOffsetSpinBox.value))
+    self._parameterNode.SetParameter("HistoryLength", str(self.ui.historyLengthSpinBox.value))
+    self._parameterNode.SetParameter("VolumeCoverage", "true" if self.ui.volumeCoverageCheckBox.checked else "false")
+    self._parameterNode.SetParameter("ShellMargin", str(self.ui.shellMarginSpinBox.value))
+    self.ui.shellMarginSpinBox.enabled = self.ui.volumeCoverageCheckBox.checked
+    self.ui.probeNodeSelector.enabled = not self.ui.ellipsoidProfileCheckBox.checked
+
+  def getProbeProfileNode(self):
+    """Return the profile segmentation that is placed at each probe: the selected profile segmentation,
+    or a surface of the parametric ellipsoid profile.
+    """
+    ellipsoidProfile = self.logic.ellipsoidProfileFromParameterNode(self._parameterNode)
+    if ellipsoidProfile is not None:
+      return self.logic.getEllipsoidProfileNode(ellipsoidProfile)
+    return self._parameterNode.GetNodeReference("InputSurface")
+
+  @profiler.spanned("Load Profile")
+  def onLoadProfileButton(self):
+    path = qt.QFileDialog.getOpenFileName(None, "Load ablation profile", "", "Segmentation files (*.seg.nrrd *.nrrd *.seg.vtm)")
+    if not path:
+      return
+    with slicer.util.tryWithErrorDisplay("Failed to load the ablation profile.", waitCursor=True):
+      profileNode = self.logic.loadProfile(path, distanceFieldSpacing=0.5)
+      self.ui.probeNodeSelector.setCurrentNode(profileNode)
+
+  def getPlan(self):
+    """Return the profile, the end point pairs and the tumor of the current plan, None if it is incomplete."""
+    tumorNode = self._parameterNode.GetNodeReference("InputTumor")
+    endPointsNode = self._parameterNode.GetNodeReference("EndPoints")
+    profile = self.logic.ellipsoidProfileFromParameterNode(self._parameterNode) or self._parameterNode.GetNodeReference("InputSurface")
+    if tumorNode is None or endPointsNode is None or profile is None:
+      return None
+    try:
+      endPointPairs = self.logic.endPointPairsFromMarkups(endPointsNode)
+    except ValueError:
+      return None
+    return profile, endPointPairs, tumorNode
+
+  def getPlanKey(self):
+    """Key of the current plan (profile, end points and tumor) in the plan evaluation cache, None if it is incomplete."""
+    plan = self.getPlan()
+    return self.logic.getPlanKey(*plan) if plan is not None else None
+
+  def getZoneKey(self):
+    """Key of the ablation zone of the current plan (profile and end points), None if it is incomplete."""
+    plan = self.getPlan()
+    return self.logic.getZoneKey(*plan[:2]) if plan is not None else None
+
+  @profiler.spanned("Translate Tumor")
   def onTumorButton(self):
      self.updateParameterNodeFromGUI()
      nativeFiducials = self._parameterNode.GetNodeReference("NativeFiducials")
      tableFiducials = self._parameterNode.GetNodeReference("NewFiducials")
+     if nativeFiducials is None or tableFiducials is None:
+       print("Please select the native and the new fiducials!")
+       return
+
+     # from now on the tumor follows the fiducials as they are added, moved or removed
+     self.stopLiveRegistration()
+     for fiducialsNode in (nativeFiducials, tableFiducials):
+       for event in (slicer.vtkMRMLMarkupsNode.PointAddedEvent, slicer.vtkMRMLMarkupsNode.PointModifiedEvent,
+                     slicer.vtkMRMLMarkupsNode.PointRemovedEvent):
+         self.addObserver(fiducialsNode, event, self.onRegistrationFiducialsModified)
+     self.registrationFiducialNodes = [nativeFiducials, tableFiducials]
+     self.updateTumorRegistration()
+
+  def stopLiveRegistration(self):
+     for fiducialsNode in self.registrationFiducialNodes:
+       self.removeObserver(fiducialsNode, slicer.vtkMRMLMarkupsNode.PointAddedEvent, self.onRegistrationFiducialsModified)
+       self.removeObserver(fiducialsNode, slicer.vtkMRMLMarkupsNode.PointModifiedEvent, self.onRegistrationFiducialsModified)
+       self.removeObserver(fiducialsNode, slicer.vtkMRMLMarkupsNode.PointRemovedEvent, self.onRegistrationFiducialsModified)
+     self.registrationFiducialNodes = []
+
+  def onRegistrationFiducialsModified(self, caller=None, event=None):
+     self.updateTumorRegistration()
+
+  def updateTumorRegistration(self):
+     if not self.registrationFiducialNodes:
+       return
      tumorNode = self._parameterNode.GetNodeReference("InputTumor")
-
-     nativeTableTransform = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLTransformNode")
-
-     parameters = {}
-     parameters["fixedLandmarks"] = tableFiducials
-     parameters["movingLandmarks"] = nativeFiducials
-     parameters["saveTransform"] = nativeTableTransform
-     parameters["transformType"] = "Rigid"
-
-     FRcliNode = slicer.cli.runSync(slicer.modules.fiducialregistration, None, parameters)
-
-     tumorNode.SetAndObserveTransformNodeID(nativeTableTransform.GetID())
-     
+     nativeFiducials, tableFiducials = self.registrationFiducialNodes
+     try:
+       transformNode, errors, rmsError = self.logic.updateTumorRegistration(nativeFiducials, tableFiducials, tumorNode,
+         self.ui.registrationScaleCheckBox.checked)
+     except ValueError as e:
+       self.ui.registrationErrorLabel.text = "Registration not updated: " + str(e)
+       return
+     self.ui.registrationErrorLabel.text = "RMS error: {0:.2f} mm (per point: {1})".format(rmsError,
+       ", ".join("{0:.2f}".format(error) for error in errors))
+
+  @profiler.spanned("Create Lines")
   def onLineButton(self):
     if self.endPoints_positions is None:
       print("You haven't entered any fiducials yet!")
       return 
 
-    lineNodes = slicer.mrmlScene.GetNodesByClass("vtkMRMLMarkupsLineNode")
-
-    if lineNodes is not None:
-      for lineNode in lineNodes:
-        slicer.mrmlScene.RemoveNode(lineNode)
-
     endPointsMarkupsNode = self._parameterNode.GetNodeReference("EndPoints")
-    numNodePoints = endPointsMarkupsNode.GetNumberOfControlPoints()
-
-    for i in range(0,numNodePoints,2):
-        fiducialLabel = endPointsMarkupsNode.GetNthFiducialLabel(i)        
-        ras1 = vtk.vtkVector3d(0,0,0)
-        endPointsMarkupsNode.GetNthControlPointPosition(i, ras1)
-        
-        ras2 = vtk.vtkVector3d(0,0,0)
-        endPointsMarkupsNode.GetNthControlPointPosition(i+1, ras2)
-        
-        pointPositions = np.asarray([ras1,ras2])
-        lineNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsLineNode")
-        slicer.util.updateMarkupsControlPointsFromArray(lineNode, pointPositions)
-        lineDisplayNode = lineNode.GetDisplayNode()
-        lineDisplayNode.SetPropertiesLabelVisibility(False)
-        lineDisplayNode.SetPointSize(0.5)
-        lineDisplayNode.SetSelectable(False)
-        slicer.app.processEvents()
-    
+    positions = slicer.util.arrayFromMarkupsControlPoints(endPointsMarkupsNode, world=True)
+    # only the lines of the module are updated, other line markups in the scene are left alone
+    self.logic.updateProbeLines([(positions[i], positions[i+1]) for i in range(0, len(positions) - 1, 2)])
 
+  @profiler.spanned("Evaluate Tumor Margins")
   def onMarginButton(self):
     try: 
       self.updateParameterNodeFromGUI()
 
       tumorNode = self._parameterNode.GetNodeReference("InputTumor")
       probeNode = self._parameterNode.GetNodeReference("combinedProbeNode")
+      probePoses = None
+      ellipsoidProfile = self.logic.ellipsoidProfileFromParameterNode(self._parameterNode)
+      if ellipsoidProfile is not None:
+        # parametric plans are evaluated in closed form from the probe poses, no combined zone is needed
+        probeNode = ellipsoidProfile
+        probePoses = [self.logic.probePoses[probeNodeID] for probeNodeID in self.probeNodeIDs if probeNodeID in self.logic.probePoses]
+        if not probePoses:
+          probeNode = None
 
       missingNode = False
       if tumorNode is None:
@@ -339,70 +506,187 @@ class AblationPlannerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
       if missingNode:
         return
       
-      outputMarginModel, resultTableNode, lowerMargin, signedVals = self.logic.evaluateMargins(tumorNode, probeNode)
-      
+      distanceBackend = self._parameterNode.GetParameter("DistanceBackend")
+      statisticsThresholds = self.logic.parseMarginThresholds(self._parameterNode.GetParameter("StatisticsThresholds"))
+      shellMargin = None
+      if self._parameterNode.GetParameter("VolumeCoverage") == "true":
+        shellMargin = float(self._parameterNode.GetParameter("ShellMargin"))
+      planKey = self.getPlanKey()
+      if ellipsoidProfile is None and self.logic.getCombinedZone(self.getZoneKey()) is None:
+        # the combined zone was built for other end points, its evaluation must not be stored as this plan's
+        planKey = None
+      # runs in the background, a new evaluation cancels the one still running
+      self.ui.cancelEvaluationButton.enabled = True
+      self.logic.evaluateMarginsAsync(tumorNode, probeNode, distanceBackend, probePoses, statisticsThresholds,
+        self.onMarginEvaluationProgress, self.onMarginEvaluationFinished, shellMargin, planKey)
+    except Exception as e:
+      slicer.util.errorDisplay("Did you enter a segmentation? The code found an error: "+str(e))
+
+  def onMarginEvaluationProgress(self, fraction, message):
+    self.ui.marginProgressBar.value = int(100 * fraction)
+    self.ui.marginProgressBar.format = message + " %p%"
+
+  @profiler.spanned("Evaluate Tumor Margins (finish)")
+  def onMarginEvaluationFinished(self, task):
+    if task is not self.logic.marginEvaluationTask:
+      # a stale evaluation that was replaced by a newer one
+      return
+    self.ui.cancelEvaluationButton.enabled = False
+    if task.cancelled:
+      self.ui.marginProgressBar.format = "Cancelled"
+      return
+    if task.error is not None:
+      self.ui.marginProgressBar.format = "Failed"
+      slicer.util.errorDisplay("Did you enter a segmentation? The code found an error: "+str(task.error))
+      return
+    outputMarginModel, resultTableNode, lowerMargin, marginStatistics = task.result
+    tumorNode = self._parameterNode.GetNodeReference("InputTumor")
+    if tumorNode is not None:
       thisDisplayNode = tumorNode.GetDisplayNode()
       thisDisplayNode.SetVisibility(False) # Hide all points
 
-      self._parameterNode.SetNodeReferenceID("outputMarginModel", outputMarginModel.GetID())
-      self._parameterNode.SetNodeReferenceID("resultTableNodeID", resultTableNode.GetID())
-      VTKFieldData = outputMarginModel.GetMesh().GetAttributesAsFieldData(0)
-      VTKFieldDataArray = VTKFieldData.GetArray("Signed")
-      originalColorArray = []
-
-      for i in range(0, VTKFieldDataArray.GetSize()-1):
-          thisArray = []
-          thisArray.append(VTKFieldDataArray.GetValue(i))
-          thisArray.append(i)
-          originalColorArray.append(thisArray)
-
-      self.originalColorArray = originalColorArray
-      self.originalModelFieldData = VTKFieldData
-      self.lowerMargin = lowerMargin
-      self.signedVals = signedVals
-    except Exception as e:
-      slicer.util.errorDisplay("Did you enter a segmentation? The code found an error: "+str(e))
+    self._parameterNode.SetNodeReferenceID("outputMarginModel", outputMarginModel.GetID())
+    self._parameterNode.SetNodeReferenceID("resultTableNodeID", resultTableNode.GetID())
+    self.lowerMargin = lowerMargin
+    self.marginStatistics = marginStatistics
+    self.observeTumorTransform(tumorNode)
+
+  def observeTumorTransform(self, tumorNode):
+    """Update the margins whenever the evaluated tumor moves (registration, transform edits, hardening)."""
+    if self.observedTumorNode is not None:
+      self.removeObserver(self.observedTumorNode, slicer.vtkMRMLTransformableNode.TransformModifiedEvent, self.onTumorTransformModified)
+    self.observedTumorNode = tumorNode
+    if tumorNode is not None:
+      self.addObserver(tumorNode, slicer.vtkMRMLTransformableNode.TransformModifiedEvent, self.onTumorTransformModified)
+
+  def onTumorTransformModified(self, caller=None, event=None):
+    # a transform drag fires many events, they are merged into one update when the application is idle
+    if not self.tumorMarginUpdatePending:
+      self.tumorMarginUpdatePending = True
+      qt.QTimer.singleShot(0, self.updateMarginsForTumor)
+
+  @profiler.spanned("Update Tumor Margins")
+  def updateMarginsForTumor(self):
+    self.tumorMarginUpdatePending = False
+    outputMarginModel = self._parameterNode.GetNodeReference("outputMarginModel")
+    tumorNode = self._parameterNode.GetNodeReference("InputTumor")
+    if outputMarginModel is None or tumorNode is None or tumorNode is not self.observedTumorNode:
+      return
+    if self.logic.marginEvaluationTask is not None and not self.logic.marginEvaluationTask.finished:
+      return
+    if self.logic.watchTask is not None and not self.logic.watchTask.finished:
+      # the watch folder pipeline evaluates the margins of the new scan itself
+      return
+    zone = self.logic.ellipsoidProfileFromParameterNode(self._parameterNode)
+    if zone is None:
+      # None if the probes were dragged since the combined zone was built, the placed probes are then queried instead
+      zone = self.logic.getCombinedZone(self.getZoneKey())
+      if zone is None and not self.probeNodeIDs:
+        return
+    probePoses = [self.logic.probePoses[probeNodeID] for probeNodeID in self.probeNodeIDs if probeNodeID in self.logic.probePoses]
+    statisticsThresholds = self.logic.parseMarginThresholds(self._parameterNode.GetParameter("StatisticsThresholds"))
+    self.lowerMargin, self.marginStatistics = self.logic.updateMarginsForTumor(outputMarginModel, tumorNode, zone, probePoses,
+      statisticsThresholds, self.probeNodeIDs)
+    print("Updated margins of the moved tumor, lowest signed distance: ", self.lowerMargin)
+    if outputMarginModel.GetModelDisplayNode().GetActiveScalarName() == "MarginClass":
+      self.onColorButton()
 
+  def onCancelEvaluationButton(self):
+    self.logic.cancelMarginEvaluation()
 
+
+  @profiler.spanned("Preview Margins")
+  def onPreviewButton(self):
+    self.updateParameterNodeFromGUI()
+    tumorNode = self._parameterNode.GetNodeReference("InputTumor")
+    probeNode = self.logic.ellipsoidProfileFromParameterNode(self._parameterNode) or self._parameterNode.GetNodeReference("InputSurface")
+    probePoses = [self.logic.probePoses[probeNodeID] for probeNodeID in self.probeNodeIDs if probeNodeID in self.logic.probePoses]
+    if tumorNode is None or probeNode is None or not probePoses:
+      print("Please select a tumor segmentation and place the probes first!")
+      return
+    statisticsThresholds = self.logic.parseMarginThresholds(self._parameterNode.GetParameter("StatisticsThresholds"))
+    previewModel, statistics, errorEstimate = self.logic.evaluatePreviewMargins(tumorNode, probeNode, probePoses,
+      self.ui.previewVertexBudgetSpinBox.value, statisticsThresholds)
+    print("Preview: lowest signed distance {0:.2f} mm, estimated to be within {1:.2f} mm of the full resolution margins".format(
+      statistics.minimum, errorEstimate))
+    for threshold, fraction in zip(statistics.marginThresholds, statistics.fractionBelow):
+      print("Tumor surface with less than {0:g} mm margin: {1:.1%}".format(threshold, fraction))
+
+  def onSurfaceDistancesTableButton(self):
+    outputMarginModel = self._parameterNode.GetNodeReference("outputMarginModel")
+    if outputMarginModel is None:
+      print("Please evaluate the tumor margins first!")
+      return
+    tableNode = self.logic.createSurfaceDistancesTable(outputMarginModel)
+    slicer.app.applicationLogic().GetSelectionNode().SetActiveTableID(tableNode.GetID())
+    slicer.app.applicationLogic().PropagateTableSelection()
+
+  def onExportDistancesButton(self):
+    outputMarginModel = self._parameterNode.GetNodeReference("outputMarginModel")
+    if outputMarginModel is None:
+      print("Please evaluate the tumor margins first!")
+      return
+    path = qt.QFileDialog.getSaveFileName(None, "Export surface distances", "surface_distances.npz",
+      "Compressed NumPy arrays (*.npz);;Raw arrays directory (*)")
+    if not path:
+      return
+    fileFormat = "npz" if path.endswith(".npz") else "raw"
+    self.logic.exportSurfaceDistances(outputMarginModel, path, fileFormat)
+    print("Surface distances written to " + path)
+
+  @profiler.spanned("Apply Margin Color")
   def onColorButton(self):
     self.updateParameterNodeFromGUI()
     outputMarginModel = self._parameterNode.GetNodeReference("outputMarginModel")
-    self.logic.changeColorsByMargin_(outputMarginModel,-10,-5,-2)
+    if outputMarginModel is None:
+      print("Please evaluate the tumor margins first!")
+      return
+    try:
+      thresholds = self.logic.parseMarginThresholds(self._parameterNode.GetParameter("MarginThresholds"))
+    except ValueError as e:
+      slicer.util.errorDisplay("Invalid margin thresholds: "+str(e))
+      return
+    self.logic.changeColorsByMargin_(outputMarginModel, *thresholds)
     self.logic.updateNodeColor(outputMarginModel)
 
+  @profiler.spanned("Revert Color")
   def onReColorButton(self): 
     self.updateParameterNodeFromGUI()
     outputMarginModel = self._parameterNode.GetNodeReference("outputMarginModel")
-    self.logic.regenerateOriginalModelColors(outputMarginModel, self.originalColorArray)
+    if outputMarginModel is None:
+      return
+    self.logic.regenerateOriginalModelColors(outputMarginModel)
     self.logic.updateNodeColor(outputMarginModel)
 
+  @profiler.spanned("Translate Probe")
   def onTranslateButton(self):
-    probeNode = self._parameterNode.GetNodeReference("InputSurface")
+    probeNode = self.getProbeProfileNode()
 
-    thisScene = probeNode.GetScene()
-    markupReference = thisScene.GetNodeByID(self.formerMarkupID)
-    markupReference.RemoveObserver(self.observerID)
-    self.removeObservers()
+    # the end points stay observed, so that dragging a probe after combining still updates its margins
     nodeIds = self.probeNodeIDs
     combinedProbeNode = self.logic.convertSegmentsToSegment(probeNode, nodeIds)
-    self._parameterNode.SetNodeReferenceID("combinedProbeNode", combinedProbeNode.GetID())
+    self.logic.setCombinedZone(combinedProbeNode, self.getZoneKey())
 
 
+  @profiler.spanned("Harden Transform")
   def onHardenButton(self):
     tumorNode = self._parameterNode.GetNodeReference("InputTumor")
     if tumorNode is None:
         print("tumor segmentation is invalid")
         return
+    # the registration is final once hardened, the tumor must not follow the fiducials any more
+    self.stopLiveRegistration()
     tumorNode.HardenTransform()
     self.logic.updateNodeColor(tumorNode)
     
   #this is the "Place Probes" button
+  @profiler.spanned("Place Probes")
   def onProbeButton(self):
      self.updateParameterNodeFromGUI()
      if True:
        xyz = []
        endPointsMarkupsNode = self._parameterNode.GetNodeReference("EndPoints")
-       probeNode = self._parameterNode.GetNodeReference("InputSurface")
+       probeNode = self.getProbeProfileNode()
        if probeNode is None:
         print("Please enter a valid probe segmentation!")
         return
@@ -415,57 +699,259 @@ class AblationPlannerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
        print("Number of input fiducials found: ", endPointsMarkupsNode.GetNumberOfFiducials())
 
+       for i in range(0, endPointsMarkupsNode.GetNumberOfFiducials()):
+         endPointsMarkupsNode.GetNthFiducialPosition(i, xyz[i])
+       self.endPoints_positions = xyz
+
        if endPointsMarkupsNode.GetNumberOfFiducials() >= 2:
          if (endPointsMarkupsNode.GetNumberOfFiducials()%2 == 1):
            print("You entered an odd number of fiducials. Please enter an even number of fiducials.")
          else:
-           fidPairs = endPointsMarkupsNode.GetNumberOfFiducials()/2 
-           probeNodeIDs = duplicateProbeNode(int(fidPairs),probeNode)
+           endPointPairs = [(xyz[i], xyz[i+1]) for i in range(0, len(xyz), 2)]
+           # placing the probes again moves the previous ones in place, extra ones are removed
+           probeNodeIDs = self.logic.placeProbes(probeNode, endPointPairs, reuseNodeIDs=self.probeNodeIDs)
+           self.logic.removeProbes(self.probeNodeIDs[len(probeNodeIDs):])
            self.probeNodeIDs = probeNodeIDs
-           #print("New probe IDs probes: ", self.probeNodeIDs)
 
-       for i in range(0, endPointsMarkupsNode.GetNumberOfFiducials()):
-         endPointsMarkupsNode.GetNthFiducialPosition(i, xyz[i])
-         self.endPoints_positions.append(xyz) #.GetNthFiducialPosition(0, [1,1,1])
-         #print("At positon: ", i, " found position: ", xyz[i])
-         self.endPoints_positions = xyz
-        
-       #self.endPoints_positions = point_list
-       for i in range(0, len(self.probeNodeIDs)):
-         self.logic.updateProbePosition(self.probeNodeIDs[i], probeNode, [0,0,0], [0,0,-1], self.endPoints_positions[i*2], self.endPoints_positions[i*2+1])
-         #logging.info("Moving probe {0} from {1} , {2} to position {3} , {4}".format(self.probeNodeIDs[i], [0,0,0],[0,0,-1], self.endPoints_positions[i*2], self.endPoints_positions[i*2+1]))
+       self.observeEndPointsDrag(endPointsMarkupsNode)
 
-       #endPointsMarkupsNode.AddObserver(slicer.vtkMRMLMarkupsNode.PointStartInteractionEvent, self.onMarkupStartInteraction)
-       if self.fromDrag:
-         #endPointsMarkupsNode.removeObservers()
-         thisScene = probeNode.GetScene()
-         markupReference = thisScene.GetNodeByID(self.formerMarkupID)
-         endPointsMarkupsNode.RemoveObserver(self.observerID)
-         self.removeObservers()
-
-       self.observerID = endPointsMarkupsNode.AddObserver(slicer.vtkMRMLMarkupsNode.PointEndInteractionEvent, self.onMarkupEndInteraction)
-       self.formerMarkupID = endPointsMarkupsNode.GetID()
 
 
 
 
+  @profiler.spanned("Optimize Probe Trajectories")
+  def onOptimizeButton(self):
+    self.updateParameterNodeFromGUI()
+    tumorNode = self._parameterNode.GetNodeReference("InputTumor")
+    entryRegionNode = self._parameterNode.GetNodeReference("EntryRegion")
+    profile = self.logic.ellipsoidProfileFromParameterNode(self._parameterNode) or self._parameterNode.GetNodeReference("InputSurface")
+    if tumorNode is None or entryRegionNode is None or profile is None:
+      print("Please select a tumor segmentation, a probe profile and an entry region!")
+      return
+    objective = "coverage" if self.ui.objectiveComboBox.currentIndex == 1 else "margin"
+    try:
+      with slicer.util.tryWithErrorDisplay("Probe trajectory optimization failed.", waitCursor=True):
+        endPointsNode, plans = self.logic.optimizeProbeTrajectories(tumorNode, profile, self.ui.probeCountSpinBox.value,
+          entryRegionNode, objective, endPointsNode=self._parameterNode.GetNodeReference("EndPoints"))
+    except Exception:
+      return
+    self._parameterNode.SetNodeReferenceID("EndPoints", endPointsNode.GetID())
+    self.updateGUIFromParameterNode()
+    print("Optimized plan: minimum margin {0:.2f} mm, {1:.1%} of the tumor surface covered with margin".format(
+      plans[0]["minimumMargin"], plans[0]["coverage"]))
 
+  @profiler.spanned("Analyze Placement Uncertainty")
+  def onUncertaintyButton(self):
+    self.updateParameterNodeFromGUI()
+    tumorNode = self._parameterNode.GetNodeReference("InputTumor")
+    endPointsNode = self._parameterNode.GetNodeReference("EndPoints")
+    profile = self.logic.ellipsoidProfileFromParameterNode(self._parameterNode) or self._parameterNode.GetNodeReference("InputSurface")
+    if tumorNode is None or endPointsNode is None or profile is None:
+      print("Please select a tumor segmentation, a probe profile and the end points!")
+      return
+    try:
+      with slicer.util.tryWithErrorDisplay("Placement uncertainty analysis failed.", waitCursor=True):
+        uncertainty = self.logic.analyzePlacementUncertainty(tumorNode, profile, self.logic.endPointPairsFromMarkups(endPointsNode),
+          self.ui.uncertaintySamplesSpinBox.value, self.ui.tipErrorSpinBox.value, self.ui.entryErrorSpinBox.value,
+          self.ui.errorDistributionComboBox.currentText, self.ui.requiredMarginSpinBox.value)[0]
+    except Exception:
+      self.ui.uncertaintyStatusLabel.text = "Failed"
+      return
+    self.ui.uncertaintyStatusLabel.text = "Zone model: {0}. Samples with less than {1:g} mm margin: {2:.1%}".format(
+      uncertainty.zoneModel, uncertainty.requiredMargin, uncertainty.failureProbability(uncertainty.requiredMargin))
+
+  @profiler.spanned("Evaluate Organ Proximity")
+  def onProximityButton(self):
+    self.updateParameterNodeFromGUI()
+    tumorNode = self._parameterNode.GetNodeReference("InputTumor")
+    zone = self._parameterNode.GetNodeReference("combinedProbeNode")
+    probePoses = None
+    ellipsoidProfile = self.logic.ellipsoidProfileFromParameterNode(self._parameterNode)
+    if ellipsoidProfile is not None:
+      zone = ellipsoidProfile
+      probePoses = [self.logic.probePoses[probeNodeID] for probeNodeID in self.probeNodeIDs if probeNodeID in self.logic.probePoses]
+      if not probePoses:
+        zone = None
+    if zone is None:
+      print("Please place the probes and combine their ablation zones first!")
+      return
+    # every segment of the checked segmentations, except the tumor itself
+    structures = []
+    for segmentationNode in self.ui.organsAtRiskSelector.checkedNodes():
+      segmentation = segmentationNode.GetSegmentation()
+      for segmentIndex in range(segmentation.GetNumberOfSegments()):
+        if segmentationNode is tumorNode and segmentIndex == 0:
+          continue
+        structures.append((segmentationNode, segmentation.GetNthSegmentID(segmentIndex)))
+    if not structures:
+      print("Please check the segmentations of the organs at risk!")
+      return
+    try:
+      with slicer.util.tryWithErrorDisplay("Organ proximity evaluation failed.", waitCursor=True):
+        self.logic.evaluateStructureProximity(zone, structures, probePoses)
+    except Exception:
+      return
+
+  def onWatchButton(self, checked):
+    if not checked:
+      self.logic.stopWatching()
+      self.ui.watchButton.text = "Start watching"
+      self.ui.watchStatusLabel.text = "Not watching"
+      return
+    self.updateParameterNodeFromGUI()
+    directory = self.ui.watchDirectoryButton.directory if self.ui.watchFolderCheckBox.checked else None
+    useDicomDatabase = self.ui.watchDicomCheckBox.checked
+    if not directory and not useDicomDatabase:
+      print("Please select a folder or the DICOM database to watch!")
+      self.ui.watchButton.checked = False
+      return
+    self.logic.startWatching(directory, useDicomDatabase, self.probeNodeIDs, self.onWatchStageFinished,
+      self.ui.registrationScaleCheckBox.checked)
+    self.ui.watchButton.text = "Stop watching"
+    self.ui.watchStatusLabel.text = "Waiting for a new scan"
+
+  def onWatchStageFinished(self, series, stage, result):
+    """Publish the result of a stage of the watch folder pipeline as soon as it is done."""
+    if stage == "registration" and result is not None:
+      transformNode, errors, rmsError = result
+      self.ui.registrationErrorLabel.text = "{0}: RMS error {1:.2f} mm".format(series.name, rmsError)
+      self.observeTumorTransform(self._parameterNode.GetNodeReference("InputTumor"))
+    elif stage == "placement":
+      self.probeNodeIDs = list(result)
+    elif stage == "margins":
+      outputMarginModel, self.marginStatistics = result
+      self.lowerMargin = self.marginStatistics.minimum
+      print("{0}: lowest signed distance {1:.2f} mm".format(series.name, self.lowerMargin))
+    self.ui.watchStatusLabel.text = "{0}: {1} done".format(series.name, stage)
+
+  def onTimingToggled(self, checked=None):
+    self.logic.setTimingEnabled(self.ui.timingCheckBox.checked, self.ui.cProfileCheckBox.checked)
+
+  def onExportTimingButton(self):
+    path = qt.QFileDialog.getSaveFileName(None, "Export timing log", "AblationPlannerTiming.json", "JSON files (*.json)")
+    if not path:
+      return
+    profiler.writeJson(path)
+    if profiler.profiles:
+      profiler.writeProfile(os.path.splitext(path)[0] + ".prof")
+    print("Timing log written to " + path)
+
+  def observeEndPointsDrag(self, endPointsNode):
+    """Preview the probes while the end points are dragged (see onEndPointModified) and move them when the drag
+    ends (see onMarkupEndInteraction). Only one end points node is observed, and only once."""
+    if endPointsNode is self.observedEndPointsNode:
+      return
+    dragEvents = ((slicer.vtkMRMLMarkupsNode.PointStartInteractionEvent, self.onEndPointStartInteraction),
+      (slicer.vtkMRMLMarkupsNode.PointModifiedEvent, self.onEndPointModified),
+      (slicer.vtkMRMLMarkupsNode.PointEndInteractionEvent, self.onMarkupEndInteraction))
+    if self.observedEndPointsNode is not None:
+      for event, method in dragEvents:
+        self.removeObserver(self.observedEndPointsNode, event, method)
+    self.observedEndPointsNode = endPointsNode
+    for event, method in dragEvents:
+      self.addObserver(endPointsNode, event, method)
+
+  def onEndPointStartInteraction(self, caller=None, event=None):
+    self.endPointsDragging = True
+
+  def onEndPointModified(self, caller=None, event=None):
+    # point modified events arrive for every mouse move: previews are throttled to the frame budget, the last
+    # position of the drag is always previewed by the pending update
+    if not self.endPointsDragging or self.dragPreviewPending:
+      return
+    self.dragPreviewPending = True
+    delay = max(0.0, self.dragFrameBudget - (time.perf_counter() - self.lastDragPreviewTime))
+    qt.QTimer.singleShot(int(delay * 1000), self.updateDragPreview)
+
+  def updateDragPreview(self):
+    """Move the probes whose end points are being dragged, and their lines, with a transform: nothing is
+    hardened, combined or evaluated until the drag ends (onMarkupEndInteraction)."""
+    self.dragPreviewPending = False
+    self.lastDragPreviewTime = time.perf_counter()
+    if not self.endPointsDragging or self.observedEndPointsNode is None:
+      return
+    positions = slicer.util.arrayFromMarkupsControlPoints(self.observedEndPointsNode, world=True)
+    if len(positions) != len(self.endPoints_positions) or len(self.probeNodeIDs) != len(positions)//2:
+      return
+    for i, probeNodeID in enumerate(self.probeNodeIDs):
+      if not np.array_equal(positions[i*2:i*2+2], self.endPoints_positions[i*2:i*2+2]):
+        self.logic.previewProbeDrag(probeNodeID, positions[i*2], positions[i*2+1], lineIndex=i)
+
+  @profiler.spanned("Move Probe")
   def onMarkupEndInteraction(self, caller, event):
     markupsNode = caller
-    self.fromDrag = True
+    self.endPointsDragging = False
     thisScene = markupsNode.GetScene()
-    existingMovedProbes = self.probeNodeIDs
-    for probeID in existingMovedProbes:
-      probeReference = thisScene.GetNodeByID(probeID)
-      slicer.mrmlScene.RemoveNode(probeReference)
-      print("Deleted: ", probeID)
-    self.onLineButton()
-    print("Moving probes... please wait a few seconds")
-    self.onProbeButton()
-    print("Finished moving probes!")
-
 
+    positions = []
+    for i in range(0, markupsNode.GetNumberOfFiducials()):
+      xyz = [0,0,0]
+      markupsNode.GetNthFiducialPosition(i, xyz)
+      positions.append(xyz)
+
+    probeNode = self.getProbeProfileNode()
+    if (probeNode is None or len(positions)%2 == 1 or len(positions) != len(self.endPoints_positions)
+        or len(self.probeNodeIDs) != len(positions)//2):
+      # the number of probes changed, place all of them again (onProbeButton reuses the existing probe nodes)
+      if probeNode is None or len(positions)%2 == 1:
+        self.logic.removeProbes(self.probeNodeIDs)
+        self.probeNodeIDs = []
+      self.onLineButton()
+      print("Moving probes... please wait a few seconds")
+      self.onProbeButton()
+      print("Finished moving probes!")
+      return
+
+    movedProbeIndices = [i for i in range(len(self.probeNodeIDs))
+      if positions[i*2] != self.endPoints_positions[i*2] or positions[i*2+1] != self.endPoints_positions[i*2+1]]
+    if not movedProbeIndices:
+      # dragged back to where the probes were placed
+      for probeNodeID in self.probeNodeIDs:
+        self.logic.removeProbeDragTransform(slicer.mrmlScene.GetNodeByID(probeNodeID))
+      self.onLineButton()
+      return
+
+    # only re-pose the probes whose end points moved, their nodes are updated in place
+    self.logic.placeProbes(probeNode, [(positions[i*2], positions[i*2+1]) for i in movedProbeIndices],
+      reuseNodeIDs=[self.probeNodeIDs[i] for i in movedProbeIndices])
+    self.endPoints_positions = positions
+    self.onLineButton()
+    if self.logic.getParameterNode().GetNodeReference("MarginPreviewModel") is not None:
+      self.onPreviewButton()
+    if self.logic.marginEvaluationTask is not None and not self.logic.marginEvaluationTask.finished:
+      # the running evaluation is for the previous probe positions: restart it with the new ones
+      if self.logic.ellipsoidProfileFromParameterNode(self._parameterNode) is None:
+        self.onTranslateButton()
+      self.onMarginButton()
 
+    outputMarginModel = self._parameterNode.GetNodeReference("outputMarginModel")
+    if outputMarginModel is None:
+      return
+    ellipsoidProfile = self.logic.ellipsoidProfileFromParameterNode(self._parameterNode)
+    statisticsThresholds = self.logic.parseMarginThresholds(self._parameterNode.GetParameter("StatisticsThresholds"))
+    planKey = self.getPlanKey()
+    combinedProbeNode = self._parameterNode.GetNodeReference("combinedProbeNode")
+    restoredEvaluation = self.logic.restorePlanEvaluation(planKey, outputMarginModel, statisticsThresholds, combinedProbeNode)
+    if restoredEvaluation is not None:
+      # this plan was evaluated before, e.g. the probe was moved back
+      self.lowerMargin, self.marginStatistics, zoneRestored = restoredEvaluation
+      if zoneRestored:
+        self.logic.setCombinedZone(combinedProbeNode, self.getZoneKey())
+      print("Restored the margins of a previously evaluated plan, lowest signed distance: ", self.lowerMargin)
+    else:
+      if ellipsoidProfile is not None:
+        self.lowerMargin, self.marginStatistics = self.logic.updateParametricMargins(outputMarginModel, ellipsoidProfile,
+          [self.logic.probePoses[probeNodeID] for probeNodeID in self.probeNodeIDs], statisticsThresholds)
+      else:
+        # update the margins from the cached per-probe distances, only the moved probes are queried again
+        self.lowerMargin, self.marginStatistics = self.logic.updateMarginsFromProbes(outputMarginModel, self.probeNodeIDs, statisticsThresholds)
+      if planKey is not None:
+        # the per-probe minimum is only exact where the zones do not overlap: it is restored while dragging,
+        # but evaluateMargins evaluates the plan again
+        self.logic.storePlanEvaluation(planKey, outputMarginModel, self.marginStatistics, exact=ellipsoidProfile is not None)
+      print("Updated margins of probes ", movedProbeIndices, ", lowest signed distance: ", self.lowerMargin)
+    if outputMarginModel.GetModelDisplayNode().GetActiveScalarName() == "MarginClass":
+      self.onColorButton()
 
 
 
@@ -485,311 +971,1641 @@ class AblationPlannerLogic(ScriptedLoadableModuleLogic):
 
   def __init__(self):
     ScriptedLoadableModuleLogic.__init__(self)
+    # per-probe signed distance functions and tumor vertex distances, keyed by probe node ID
+    self.probeDistanceFunctions = {}
+    self.probeDistances = {}
+    # (key, polydata) of the last extracted ablation profile surface
+    self.probeTemplateCache = None
+    # probe to world matrix of each placed probe, keyed by probe node ID
+    self.probePoses = {}
+    # decimated surfaces and their approximation error for preview evaluations, least recently used first
+    self.coarseSurfaceCache = collections.OrderedDict()
+    self.coarseSurfaceCacheSize = 8
+    # PipelineTask of the margin evaluation started last by evaluateMarginsAsync
+    self.marginEvaluationTask = None
+    # VolumeCoverage of the last margin evaluation, None if it was not requested
+    self.volumeCoverage = None
+    self.placementUncertainty = None
+    self.structureProximities = None
+    # watch folder pipeline (see startWatching)
+    self.folderWatcher = None
+    self.seenDicomSeries = None
+    self.watchTimer = None
+    self.watchTask = None
+    self.pendingSeries = None
+    self.watchOptions = {}
+    self.watchProbeNodeIDs = []
+    self.watchPlacementKey = None
+    # (key, SignedDistanceField) of the combined ablation zone, for margin queries after the tumor moved
+    self.zoneDistanceField = None
+    # on-disk cache of preprocessed profile files and the ProfileEntry of each loaded profile, keyed by file hash
+    self.profileCache = None
+    self.profileEntries = {}
+    # evaluations of plans (PlanEvaluation) by plan key, see getPlanKey
+    self.planCache = PlanCache(256 * 2**20)
+    # (key, pointsDigest) of the last tumor surface used in a plan key, see getTumorKey
+    self.tumorKey = None
 
   def setDefaultParameters(self, parameterNode):
     if not parameterNode:
         print("No parameter node entered!")
+        return
+    if not parameterNode.GetParameter("MarginThresholds"):
+        parameterNode.SetParameter("MarginThresholds", "-10, -5, -2")
+    if not parameterNode.GetParameter("StatisticsThresholds"):
+        parameterNode.SetParameter("StatisticsThresholds", "0, 5, 10")
+    if not parameterNode.GetParameter("DistanceBackend"):
+        parameterNode.SetParameter("DistanceBackend", "InProcess")
+    if not parameterNode.GetParameter("ProfileType"):
+        parameterNode.SetParameter("ProfileType", "Segmentation")
+    if not parameterNode.GetParameter("EllipsoidSemiAxes"):
+        parameterNode.SetParameter("EllipsoidSemiAxes", "15, 15, 20")
+    if not parameterNode.GetParameter("EllipsoidTipOffset"):
+        parameterNode.SetParameter("EllipsoidTipOffset", "10")
+    if not parameterNode.GetParameter("HistoryLength"):
+        parameterNode.SetParameter("HistoryLength", "0")
+    if not parameterNode.GetParameter("VolumeCoverage"):
+        parameterNode.SetParameter("VolumeCoverage", "false")
+    if not parameterNode.GetParameter("ShellMargin"):
+        parameterNode.SetParameter("ShellMargin", "5")
+
+  def getOutputNode(self, role, className, name):
+    """Return the output node of the module with the given role (e.g. "MarginModel"), created on first use.
+    Output nodes are referenced by the parameter node and updated in place by every planning iteration,
+    so that repeated iterations do not add nodes to the scene.
+    """
+    parameterNode = self.getParameterNode()
+    node = parameterNode.GetNodeReference(role)
+    if node is None:
+      node = slicer.mrmlScene.AddNewNodeByClass(className, name)
+      parameterNode.SetNodeReferenceID(role, node.GetID())
+    return node
+
+  def archiveMarginModel(self, outputNode, historyLength):
+    """Keep a hidden copy of the current result of a margin model before it is overwritten, at most historyLength
+    copies (the oldest ones are removed). The copies are referenced by the parameter node as "MarginHistory".
+    """
+    parameterNode = self.getParameterNode()
+    polyData = outputNode.GetPolyData()
+    if historyLength > 0 and polyData is not None and polyData.GetPointData().GetArray("Signed") is not None:
+      historyPolyData = vtk.vtkPolyData()
+      historyPolyData.DeepCopy(polyData)
+      historyNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLModelNode", slicer.mrmlScene.GenerateUniqueName(outputNode.GetName() + " previous"))
+      historyNode.SetAndObservePolyData(historyPolyData)
+      historyNode.CreateDefaultDisplayNodes()
+      historyNode.GetDisplayNode().SetVisibility(False)
+      parameterNode.AddNodeReferenceID("MarginHistory", historyNode.GetID())
+    while parameterNode.GetNumberOfNodeReferences("MarginHistory") > historyLength:
+      oldestNode = parameterNode.GetNthNodeReference("MarginHistory", 0)
+      parameterNode.RemoveNthNodeReferenceID("MarginHistory", 0)
+      if oldestNode is not None:
+        slicer.mrmlScene.RemoveNode(oldestNode)
+
+  def removeProbes(self, probeNodeIDs):
+    """Remove placed probe segmentation nodes from the scene and forget their cached geometry and distances."""
+    with batchSceneModification():
+      for probeNodeID in probeNodeIDs:
+        probeNode = slicer.mrmlScene.GetNodeByID(probeNodeID)
+        if probeNode is not None:
+          self.removeProbeDragTransform(probeNode)
+          slicer.mrmlScene.RemoveNode(probeNode)
+        self.invalidateProbeDistances(probeNodeID)
+
+  def previewProbeDrag(self, probeNodeID, tip, entry, lineIndex=None):
+    """Show a placed probe at a new tip and entry without touching its geometry: a linear transform (not hardened)
+    moves it from its placed pose, and the line of the probe (lineIndex of updateProbeLines) is moved to match.
+    The transform is removed when the probe is placed again (placeProbes) or removed.
+    """
+    probeNode = slicer.mrmlScene.GetNodeByID(probeNodeID)
+    placedPose = self.probePoses.get(probeNodeID)
+    if probeNode is None or placedPose is None:
+      return
+    draggedPose = probePosesFromEndPoints(tip, entry)[0]
+    transformNode = probeNode.GetParentTransformNode()
+    if transformNode is None or transformNode.GetAttribute("AblationPlanner.DragTransform") is None:
+      transformNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLinearTransformNode", probeNode.GetName() + " drag")
+      transformNode.SetAttribute("AblationPlanner.DragTransform", "1")
+      transformNode.SetHideFromEditors(True)
+      probeNode.SetAndObserveTransformNodeID(transformNode.GetID())
+    transformNode.SetMatrixTransformToParent(slicer.util.vtkMatrixFromArray(draggedPose.dot(np.linalg.inv(placedPose))))
+    if lineIndex is not None:
+      lineNode = self.getParameterNode().GetNthNodeReference("ProbeLine", lineIndex)
+      if lineNode is not None:
+        slicer.util.updateMarkupsControlPointsFromArray(lineNode, np.asarray([tip, entry], dtype=float))
+
+  def removeProbeDragTransform(self, probeNode):
+    """Remove the drag preview transform of a probe (see previewProbeDrag), if any."""
+    transformNode = probeNode.GetParentTransformNode() if probeNode is not None else None
+    if transformNode is not None and transformNode.GetAttribute("AblationPlanner.DragTransform") is not None:
+      probeNode.SetAndObserveTransformNodeID(None)
+      slicer.mrmlScene.RemoveNode(transformNode)
+
+  def updateProbeLines(self, endPointPairs):
+    """Show a line from tip to entry for every (tip, entry) pair.
+    The line markups are output nodes of the module ("ProbeLine" references of the parameter node): existing lines
+    are moved in place, missing ones added and extra ones removed, all in one batch. Returns the line nodes.
+    """
+    parameterNode = self.getParameterNode()
+    lineNodes = []
+    with batchSceneModification():
+      for lineIndex, (tip, entry) in enumerate(endPointPairs):
+        lineNode = parameterNode.GetNthNodeReference("ProbeLine", lineIndex)
+        if lineNode is None:
+          lineNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsLineNode", "probe line " + str(lineIndex+1))
+          lineNode.CreateDefaultDisplayNodes()
+          lineDisplayNode = lineNode.GetDisplayNode()
+          lineDisplayNode.SetPropertiesLabelVisibility(False)
+          lineDisplayNode.SetPointSize(0.5)
+          lineDisplayNode.SetSelectable(False)
+          parameterNode.SetNthNodeReferenceID("ProbeLine", lineIndex, lineNode.GetID())
+        slicer.util.updateMarkupsControlPointsFromArray(lineNode, np.asarray([tip, entry], dtype=float))
+        lineNodes.append(lineNode)
+      while parameterNode.GetNumberOfNodeReferences("ProbeLine") > len(endPointPairs):
+        lineNode = parameterNode.GetNthNodeReference("ProbeLine", len(endPointPairs))
+        parameterNode.RemoveNthNodeReferenceID("ProbeLine", len(endPointPairs))
+        if lineNode is not None:
+          slicer.mrmlScene.RemoveNode(lineNode)
+    return lineNodes
+
+  def updateTumorRegistration(self, nativeFiducials, newFiducials, tumorNode=None, similarity=False):
+    """Fit the transform from the native to the new (intra-procedure) space to the corresponding fiducials
+    (the n-th native point corresponds to the n-th new point) and apply it to the tumor.
+    The fit is rigid, or a similarity transform (rotation, translation and isotropic scale) with similarity.
+    The same "Native to new" transform node is updated every time.
+    Returns the transform node, the registration error of each fiducial pair (mm) and their RMS.
+    """
+    pointCount = min(nativeFiducials.GetNumberOfControlPoints(), newFiducials.GetNumberOfControlPoints())
+    nativePoints = slicer.util.arrayFromMarkupsControlPoints(nativeFiducials, world=True)[:pointCount]
+    newPoints = slicer.util.arrayFromMarkupsControlPoints(newFiducials, world=True)[:pointCount]
+    nativeToNew = registerPoints(nativePoints, newPoints, similarity)
+    errors, rmsError = registrationErrors(nativeToNew, nativePoints, newPoints)
+
+    transformNode = self.getOutputNode("TumorRegistrationTransform", "vtkMRMLLinearTransformNode", "Native to new")
+    transformNode.SetMatrixTransformToParent(slicer.util.vtkMatrixFromArray(nativeToNew))
+    if tumorNode is not None and tumorNode.GetTransformNodeID() != transformNode.GetID():
+      tumorNode.SetAndObserveTransformNodeID(transformNode.GetID())
+    return transformNode, errors, rmsError
+
+  def setTimingEnabled(self, enabled, captureProfile=False):
+    """Switch the recording of pipeline stage timing (and cProfile capture) on or off.
+    Recorded stages are listed in the "AblationPlanner timing" table node, updated after each top-level stage.
+    """
+    profiler.enabled = enabled
+    profiler.captureProfile = captureProfile
+    profiler.topLevelSpanFinishedCallback = self.updateTimingTableNode if enabled else None
+
+  def updateTimingTableNode(self):
+    """Write the recorded stages into the timing table node (one row per stage, indented by nesting level)."""
+    tableNode = self.getOutputNode("TimingTable", "vtkMRMLTableNode", "AblationPlanner timing")
+    columns = [("Stage", vtk.vtkStringArray()), ("Start (s)", vtk.vtkDoubleArray()), ("Duration (s)", vtk.vtkDoubleArray()),
+      ("Nodes before", vtk.vtkIntArray()), ("Nodes after", vtk.vtkIntArray()), ("Memory after (MB)", vtk.vtkDoubleArray()),
+      ("Details", vtk.vtkStringArray())]
+    for columnName, column in columns:
+      column.SetName(columnName)
+    for span in profiler.spans:
+      columns[0][1].InsertNextValue("  " * span["depth"] + span["name"])
+      columns[1][1].InsertNextValue(span["start"])
+      columns[2][1].InsertNextValue(span["duration"])
+      columns[3][1].InsertNextValue(span.get("stateBefore", {}).get("nodeCount", -1))
+      columns[4][1].InsertNextValue(span.get("stateAfter", {}).get("nodeCount", -1))
+      columns[5][1].InsertNextValue(span.get("stateAfter", {}).get("processMemory") or float("nan"))
+      columns[6][1].InsertNextValue(", ".join("{0}: {1}".format(key, value) for key, value in span["attributes"].items()))
+    table = vtk.vtkTable()
+    for columnName, column in columns:
+      table.AddColumn(column)
+    tableNode.SetAndObserveTable(table)
+    return tableNode
+
+  def parseMarginThresholds(self, text):
+    """Parse a comma separated list of distance thresholds (mm), e.g. "-10, -5, -2"."""
+    thresholds = [float(value) for value in text.replace(";", ",").split(",") if value.strip()]
+    if not thresholds:
+      raise ValueError("at least one threshold is required")
+    return thresholds
+
+  @profiler.spanned()
+  def optimizeProbeTrajectories(self, tumorNode, profile, probeCount, entryRegionNode, objective="margin",
+                                requiredMargin=5.0, maximumWorkers=None, maximumTumorPoints=500, numberOfPlans=1,
+                                endPointsNode=None, **searchOptions):
+    """Search tip and entry positions of probeCount probes that maximize the minimum margin (objective="margin")
+    or the fraction of the tumor surface with at least requiredMargin mm of margin (objective="coverage").
+    profile is an EllipsoidProfile or a profile segmentation, which is approximated by the ellipsoid inscribed
+    in its bounding box. Entry points are sampled from entryRegionNode (the control points of a markups node
+    or the inside of an ROI). Candidate plans are scored in batches on up to maximumWorkers worker processes
+    (1 runs the search in this process), on at most maximumTumorPoints tumor vertices; the best plans are then
+    scored again on the full tumor surface.
+    The best plan is written to endPointsNode (a new "OptimizedEndPoints" markups node by default) with the same
+    tip/entry ordering as manually placed end points, so that "Place Probes" can take over.
+    Returns the endpoints node and the best plans (dictionaries with score, minimumMargin, coverage, tips, entries).
+    """
+    if not isinstance(profile, EllipsoidProfile):
+      profile = self.getProfileEllipsoid(profile)
+    tumorPoints = numpy_support.vtk_to_numpy(getSegmentWorldPolyData(tumorNode).GetPoints().GetData()).astype(float)
+    searchPoints = tumorPoints
+    if len(tumorPoints) > maximumTumorPoints:
+      searchPoints = tumorPoints[np.random.RandomState(0).choice(len(tumorPoints), maximumTumorPoints, replace=False)]
+    candidateEntries = self.getEntryRegionPoints(entryRegionNode)
+
+    startTime = time.perf_counter()
+    if maximumWorkers == 1:
+      plans = TrajectoryOptimizer.optimizeTrajectories(profile, searchPoints, candidateEntries, probeCount,
+        objective=objective, requiredMargin=requiredMargin, numberOfPlans=numberOfPlans, **searchOptions)
+    else:
+      with createProcessPool(maximumWorkers, TrajectoryOptimizer.initializeWorker,
+          (profile, searchPoints, objective, requiredMargin)) as executor:
+        plans = TrajectoryOptimizer.optimizeTrajectories(profile, searchPoints, candidateEntries, probeCount,
+          mapBatches=executor.map, objective=objective, requiredMargin=requiredMargin,
+          numberOfPlans=numberOfPlans, **searchOptions)
+
+    for plan in plans:
+      scores, minimumMargins, coverages = TrajectoryOptimizer.scorePlans(profile, tumorPoints,
+        plan["tips"][np.newaxis], plan["entries"][np.newaxis], objective, requiredMargin)
+      plan.update(score=float(scores[0]), minimumMargin=float(minimumMargins[0]), coverage=float(coverages[0]))
+    plans.sort(key=lambda plan: -plan["score"])
+    logging.info("Optimized {0} probe trajectories in {1:.1f} s, minimum margin {2:.2f} mm, coverage {3:.1%}".format(
+      probeCount, time.perf_counter() - startTime, plans[0]["minimumMargin"], plans[0]["coverage"]))
+
+    if endPointsNode is None:
+      endPointsNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode", "OptimizedEndPoints")
+    self.setEndPointsFromPlan(endPointsNode, plans[0]["tips"], plans[0]["entries"])
+    return endPointsNode, plans
+
+  @profiler.spanned()
+  def analyzePlacementUncertainty(self, tumorNode, profile, endPointPairs, sampleCount=500, tipError=2.0, entryError=2.0,
+                                  distribution="normal", requiredMargin=5.0, maximumWorkers=None, randomSeed=None):
+    """Monte Carlo analysis of the margins of a plan when the probes do not land exactly on the planned tip and
+    entry points (see AblationPlannerLib.PlacementUncertainty). Every sample displaces each tip and entry by
+    tipError and entryError (mm) drawn from distribution ("normal" or "uniform").
+    Samples are evaluated with the closed form zones of an EllipsoidProfile or, for a profile segmentation, with
+    its distance field when it was loaded with one (loadProfile) and otherwise with the ellipsoid inscribed in its
+    bounding box, an approximation reported in the zoneModel of the result and in the table; batches of samples
+    are scored on up to maximumWorkers worker processes (1 runs them in this process).
+    The probability of inadequate margin (less than requiredMargin) of every tumor vertex is stored in the
+    "InadequateMarginProbability" array of the tumor model, which is colored with it, and the distributions of the
+    minimum margin and coverage are written to the "placement_uncertainty" table.
+    Returns the PlacementUncertainty, the tumor model and the table node.
+    """
+    if isinstance(profile, EllipsoidProfile):
+      distanceProfile = profile
+      zoneModel = "parametric ellipsoid"
+    else:
+      entry = self.getProfileEntry(profile)
+      if entry is not None and entry.distanceField is not None:
+        distanceProfile = entry.distanceField
+        zoneModel = "profile distance field"
+      else:
+        distanceProfile = self.getProfileEllipsoid(profile)
+        zoneModel = "bounding box ellipsoid of the profile (approximation)"
+        logging.warning("No distance field for {0}, placement errors are evaluated with {1}".format(profile.GetName(), distanceProfile))
+    tumorModel = updateModelFromSegment(tumorNode, self.getOutputNode("TumorModel", "vtkMRMLModelNode", "tumor model"))
+    tumorPoints = slicer.util.arrayFromModelPoints(tumorModel).astype(float)
+    endPointPairs = np.asarray(endPointPairs, dtype=float).reshape(-1, 2, 3)
+
+    startTime = time.perf_counter()
+    if maximumWorkers == 1:
+      uncertainty = PlacementUncertainty.analyzePlacementUncertainty(distanceProfile, tumorPoints, endPointPairs[:,0], endPointPairs[:,1],
+        sampleCount, tipError, entryError, distribution, requiredMargin, randomSeed=randomSeed)
+    else:
+      with createProcessPool(maximumWorkers, PlacementUncertainty.initializeWorker,
+          (distanceProfile, tumorPoints, requiredMargin)) as executor:
+        uncertainty = PlacementUncertainty.analyzePlacementUncertainty(distanceProfile, tumorPoints, endPointPairs[:,0], endPointPairs[:,1],
+          sampleCount, tipError, entryError, distribution, requiredMargin, mapBatches=executor.map, randomSeed=randomSeed)
+    logging.info("Evaluated {0} placement samples in {1:.1f} s".format(sampleCount, time.perf_counter() - startTime))
+    uncertainty.zoneModel = zoneModel
+
+    with batchSceneModification():
+      setModelPointDataArray(tumorModel, "InadequateMarginProbability", uncertainty.inadequateMarginProbability)
+      displayNode = tumorModel.GetDisplayNode()
+      displayNode.SetVisibility(True)
+      displayNode.SetOpacity(1.0)
+      displayNode.SetActiveScalarName("InadequateMarginProbability")
+      displayNode.SetAndObserveColorNodeID("vtkMRMLColorTableNodeRed")
+      displayNode.SetScalarRangeFlag(slicer.vtkMRMLDisplayNode.UseManualScalarRange)
+      displayNode.SetScalarRange(0.0, 1.0)
+      displayNode.SetScalarVisibility(True)
+      tableNode = self.updatePlacementUncertaintyTable(uncertainty)
+    self.placementUncertainty = uncertainty
+    self.printPlacementUncertainty(uncertainty)
+    return uncertainty, tumorModel, tableNode
+
+  def updatePlacementUncertaintyTable(self, uncertainty):
+    """Write the minimum margin and coverage distributions of a PlacementUncertainty into a (statistic, value) table."""
+    tableNode = self.getOutputNode("PlacementUncertaintyTable", "vtkMRMLTableNode", "placement_uncertainty")
+    marginPercentiles = uncertainty.minimumMarginPercentiles()
+    coveragePercentiles = uncertainty.coveragePercentiles()
+    rows = [("Zone model: {0}".format(uncertainty.zoneModel), float("nan"))] if uncertainty.zoneModel else []
+    rows += [("Samples", uncertainty.sampleCount), ("Tip error (mm, {0})".format(uncertainty.distribution), uncertainty.tipError),
+      ("Entry error (mm, {0})".format(uncertainty.distribution), uncertainty.entryError),
+      ("Nominal minimum margin (mm)", uncertainty.nominalMinimumMargin),
+      ("Minimum margin mean (mm)", float(np.mean(uncertainty.minimumMargins))),
+      ("Minimum margin 5th percentile (mm)", marginPercentiles[0]), ("Minimum margin median (mm)", marginPercentiles[1]),
+      ("Minimum margin 95th percentile (mm)", marginPercentiles[2]),
+      ("Samples with tumor outside the zone (%)", 100.0 * uncertainty.failureProbability(0.0)),
+      ("Samples with margin below {0:g} mm (%)".format(uncertainty.requiredMargin), 100.0 * uncertainty.failureProbability(uncertainty.requiredMargin)),
+      ("Nominal coverage with {0:g} mm margin (%)".format(uncertainty.requiredMargin), 100.0 * uncertainty.nominalCoverage),
+      ("Coverage mean (%)", 100.0 * float(np.mean(uncertainty.coverages))),
+      ("Coverage 5th percentile (%)", 100.0 * coveragePercentiles[0]), ("Coverage median (%)", 100.0 * coveragePercentiles[1])]
+    names = vtk.vtkStringArray()
+    names.SetName("Statistic")
+    values = vtk.vtkDoubleArray()
+    values.SetName("Value")
+    for name, value in rows:
+      names.InsertNextValue(name)
+      values.InsertNextValue(value)
+    table = vtk.vtkTable()
+    table.AddColumn(names)
+    table.AddColumn(values)
+    tableNode.SetAndObserveTable(table)
+    return tableNode
+
+  def printPlacementUncertainty(self, uncertainty):
+    lower, median, upper = uncertainty.minimumMarginPercentiles()
+    print("Placement uncertainty ({0} samples): minimum margin {1:.2f} mm nominal, median {2:.2f} mm, 5th-95th percentile {3:.2f} to {4:.2f} mm".format(
+      uncertainty.sampleCount, uncertainty.nominalMinimumMargin, median, lower, upper))
+    print("Samples with part of the tumor outside the ablation zone: {0:.1%}, with less than {1:g} mm margin: {2:.1%}".format(
+      uncertainty.failureProbability(0.0), uncertainty.requiredMargin, uncertainty.failureProbability(uncertainty.requiredMargin)))
+    if uncertainty.zoneModel:
+      print("Ablation zones evaluated with the " + uncertainty.zoneModel)
+
+  def getEntryRegionPoints(self, entryRegionNode, sampleCount=500):
+    """Return candidate entry points (N,3): samples inside an ROI, or the (curve) points of other markups."""
+    if entryRegionNode.IsA("vtkMRMLMarkupsROINode"):
+      center = [0,0,0]
+      entryRegionNode.GetCenterWorld(center)
+      objectToWorld = slicer.util.arrayFromVTKMatrix(entryRegionNode.GetObjectToWorldMatrix())
+      samples = (np.random.RandomState(0).uniform(size=(sampleCount, 3)) - 0.5) * np.array(entryRegionNode.GetSize())
+      return samples.dot(objectToWorld[:3,:3].T) + center
+    if entryRegionNode.IsA("vtkMRMLMarkupsCurveNode"):
+      return slicer.util.arrayFromMarkupsCurvePoints(entryRegionNode, world=True)
+    return slicer.util.arrayFromMarkupsControlPoints(entryRegionNode, world=True)
+
+  def setEndPointsFromPlan(self, endPointsNode, tips, entries):
+    """Write a plan to an end points markups node: tip and entry of each probe, one after the other."""
+    pointPositions = np.stack([tips, entries], axis=1).reshape(-1, 3)
+    slicer.util.updateMarkupsControlPointsFromArray(endPointsNode, pointPositions)
+    for probeIndex in range(len(tips)):
+      endPointsNode.SetNthControlPointLabel(probeIndex*2, "tip-" + str(probeIndex+1))
+      endPointsNode.SetNthControlPointLabel(probeIndex*2+1, "entry-" + str(probeIndex+1))
+
+  def endPointPairsFromMarkups(self, endPointsMarkupsNode):
+    """Return the (tip, entry) position pairs of the end points: odd points are tips, even points entries."""
+    positions = slicer.util.arrayFromMarkupsControlPoints(endPointsMarkupsNode, world=True)
+    if len(positions) < 2 or len(positions) % 2 == 1:
+      raise ValueError("an even number of end points is required, found {0}".format(len(positions)))
+    return [(positions[i], positions[i+1]) for i in range(0, len(positions), 2)]
+
+  @profiler.spanned()
+  def processCase(self, tumorPath, endPointsPath, profilePath, caseOutputDirectory, distanceBackend="InProcess"):
+    """Run probe placement, zone union and margin evaluation on one case loaded from files, without the widget,
+    and write the per-vertex distances and the margin summary to caseOutputDirectory.
+    Returns the summary.
+    """
+    tumorNode = slicer.util.loadSegmentation(tumorPath)
+    endPointsNode = slicer.util.loadMarkups(endPointsPath)
+    profileNode = slicer.util.loadSegmentation(profilePath)
+    endPointPairs = self.endPointPairsFromMarkups(endPointsNode)
+
+    probeNodeIDs = self.placeProbes(profileNode, endPointPairs)
+    combinedProbeNode = self.convertSegmentsToSegment(profileNode, probeNodeIDs)
+    outputNode = self.evaluateMargins(tumorNode, combinedProbeNode, distanceBackend)[0]
+
+    caseInfo = {"tumor": tumorPath, "endPoints": endPointsPath, "profile": profilePath, "numberOfProbes": len(endPointPairs)}
+    return BatchProcessing.writeCaseResults(caseOutputDirectory, slicer.util.arrayFromModelPoints(outputNode),
+      slicer.util.arrayFromModelPointData(outputNode, "Signed"), caseInfo, computeVertexAreas(outputNode.GetPolyData()))
+
+  def runBatch(self, cases, profilePath, outputDirectory, maximumWorkers=2, resume=True, distanceBackend="InProcess", timeout=None):
+    """Evaluate many cases in parallel headless Slicer processes (see processCase).
+    cases is a list of dictionaries with name, tumor and endPoints (file paths) entries, e.g. from
+    AblationPlannerLib.BatchProcessing.findCases; a case can override the profile with a "profile" entry.
+    Results go to outputDirectory/<case name>/ and a summary.csv with one row per case. An interrupted batch
+    is resumed by running it again with the same output directory. Returns the path of summary.csv.
+    """
+    launcherPath = getattr(slicer.app, "launcherExecutableFilePath", "") or slicer.app.applicationFilePath()
+
+    def caseCommand(case, caseOutputDirectory):
+      caseArguments = json.dumps([case["tumor"], case["endPoints"], case.get("profile", profilePath), caseOutputDirectory, distanceBackend])
+      return [launcherPath, "--no-splash", "--no-main-window", "--python-code",
+        "import AblationPlanner; AblationPlanner.processBatchCase({0!r})".format(caseArguments)]
+
+    startTime = time.perf_counter()
+    summaryPath = BatchProcessing.runBatch(cases, outputDirectory, caseCommand, maximumWorkers, resume, timeout)
+    logging.info("Processed {0} cases in {1:.1f} s, summary written to {2}".format(len(cases), time.perf_counter() - startTime, summaryPath))
+    return summaryPath
+
+  def startWatching(self, directory=None, useDicomDatabase=False, probeNodeIDs=None, stageCallback=None, similarity=False,
+                    settleTime=2.0, pollInterval=1.0, processExisting=False):
+    """Rerun the planning pipeline on every new intra-procedure scan: a file or subdirectory copied into directory
+    (see AblationPlannerLib.WatchFolder) and/or a series added to the DICOM database of the application.
+    For each scan, the tumor is registered to the fiducials of the scan (a markups file of the series; otherwise the
+    current "new" fiducials are used), the probes are placed at the end points (a markups file of the series with
+    "endpoints" in its name, or the current end points), their zones are combined and the margins are evaluated.
+    Stages whose inputs did not change are skipped, and cached data is reused: when only the tumor moved the margins
+    are sampled from the cached distance field of the zone, and evaluated plans come from the plan cache.
+    The scan's image is loaded last, so that it never delays the results.
+    stageCallback(series, stage, result) is called as soon as each stage ("registration", "placement", "union",
+    "margins", "volume") is done. The pipeline runs without blocking the application; a scan arriving while one
+    is processed waits for it, and only the newest waiting scan is processed.
+    probeNodeIDs are the probes already placed, which are moved in place. With pollInterval None the sources are
+    not polled by a timer, processNewSeries polls them instead.
+    """
+    self.stopWatching()
+    self.watchOptions = {"stageCallback": stageCallback, "similarity": similarity}
+    self.watchProbeNodeIDs = list(probeNodeIDs or [])
+    self.watchPlacementKey = None
+    if directory:
+      self.folderWatcher = FolderWatcher(directory, settleTime)
+      if not processExisting:
+        self.folderWatcher.ignoreExisting()
+    if useDicomDatabase:
+      self.seenDicomSeries = set() if processExisting else set(self.getDicomSeriesUIDs())
+    if pollInterval is not None:
+      self.watchTimer = qt.QTimer()
+      self.watchTimer.setInterval(int(pollInterval * 1000))
+      self.watchTimer.connect("timeout()", self.processNewSeries)
+      self.watchTimer.start()
+
+  def stopWatching(self):
+    """Stop watching for new scans (a scan being processed is completed)."""
+    if self.watchTimer is not None:
+      self.watchTimer.stop()
+      self.watchTimer = None
+    self.folderWatcher = None
+    self.seenDicomSeries = None
+    self.pendingSeries = None
+
+  def getDicomSeriesUIDs(self):
+    database = slicer.dicomDatabase
+    if database is None or not database.isOpen:
+      return []
+    return [seriesUID for patient in database.patients() for study in database.studiesForPatient(patient)
+      for seriesUID in database.seriesForStudy(study)]
+
+  def pollNewSeries(self):
+    """Return the new scans of the watched folder and DICOM database (oldest first)."""
+    newSeries = []
+    if self.folderWatcher is not None:
+      newSeries += self.folderWatcher.poll()
+    if self.seenDicomSeries is not None:
+      for seriesUID in self.getDicomSeriesUIDs():
+        if seriesUID not in self.seenDicomSeries:
+          self.seenDicomSeries.add(seriesUID)
+          seriesName = slicer.dicomDatabase.descriptionForSeries(seriesUID) or seriesUID
+          newSeries.append(Series(seriesName, None, list(slicer.dicomDatabase.filesForSeries(seriesUID)), seriesUID))
+    return newSeries
+
+  def processNewSeries(self, synchronous=False):
+    """Poll the watched sources and start the pipeline on the newest scan if none is running (with synchronous, the
+    pipeline is run before returning). Returns the PipelineTask that was started, or None."""
+    newSeries = self.pollNewSeries()
+    if newSeries:
+      # an older scan that is still waiting is superseded by the newer one
+      self.pendingSeries = newSeries[-1]
+    if self.pendingSeries is None or (self.watchTask is not None and not self.watchTask.finished):
+      return None
+    series, self.pendingSeries = self.pendingSeries, None
+    logging.info("Processing the new scan " + series.name)
+    self.watchTask = PipelineTask(self.watchPipelineSteps(series), finishedCallback=self.onWatchTaskFinished)
+    if synchronous:
+      self.watchTask.run()
+    else:
+      self.watchTask.start()
+    return self.watchTask
+
+  def onWatchTaskFinished(self, task):
+    if task.error is not None:
+      logging.error("The pipeline failed on the new scan: " + str(task.error))
+    if self.pendingSeries is not None:
+      qt.QTimer.singleShot(0, self.processNewSeries)
+
+  def watchPipelineSteps(self, series):
+    """Steps of the pipeline run on a new scan (see startWatching), run by a PipelineTask.
+    Returns the MarginStatistics of the scan."""
+    parameterNode = self.getParameterNode()
+    statisticsThresholds = (0, 5, 10)
+    if parameterNode.GetParameter("StatisticsThresholds"):
+      statisticsThresholds = self.parseMarginThresholds(parameterNode.GetParameter("StatisticsThresholds"))
+    stageCallback = self.watchOptions.get("stageCallback")
+    def publish(stage, result):
+      logging.info("{0}: {1} done".format(series.name, stage))
+      if stageCallback is not None:
+        stageCallback(series, stage, result)
+    seriesFiles = series.classify()
+    tumorNode = parameterNode.GetNodeReference("InputTumor")
+    if tumorNode is None:
+      raise ValueError("No tumor segmentation is selected")
+
+    yield ("progress", 0.0, "Registering the tumor to " + series.name)
+    nativeFiducials = parameterNode.GetNodeReference("NativeFiducials")
+    newFiducials = parameterNode.GetNodeReference("NewFiducials")
+    if seriesFiles["fiducials"] is not None and newFiducials is not None:
+      self.updateMarkupsFromFile(newFiducials, seriesFiles["fiducials"])
+    registration = None
+    if nativeFiducials is not None and newFiducials is not None:
+      registration = self.updateTumorRegistration(nativeFiducials, newFiducials, tumorNode, self.watchOptions.get("similarity", False))
+    publish("registration", registration)
+
+    yield ("progress", 0.25, "Placing the probes")
+    endPointsNode = parameterNode.GetNodeReference("EndPoints")
+    if seriesFiles["endPoints"] is not None and endPointsNode is not None:
+      self.updateMarkupsFromFile(endPointsNode, seriesFiles["endPoints"])
+    if endPointsNode is None:
+      raise ValueError("No end points are selected")
+    endPointPairs = self.endPointPairsFromMarkups(endPointsNode)
+    ellipsoidProfile = self.ellipsoidProfileFromParameterNode(parameterNode)
+    profileNode = self.getEllipsoidProfileNode(ellipsoidProfile) if ellipsoidProfile is not None else parameterNode.GetNodeReference("InputSurface")
+    if profileNode is None:
+      raise ValueError("No ablation profile is selected")
+    placementKey = (profileNode.GetID(), profileNode.GetSegmentation().GetMTime(), quantizeEndPoints(endPointPairs).tobytes())
+    placementChanged = (placementKey != self.watchPlacementKey
+      or any(slicer.mrmlScene.GetNodeByID(probeNodeID) is None for probeNodeID in self.watchProbeNodeIDs))
+    if placementChanged:
+      probeNodeIDs = self.placeProbes(profileNode, endPointPairs, reuseNodeIDs=self.watchProbeNodeIDs)
+      self.removeProbes(self.watchProbeNodeIDs[len(probeNodeIDs):])
+      self.watchProbeNodeIDs = probeNodeIDs
+      self.updateProbeLines(endPointPairs)
+      self.watchPlacementKey = placementKey
+    publish("placement", self.watchProbeNodeIDs)
+
+    probePoses = None
+    if ellipsoidProfile is not None:
+      zone = ellipsoidProfile
+      probePoses = [self.probePoses[probeNodeID] for probeNodeID in self.watchProbeNodeIDs]
+    else:
+      yield ("progress", 0.4, "Combining the ablation zones")
+      # the combined zone is reused only if it was built for these end points (not e.g. before a probe was dragged)
+      zoneKey = self.getZoneKey(profileNode, endPointPairs)
+      zone = self.getCombinedZone(zoneKey)
+      if zone is None:
+        zone = self.convertSegmentsToSegment(profileNode, self.watchProbeNodeIDs)
+        self.setCombinedZone(zone, zoneKey)
+      publish("union", zone)
+
+    yield ("progress", 0.5, "Evaluating the margins")
+    marginModel = parameterNode.GetNodeReference("MarginModel")
+    if (not placementChanged and marginModel is not None and marginModel.GetPolyData() is not None
+        and marginModel.GetPolyData().GetPointData().GetArray("Signed") is not None):
+      # only the tumor moved: the margins are sampled from the zone of the current end points
+      lowerMargin, statistics = self.updateMarginsForTumor(marginModel, tumorNode, zone, probePoses, statisticsThresholds)
+      self.updateMarginSummaryTable(statistics)
+    else:
+      marginModel, resultTableNode, lowerMargin, statistics = yield from self.evaluateMarginsSteps(tumorNode, zone, "InProcess",
+        probePoses, statisticsThresholds, planKey=self.getPlanKey(profileNode if ellipsoidProfile is None else ellipsoidProfile, endPointPairs, tumorNode))
+    parameterNode.SetNodeReferenceID("outputMarginModel", marginModel.GetID())
+    publish("margins", (marginModel, statistics))
+
+    if seriesFiles["volumes"] or series.seriesInstanceUID:
+      yield ("progress", 0.9, "Loading " + series.name)
+      publish("volume", self.loadSeriesVolume(series, seriesFiles["volumes"]))
+    return statistics
+
+  def updateMarkupsFromFile(self, markupsNode, path):
+    """Replace the control points of a markups node by those of a markups file (the node is kept)."""
+    loadedNode = slicer.util.loadMarkups(path)
+    try:
+      with batchSceneModification():
+        slicer.util.updateMarkupsControlPointsFromArray(markupsNode, slicer.util.arrayFromMarkupsControlPoints(loadedNode, world=True))
+        for pointIndex in range(loadedNode.GetNumberOfControlPoints()):
+          markupsNode.SetNthControlPointLabel(pointIndex, loadedNode.GetNthControlPointLabel(pointIndex))
+    finally:
+      slicer.mrmlScene.RemoveNode(loadedNode)
+
+  def loadSeriesVolume(self, series, volumePaths):
+    """Load the image of a scan and show it in the slice views. It replaces the image of the previous scan
+    ("IntraopVolume" reference of the parameter node). Returns the volume node, None if nothing could be loaded."""
+    if series.seriesInstanceUID is not None:
+      from DICOMLib import DICOMUtils
+      loadedNodeIDs = DICOMUtils.loadSeriesByUID([series.seriesInstanceUID])
+      volumeNodes = [slicer.mrmlScene.GetNodeByID(nodeID) for nodeID in loadedNodeIDs]
+      volumeNodes = [node for node in volumeNodes if node is not None and node.IsA("vtkMRMLScalarVolumeNode")]
+      volumeNode = volumeNodes[0] if volumeNodes else None
+    else:
+      # DICOM files of a series are read together from the first one
+      volumeNode = slicer.util.loadVolume(volumePaths[0], {"singleFile": len(volumePaths) == 1})
+    if volumeNode is None:
+      return None
+    parameterNode = self.getParameterNode()
+    previousVolumeNode = parameterNode.GetNodeReference("IntraopVolume")
+    parameterNode.SetNodeReferenceID("IntraopVolume", volumeNode.GetID())
+    if previousVolumeNode is not None and previousVolumeNode is not volumeNode:
+      slicer.mrmlScene.RemoveNode(previousVolumeNode)
+    slicer.util.setSliceViewerLayers(background=volumeNode)
+    return volumeNode
+
+  def ellipsoidProfileFromParameterNode(self, parameterNode):
+    """Return the parametric EllipsoidProfile selected in the parameter node, or None if a profile segmentation is used."""
+    if parameterNode.GetParameter("ProfileType") != "Ellipsoid":
+      return None
+    semiAxes = [float(value) for value in parameterNode.GetParameter("EllipsoidSemiAxes").replace(";", ",").split(",") if value.strip()]
+    return EllipsoidProfile(semiAxes, float(parameterNode.GetParameter("EllipsoidTipOffset") or 0))
+
+  def getEllipsoidProfileNode(self, profile):
+    """Return a segmentation node showing the ellipsoid profile in the probe frame, so that it can be placed like a
+    profile segmentation. The node is reused and updated when the profile parameters change.
+    """
+    parameterNode = self.getParameterNode()
+    profileNode = parameterNode.GetNodeReference("EllipsoidProfileNode")
+    if profileNode is None:
+      profileNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode", "ellipsoid profile")
+      profileNode.CreateDefaultDisplayNodes()
+      parameterNode.SetNodeReferenceID("EllipsoidProfileNode", profileNode.GetID())
+    if profileNode.GetAttribute("AblationPlanner.EllipsoidProfile") != repr(profile):
+      profileNode.GetSegmentation().RemoveAllSegments()
+      profileNode.AddSegmentFromClosedSurfaceRepresentation(createEllipsoidProfileSurface(profile), "ablation profile", [0,1,0])
+      profileNode.SetAttribute("AblationPlanner.EllipsoidProfile", repr(profile))
+    profileNode.SetDisplayVisibility(0)
+    return profileNode
+
+  def getProfileCache(self):
+    """Return the ProfileCache of preprocessed profile files, in the cache directory of the application."""
+    if self.profileCache is None:
+      self.profileCache = ProfileCache(os.path.join(slicer.app.cachePath, "AblationPlannerProfiles"))
+    return self.profileCache
+
+  @profiler.spanned()
+  def loadProfile(self, path, distanceFieldSpacing=None):
+    """Load an ablation profile segmentation file (in the probe frame) as a profile segmentation node.
+    The file is preprocessed once (labelmap to closed surface conversion, ellipsoid approximation and, with
+    distanceFieldSpacing in mm, a distance field of the surface used by the preview) and the result is kept in the
+    profile cache, keyed by the content hash of the file. A cached profile is created from its closed surface
+    without reading or converting the labelmap, and a profile already loaded in the scene is returned as is.
+    Returns the profile segmentation node.
+    """
+    key = fileContentHash(path)
+    entry = self.profileEntries.get(key)
+    if entry is None or (distanceFieldSpacing is not None and entry.distanceField is None):
+      profileCache = self.getProfileCache()
+      entry = profileCache.get(key)
+      if entry is None or (distanceFieldSpacing is not None and entry.distanceField is None):
+        startTime = time.perf_counter()
+        entry = self.preprocessProfile(path, entry, distanceFieldSpacing)
+        profileCache.put(key, entry)
+        logging.info("Preprocessed the ablation profile {0} in {1:.3f} s".format(path, time.perf_counter() - startTime))
+      self.profileEntries[key] = entry
+
+    for profileNode in slicer.util.getNodesByClass("vtkMRMLSegmentationNode"):
+      if profileNode.GetAttribute("AblationPlanner.ProfileHash") == key:
+        return profileNode
+    profileName = os.path.basename(path).split(".")[0]
+    profileNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode", profileName)
+    profileNode.CreateDefaultDisplayNodes()
+    profileNode.AddSegmentFromClosedSurfaceRepresentation(polyDataFromTriangles(entry.points, entry.triangles), profileName, [0,1,0])
+    profileNode.SetAttribute("AblationPlanner.ProfileHash", key)
+    return profileNode
+
+  def preprocessProfile(self, path, entry=None, distanceFieldSpacing=None):
+    """Return the ProfileEntry of a profile segmentation file; the surface of an existing entry is reused."""
+    if entry is None:
+      profileNode = slicer.util.loadSegmentation(path)
+      try:
+        profileNode.CreateClosedSurfaceRepresentation()
+        surfacePolyData = vtk.vtkPolyData()
+        profileNode.GetClosedSurfaceRepresentation(profileNode.GetSegmentation().GetNthSegmentID(0), surfacePolyData)
+      finally:
+        slicer.mrmlScene.RemoveNode(profileNode)
+      triangleFilter = vtk.vtkTriangleFilter()
+      triangleFilter.SetInputData(surfacePolyData)
+      triangleFilter.Update()
+      surfacePolyData = triangleFilter.GetOutput()
+      ellipsoid = EllipsoidProfile.fromBounds(surfacePolyData.GetBounds())
+      entry = ProfileEntry(numpy_support.vtk_to_numpy(surfacePolyData.GetPoints().GetData()),
+        numpy_support.vtk_to_numpy(surfacePolyData.GetPolys().GetConnectivityArray()), ellipsoid.semiAxes, ellipsoid.tipOffset)
+    if distanceFieldSpacing is not None and entry.distanceField is None:
+      entry.distanceField = buildSignedDistanceField(polyDataFromTriangles(entry.points, entry.triangles), distanceFieldSpacing, 10.0)
+    return entry
+
+  def getProfileEntry(self, profileNode):
+    """Return the ProfileEntry of a profile loaded with loadProfile, None for other profile segmentations."""
+    return self.profileEntries.get(profileNode.GetAttribute("AblationPlanner.ProfileHash"))
+
+  def getProfileEllipsoid(self, profileNode):
+    """Return the EllipsoidProfile approximating a profile segmentation (the ellipsoid inscribed in its bounding box)."""
+    entry = self.getProfileEntry(profileNode)
+    if entry is not None:
+      return EllipsoidProfile(entry.semiAxes, entry.tipOffset)
+    return EllipsoidProfile.fromBounds(self.getProbeTemplatePolyData(profileNode).GetBounds())
+
+  def getProbeTemplatePolyData(self, probeNode):
+    """Return the closed surface of the ablation profile, extracted once and reused until the profile changes."""
+    templateKey = (probeNode.GetID(), probeNode.GetSegmentation().GetMTime())
+    if self.probeTemplateCache is None or self.probeTemplateCache[0] != templateKey:
+      templatePolyData = vtk.vtkPolyData()
+      probeNode.GetClosedSurfaceRepresentation(probeNode.GetSegmentation().GetNthSegmentID(0), templatePolyData)
+      self.probeTemplateCache = (templateKey, templatePolyData)
+    return self.probeTemplateCache[1]
+
+  def getCoarseSurface(self, key, polyDataFunction, vertexBudget):
+    """Return a decimated surface with at most about vertexBudget points and an estimate of its approximation error (mm).
+    polyDataFunction() returns the full resolution surface; results are cached by key and vertexBudget.
+    """
+    cacheKey = (key, vertexBudget)
+    if cacheKey in self.coarseSurfaceCache:
+      self.coarseSurfaceCache.move_to_end(cacheKey)
+      return self.coarseSurfaceCache[cacheKey]
+    fullPolyData = polyDataFunction()
+    coarsePolyData = decimateSurface(fullPolyData, vertexBudget)
+    result = (coarsePolyData, surfaceApproximationError(fullPolyData, coarsePolyData))
+    self.coarseSurfaceCache[cacheKey] = result
+    while len(self.coarseSurfaceCache) > self.coarseSurfaceCacheSize:
+      self.coarseSurfaceCache.popitem(last=False)
+    return result
+
+  @profiler.spanned()
+  def evaluatePreviewMargins(self, tumorNode, probeNode, probePoses, vertexBudget=2000, statisticsThresholds=(0, 5, 10)):
+    """Quickly approximate the margins of the placed probes on decimated surfaces.
+    The tumor surface and the ablation profile (unless probeNode is an EllipsoidProfile, which is exact) are
+    decimated to about vertexBudget points and cached, so repeated previews only pose the coarse profile and
+    query it. Margins are written to a reused "margin preview" model. The returned error estimate (mm) is the sum of
+    the distances between the full and the coarse tumor and profile surfaces, measured at their vertices only
+    (surfaceApproximationError): it is not a strict bound, since the surfaces can be further apart inside their
+    triangles, but the preview margins are expected to be within about this much of the full resolution values.
+    A profile loaded with loadProfile together with a distance field is queried in that field instead of a
+    decimated profile. Use evaluateMargins for the exact, full resolution evaluation of the final plan.
+    Returns the preview model, the MarginStatistics and the error estimate.
+    """
+    transformNode = tumorNode.GetParentTransformNode()
+    tumorKey = ("tumor", tumorNode.GetID(), tumorNode.GetSegmentation().GetMTime(),
+      transformNode.GetID() if transformNode else None, transformNode.GetMTime() if transformNode else None)
+    coarseTumor, errorEstimate = self.getCoarseSurface(tumorKey, lambda: getSegmentWorldPolyData(tumorNode), vertexBudget)
+    tumorPoints = numpy_support.vtk_to_numpy(coarseTumor.GetPoints().GetData())
+
+    profileEntry = None if isinstance(probeNode, EllipsoidProfile) else self.getProfileEntry(probeNode)
+    if isinstance(probeNode, EllipsoidProfile):
+      signedDistances = probeNode.signedDistances(tumorPoints, probePoses)
+    elif profileEntry is not None and profileEntry.distanceField is not None:
+      # cached distance field of the profile, queried in the probe frame of each probe (poses are rigid);
+      # trilinear interpolation of a distance is off by at most half of the diagonal of a grid cell
+      distanceField = profileEntry.distanceField
+      errorEstimate += distanceField.spacing * np.sqrt(3) / 2
+      signedDistances = np.min([distanceField.sample((tumorPoints - probePose[:3,3]).dot(probePose[:3,:3]))
+        for probePose in probePoses], axis=0)
+    else:
+      templateKey = ("profile", probeNode.GetID(), probeNode.GetSegmentation().GetMTime())
+      coarseTemplate, templateError = self.getCoarseSurface(templateKey,
+        lambda: self.getProbeTemplatePolyData(probeNode), vertexBudget)
+      errorEstimate += templateError
+      signedDistances = None
+      for probePose in probePoses:
+        probeDistances = evaluateSignedDistances(buildSurfaceDistanceIndex(transformPolyData(coarseTemplate, probePose)), tumorPoints)
+        signedDistances = probeDistances if signedDistances is None else np.minimum(signedDistances, probeDistances)
+
+    previewModel = self.getOutputNode("MarginPreviewModel", "vtkMRMLModelNode", "margin preview")
+    if previewModel.GetDisplayNode() is None:
+      previewModel.CreateDefaultDisplayNodes()
+      previewDisplayNode = previewModel.GetModelDisplayNode()
+      previewDisplayNode.SetScalarVisibility(1)
+      previewDisplayNode.SetAndObserveColorNodeID("vtkMRMLColorTableNode2")
+    previewPolyData = vtk.vtkPolyData()
+    previewPolyData.ShallowCopy(coarseTumor)
+    previewModel.SetAndObservePolyData(previewPolyData)
+    setModelPointDataArray(previewModel, "Signed", signedDistances)
+    setModelPointDataArray(previewModel, "Absolute", np.abs(signedDistances))
+    previewModel.GetModelDisplayNode().SetActiveScalarName("Signed")
+
+    statistics = computeMarginStatistics(signedDistances, computeVertexAreas(coarseTumor), statisticsThresholds)
+    logging.info("Preview margins on {0} tumor vertices: minimum signed distance {1:.2f} mm (about +/- {2:.2f} mm)".format(
+      len(tumorPoints), statistics.minimum, errorEstimate))
+    return previewModel, statistics, errorEstimate
+
+  @profiler.spanned()
+  def placeProbes(self, probeNode, endPointPairs, probeNames=None, reuseNodeIDs=None):
+    """Place one copy of the ablation profile per (tip, entry) pair.
+    The profile surface is extracted once, all poses are computed in one batch and applied directly to the
+    geometry, and the segmentation nodes are added to the scene in a single batch.
+    The probe nodes in reuseNodeIDs (one per pair, in order) are moved in place instead of added; the caller
+    removes the ones that are not needed anymore.
+    Returns the IDs of the probe segmentation nodes.
+    """
+    if not endPointPairs:
+      return []
+    templatePolyData = self.getProbeTemplatePolyData(probeNode)
+    endPointPairs = np.asarray(endPointPairs, dtype=float).reshape(-1, 2, 3)
+    probePoses = probePosesFromEndPoints(endPointPairs[:,0], endPointPairs[:,1])
+    if probeNames is None:
+      probeNames = [probeNode.GetName() + "_" + str(i) for i in range(len(probePoses))]
+    reuseNodeIDs = list(reuseNodeIDs or [])
+
+    segDisplayNode = probeNode.GetDisplayNode()
+    segDisplayNode.SetOpacity(0.3)
 
-  def updateProbePosition(self, probeNodeID, probeNode, xyz1, xyz2, xyz3, xyz4):
-     #print("Updating probe position!")
-     #print(xyz1, " ", xyz2, " ", xyz3, " ", xyz4)
-     
-
-     fiducialDistance1 = (((abs(xyz2[0]-xyz1[0])) ** 2) + (abs(xyz2[1]-xyz1[1]) ** 2) + (abs(xyz2[2]-xyz1[2]) ** 2)) ** 0.5
-     vector1 = [xyz2[0]-xyz1[0], xyz2[1]-xyz1[1], xyz2[2]- xyz1[2]]
-     unitVector1 = [vector1[0]/fiducialDistance1, vector1[1]/fiducialDistance1, vector1[2]/fiducialDistance1]
-
-     fiducialDistance2 = (((abs(xyz4[0]-xyz3[0])) ** 2) + (abs(xyz4[1]-xyz3[1]) ** 2) + (abs(xyz4[2]-xyz3[2]) ** 2)) ** 0.5
-     vector2 = [xyz4[0]-xyz3[0], xyz4[1]-xyz3[1], xyz4[2]- xyz3[2]]
-     unitVector2 = [vector2[0]/fiducialDistance2, vector2[1]/fiducialDistance2, vector2[2]/fiducialDistance2]
-
-     rigidRegistrationMatrix = rotationMatrixFromVectors(unitVector1, unitVector2)
-     slicer.app.processEvents()  # force update
-     
-     thisScene = probeNode.GetScene()
-     probeReference = thisScene.GetNodeByID(probeNodeID)
-
-     applyTransformToProbe(rigidRegistrationMatrix, probeReference, xyz3)
-    #convertSegmentsToSegment(probeNode, nodeIds)
+    nodeIds = []
+    with batchSceneModification():
+      for probeIndex, (probePose, probeName) in enumerate(zip(probePoses, probeNames)):
+        segmentationNode = None
+        if probeIndex < len(reuseNodeIDs):
+          segmentationNode = slicer.mrmlScene.GetNodeByID(reuseNodeIDs[probeIndex])
+        if segmentationNode is None:
+          segmentationNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode", probeName)
+          segmentationNode.CreateDefaultDisplayNodes() # only needed for display
+          segmentationNode.GetDisplayNode().SetOpacity(0.3)
+        else:
+          # the cached zone geometry and distances of the moved probe are stale
+          self.invalidateProbeDistances(segmentationNode.GetID())
+          self.removeProbeDragTransform(segmentationNode)
+          segmentationNode.GetSegmentation().SetMasterRepresentationName("Closed surface")
+          segmentationNode.GetSegmentation().RemoveAllSegments()
+        segmentationNode.AddSegmentFromClosedSurfaceRepresentation(transformPolyData(templatePolyData, probePose),"duplicate_node",[0,1,0])
+        segmentationNode.GetSegmentation().SetMasterRepresentationName("Binary labelmap")
+        nodeIds.append(segmentationNode.GetID())
+        self.probePoses[segmentationNode.GetID()] = probePose
+    return nodeIds
 
+  def getProfileKey(self, profile):
+    """Return what identifies a profile in plan keys: an EllipsoidProfile's repr, the content hash of a loaded profile
+    segmentation or else the points of its surface."""
+    if isinstance(profile, EllipsoidProfile):
+      return repr(profile)
+    profileKey = profile.GetAttribute("AblationPlanner.ProfileHash")
+    if profileKey is None:
+      profileKey = numpy_support.vtk_to_numpy(self.getProbeTemplatePolyData(profile).GetPoints().GetData())
+    return profileKey
+
+  def getPlanKey(self, profile, endPointPairs, tumorNode, resolution=0.1):
+    """Return the key of a plan in the plan evaluation cache: a hash of the profile (an EllipsoidProfile or a profile
+    segmentation), the (tip, entry) pairs quantized to resolution (mm) and the tumor surface in world coordinates
+    (so it changes with the tumor geometry and its transform).
+    """
+    return planKey(self.getProfileKey(profile), endPointPairs, self.getTumorKey(tumorNode), resolution)
 
-  def evaluateMargins(self, tumorNode, probeNode):
+  def getTumorKey(self, tumorNode):
+    """Return the digest of the tumor surface in world coordinates used in plan keys. Plan keys are computed after
+    every probe move, so the surface is only exported and hashed again when the segmentation or its linear
+    transform to world changed (every time for a non-linear transform).
     """
-    if tumorNode is Null:
-        print("please pick a tumor segmentation")
-        return
-    elif probeNode is Null:
-        print("please pick a probe segmentation")
-        return
+    transformNode = tumorNode.GetParentTransformNode()
+    key = None
+    if transformNode is None or transformNode.IsTransformToWorldLinear():
+      transformToWorld = vtk.vtkMatrix4x4()
+      if transformNode is not None:
+        transformNode.GetMatrixTransformToWorld(transformToWorld)
+      key = (tumorNode.GetID(), tumorNode.GetSegmentation().GetMTime(), slicer.util.arrayFromVTKMatrix(transformToWorld).tobytes())
+    if key is None or self.tumorKey is None or self.tumorKey[0] != key:
+      tumorPoints = numpy_support.vtk_to_numpy(getSegmentWorldPolyData(tumorNode).GetPoints().GetData())
+      self.tumorKey = (key, pointsDigest(tumorPoints))
+    return self.tumorKey[1]
+
+  def getZoneKey(self, profile, endPointPairs, resolution=0.1):
+    """Return the key of the combined ablation zone of a plan: like getPlanKey without the tumor, so it only changes
+    when the profile or the end points do."""
+    return planKey(self.getProfileKey(profile), endPointPairs, np.zeros((0, 3)), resolution)
+
+  def setCombinedZone(self, zoneNode, zoneKey):
+    """Reference the combined ablation zone segmentation ("combinedProbeNode") with the zone key (see getZoneKey) of
+    the end points it was built from."""
+    parameterNode = self.getParameterNode()
+    parameterNode.SetNodeReferenceID("combinedProbeNode", zoneNode.GetID() if zoneNode is not None else None)
+    parameterNode.SetParameter("CombinedZoneKey", zoneKey or "")
+
+  def getCombinedZone(self, zoneKey):
+    """Return the combined ablation zone segmentation if it was built for zoneKey, None if there is none or it was
+    built for other end points (e.g. a probe was dragged since)."""
+    parameterNode = self.getParameterNode()
+    if not zoneKey or parameterNode.GetParameter("CombinedZoneKey") != zoneKey:
+      return None
+    return parameterNode.GetNodeReference("combinedProbeNode")
+
+  def storePlanEvaluation(self, planKey, outputMarginModel, statistics, zoneNode=None, volumeCoverage=None, exact=True):
+    """Keep a copy of the margins of a plan (and of its combined ablation zone segmentation, if given) in the plan cache.
+    Margins of an incremental update are stored with exact=False: evaluateMargins evaluates such plans again."""
+    marginPolyData = vtk.vtkPolyData()
+    marginPolyData.DeepCopy(outputMarginModel.GetPolyData())
+    size = marginPolyData.GetActualMemorySize() * 1024
+    zoneLabelmap = None
+    if zoneNode is not None:
+      zoneLabelmap = packSegmentLabelmap(zoneNode)
+      size += sum(value.nbytes for value in zoneLabelmap.values() if isinstance(value, np.ndarray))
+    self.planCache.put(planKey, PlanEvaluation(marginPolyData, statistics, zoneLabelmap, volumeCoverage, exact), size)
+
+  @profiler.spanned()
+  def restorePlanEvaluation(self, planKey, outputMarginModel, statisticsThresholds=(0, 5, 10), zoneNode=None):
+    """Restore the margins of a previously evaluated plan into the margin model (and its combined ablation zone into
+    zoneNode, if it was stored). Returns the lowest signed distance, the MarginStatistics and whether the zone was
+    restored, or None if the plan is not in the cache.
     """
-    modelNode1 = convertSegmentToModel(probeNode, "probe model")
-    modelNode1.SetName("probe model")
-    modelNode2 = convertSegmentToModel(tumorNode, "tumor model")
-    modelNode2.SetName("tumor model")
-    outputNode = findModelToModelDistance(modelNode1,modelNode2)
-    VTKFieldData = outputNode.GetMesh().GetAttributesAsFieldData(0)
-
-    resultTableNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLTableNode", "surface_distances")
-    
-    for j in range(0,VTKFieldData.GetNumberOfArrays()):
-        resultTableNode.AddColumn(VTKFieldData.GetArray(j))
-
-    tumorDisplayNode = probeNode.GetDisplayNode()
-    #tumorDisplayNode.SetVisibility(False) # Hide all points
-    tumorDisplayNode.SetOpacity(0.2)
-    probeDisplayNode = tumorNode.GetDisplayNode()
-    #probeDisplayNode.SetVisibility(False)
-    probeDisplayNode.SetOpacity(0.2)
-    thisDisplayNode = modelNode2.GetDisplayNode()
-    #thisDisplayNode.SetVisibility(False)
-
-    distanceRange = VTKFieldData.GetArray("Signed").GetRange()
-    signedVals = []
-    for i in range(0,VTKFieldData.GetArray('Signed').GetSize()-1):
-        signedVals.append(VTKFieldData.GetArray('Signed').GetValue(i)) #value
-
-    print("Evaluated model to model distance, found range: ", distanceRange)
-    print("Mean: ", np.mean(signedVals))
-    print("Median: ", np.median(signedVals))
-    print("80th percentile: ", np.quantile(signedVals, 0.8))
-    print("20th percentile: ", np.quantile(signedVals, 0.2))
-
-    probeNode.SetDisplayVisibility(0)
-    tumorNode.SetDisplayVisibility(0)
-    tumorModelDisplayNode = modelNode2.GetModelDisplayNode()
-    tumorModelDisplayNode.SetVisibility(0)
-    probeModelDisplayNode = modelNode1.GetModelDisplayNode()
-    probeModelDisplayNode.SetSliceIntersectionVisibility(1)
-    probeModelDisplayNode.SetSliceDisplayModeToIntersection()
-    probeModelDisplayNode.SetColor(0.6,0.6,0.6)
-    probeModelDisplayNode.SetOpacity(0.4)
-    probeModelDisplayNode.SetAmbient(1)
-    outputModelDisplayNode = outputNode.GetModelDisplayNode()
-    outputModelDisplayNode.SetVisibility(1)
-    outputModelDisplayNode.SetSliceIntersectionVisibility(1)
-    outputModelDisplayNode.SetSliceDisplayModeToIntersection()
-    outputModelDisplayNode.SetSliceIntersectionThickness(2)
-    outputModelDisplayNode.SetScalarVisibility(1)
-    outputModelDisplayNode.SetActiveScalarName("Signed")
-    outputModelDisplayNode.SetAndObserveColorNodeID("vtkMRMLColorTableNode2")
-
-    return outputNode, resultTableNode, distanceRange[0], signedVals #, array
-
+    planEvaluation = self.planCache.get(planKey) if planKey is not None else None
+    if planEvaluation is None:
+      return None
+    marginPolyData = vtk.vtkPolyData()
+    marginPolyData.DeepCopy(planEvaluation.marginPolyData)
+    outputMarginModel.SetAndObservePolyData(marginPolyData)
+    statistics = planEvaluation.statistics
+    if list(statistics.marginThresholds) != list(statisticsThresholds):
+      statistics = self.computeMarginStatistics(outputMarginModel, statisticsThresholds)
+    zoneRestored = zoneNode is not None and planEvaluation.zoneLabelmap is not None
+    if zoneRestored:
+      unpackSegmentLabelmap(planEvaluation.zoneLabelmap, zoneNode)
+    return statistics.minimum, statistics, zoneRestored
+
+  @profiler.spanned()
+  def evaluateMargins(self, tumorNode, probeNode, distanceBackend="InProcess", probePoses=None, statisticsThresholds=(0, 5, 10),
+                      shellMargin=None, planKey=None):
+    """Evaluate the signed distances from the tumor surface to the ablation zone.
+    probeNode is the combined ablation zone segmentation, or an EllipsoidProfile together with the probePoses
+    of the placed probes, in which case the distances are evaluated in closed form.
+    With a shellMargin (mm), the volume coverage of the tumor and of its margin shell is evaluated as well
+    (see evaluateVolumeCoverage), added to the result table and kept in volumeCoverage.
+    With a planKey (see getPlanKey), the evaluation is stored in the plan cache, and a plan found there is restored
+    instead of evaluated again.
+    Returns the output model, the result table, the lowest signed distance and the area-weighted MarginStatistics
+    (including the fraction of the tumor surface with less margin than each of statisticsThresholds, in mm).
+    """
+    return PipelineTask(self.evaluateMarginsSteps(tumorNode, probeNode, distanceBackend, probePoses, statisticsThresholds,
+      shellMargin, planKey)).run()
+
+  def evaluateMarginsAsync(self, tumorNode, probeNode, distanceBackend="InProcess", probePoses=None, statisticsThresholds=(0, 5, 10),
+                           progressCallback=None, finishedCallback=None, shellMargin=None, planKey=None):
+    """Start evaluateMargins without blocking the application and return its PipelineTask.
+    The distances are computed in a worker thread (or by the CLI running asynchronously), scene updates happen
+    between event loop iterations. A margin evaluation that is still running is cancelled first, so the most
+    recent probe configuration wins. progressCallback(fraction, message) reports the stages,
+    finishedCallback(task) is called when the task completed, failed or was cancelled.
+    """
+    self.cancelMarginEvaluation()
+    self.marginEvaluationTask = PipelineTask(
+      self.evaluateMarginsSteps(tumorNode, probeNode, distanceBackend, probePoses, statisticsThresholds, shellMargin, planKey),
+      progressCallback, finishedCallback)
+    self.marginEvaluationTask.start()
+    return self.marginEvaluationTask
+
+  def cancelMarginEvaluation(self):
+    if self.marginEvaluationTask is not None and not self.marginEvaluationTask.finished:
+      self.marginEvaluationTask.cancel()
+
+  def evaluateMarginsSteps(self, tumorNode, probeNode, distanceBackend, probePoses, statisticsThresholds, shellMargin=None, planKey=None):
+    """Steps of the margin evaluation, run by a PipelineTask.
+    The probe, tumor and margin models are output nodes of the module, updated in place by every evaluation.
+    """
+    sceneMemoryBefore = sceneMemoryUsage()
+    cliOutputNode = None
+    zoneIsSegmentation = not isinstance(probeNode, EllipsoidProfile)
+    planEvaluation = self.planCache.get(planKey) if planKey is not None else None
+    if planEvaluation is not None and not planEvaluation.exact:
+      # margins of an incremental update, conservative where the zones overlap
+      planEvaluation = None
+    modelNode1 = None
+    modelNode2 = None
+    try:
+      if planEvaluation is None:
+        yield ("progress", 0.0, "Exporting surfaces")
+        if zoneIsSegmentation:
+          modelNode1 = updateModelFromSegment(probeNode, self.getOutputNode("ProbeModel", "vtkMRMLModelNode", "probe model"))
+        modelNode2 = updateModelFromSegment(tumorNode, self.getOutputNode("TumorModel", "vtkMRMLModelNode", "tumor model"))
+
+      yield ("progress", 0.2, "Computing distances")
+      if planEvaluation is not None:
+        # this plan was evaluated before: its margins are restored instead of computed again, no surface is exported
+        tumorPolyData = vtk.vtkPolyData()
+        tumorPolyData.DeepCopy(planEvaluation.marginPolyData)
+      elif distanceBackend == "ModelToModelDistance" and zoneIsSegmentation:
+        if not hasattr(slicer.modules, "modeltomodeldistance"):
+          raise RuntimeError("The ModelToModelDistance module is not installed, select the in-process distance engine instead")
+        cliOutputNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLModelNode", "m2md")
+        yield ("cli", slicer.modules.modeltomodeldistance, {"vtkFile1": modelNode2, "vtkFile2": modelNode1,
+          "distanceType": "signed_closest_point", "vtkOutput": cliOutputNode})
+        tumorPolyData = cliOutputNode.GetPolyData()
+      else:
+        if zoneIsSegmentation and distanceBackend != "InProcess":
+          raise ValueError("Unknown distance backend: "+str(distanceBackend))
+        # the worker thread only gets copies of the surfaces, it never touches the scene
+        tumorPolyData = vtk.vtkPolyData()
+        tumorPolyData.DeepCopy(getWorldPolyData(modelNode2))
+        tumorPoints = numpy_support.vtk_to_numpy(tumorPolyData.GetPoints().GetData())
+        if not zoneIsSegmentation:
+          signedDistances = yield ("thread", evaluateInChunks, (lambda points: probeNode.signedDistances(points, probePoses), tumorPoints))
+        else:
+          zonePolyData = vtk.vtkPolyData()
+          zonePolyData.DeepCopy(getWorldPolyData(modelNode1))
+          signedDistances = yield ("thread", computeSignedDistancesToSurface, (zonePolyData, tumorPoints))
+        addSignedDistanceArrays(tumorPolyData, signedDistances)
+      volumeCoverage = None
+      if (shellMargin is not None and planEvaluation is not None and planEvaluation.volumeCoverage is not None
+          and planEvaluation.volumeCoverage.marginDistance == shellMargin):
+        volumeCoverage = planEvaluation.volumeCoverage
+      elif shellMargin is not None:
+        yield ("progress", 0.7, "Computing volume coverage")
+        volumeCoverage = yield from self.evaluateVolumeCoverageSteps(tumorNode, probeNode, probePoses, shellMargin)
+      yield ("progress", 0.9, "Computing statistics")
+    finally:
+      # the CLI result is moved into the margin model, its temporary node is never left in the scene
+      if cliOutputNode is not None:
+        slicer.mrmlScene.RemoveNode(cliOutputNode)
+
+    # the results are published in one batch, observers and views are updated once
+    with batchSceneModification():
+      outputNode = self.getOutputNode("MarginModel", "vtkMRMLModelNode", "m2md")
+      self.archiveMarginModel(outputNode, int(self.getParameterNode().GetParameter("HistoryLength") or 0))
+      outputNode.SetAndObservePolyData(tumorPolyData)
+      if outputNode.GetDisplayNode() is None:
+        outputNode.CreateDefaultDisplayNodes()
+
+      if zoneIsSegmentation:
+        tumorDisplayNode = probeNode.GetDisplayNode()
+        #tumorDisplayNode.SetVisibility(False) # Hide all points
+        tumorDisplayNode.SetOpacity(0.2)
+      probeDisplayNode = tumorNode.GetDisplayNode()
+      #probeDisplayNode.SetVisibility(False)
+      probeDisplayNode.SetOpacity(0.2)
+
+      statistics = self.computeMarginStatistics(outputNode, statisticsThresholds)
+      self.printMarginStatistics(statistics)
+      self.volumeCoverage = volumeCoverage
+      if volumeCoverage is not None:
+        self.printVolumeCoverage(volumeCoverage)
+      resultTableNode = self.updateMarginSummaryTable(statistics, volumeCoverage=volumeCoverage)
+      if planKey is not None and (planEvaluation is None or volumeCoverage is not planEvaluation.volumeCoverage):
+        self.storePlanEvaluation(planKey, outputNode, statistics, probeNode if zoneIsSegmentation else None, volumeCoverage)
+
+      tumorNode.SetDisplayVisibility(0)
+      if modelNode2 is not None:
+        tumorModelDisplayNode = modelNode2.GetModelDisplayNode()
+        tumorModelDisplayNode.SetVisibility(0)
+      if modelNode1 is not None:
+        probeNode.SetDisplayVisibility(0)
+        probeModelDisplayNode = modelNode1.GetModelDisplayNode()
+        probeModelDisplayNode.SetVisibility(1)
+        probeModelDisplayNode.SetSliceIntersectionVisibility(1)
+        probeModelDisplayNode.SetSliceDisplayModeToIntersection()
+        probeModelDisplayNode.SetColor(0.6,0.6,0.6)
+        probeModelDisplayNode.SetOpacity(0.4)
+        probeModelDisplayNode.SetAmbient(1)
+      elif zoneIsSegmentation:
+        # a restored plan: the zone segmentation is shown instead of exporting its model again
+        probeModel = self.getParameterNode().GetNodeReference("ProbeModel")
+        if probeModel is not None and probeModel.GetDisplayNode() is not None:
+          probeModel.GetDisplayNode().SetVisibility(0)
+        probeNode.SetDisplayVisibility(1)
+      outputModelDisplayNode = outputNode.GetModelDisplayNode()
+      outputModelDisplayNode.SetVisibility(1)
+      outputModelDisplayNode.SetSliceIntersectionVisibility(1)
+      outputModelDisplayNode.SetSliceDisplayModeToIntersection()
+      outputModelDisplayNode.SetSliceIntersectionThickness(2)
+      outputModelDisplayNode.SetScalarVisibility(1)
+      outputModelDisplayNode.SetActiveScalarName("Signed")
+      outputModelDisplayNode.SetAndObserveColorNodeID("vtkMRMLColorTableNode2")
+
+    self.printSceneMemoryUsage(sceneMemoryBefore, sceneMemoryUsage())
+    return outputNode, resultTableNode, statistics.minimum, statistics
+
+
+  @profiler.spanned()
+  def evaluateVolumeCoverage(self, tumorNode, probeNode, probePoses=None, marginDistance=5.0, spacing=0.5):
+    """Return the VolumeCoverage of the tumor and of the marginDistance (mm) shell around it by the ablation zone.
+    The binary labelmaps of the tumor and of the combined ablation zone segmentation (or the closed form zone of an
+    EllipsoidProfile at probePoses) are sampled on a grid with the given spacing (mm) that only covers the tumor and
+    its shell; the shell is found with a Euclidean distance transform of the tumor.
+    """
+    return PipelineTask(self.evaluateVolumeCoverageSteps(tumorNode, probeNode, probePoses, marginDistance, spacing)).run()
+
+  def evaluateVolumeCoverageSteps(self, tumorNode, probeNode, probePoses, marginDistance, spacing=0.5):
+    """Steps of the volume coverage evaluation (see evaluateVolumeCoverage), run by a PipelineTask."""
+    # the grid covers the bounding box of the tumor and its shell only
+    referenceGeometry, origin, dimensions = gridGeometry(getSegmentWorldPolyData(tumorNode).GetBounds(), spacing,
+      marginDistance + 2 * spacing)
+
+    tumorMask = segmentLabelmapMask(tumorNode, referenceGeometry)
+    if isinstance(probeNode, EllipsoidProfile):
+      zoneDistances = yield ("thread", evaluateInChunks, (lambda points: probeNode.signedDistances(points, probePoses),
+        gridPoints(origin, spacing, dimensions)))
+      zoneMask = (zoneDistances <= 0).reshape(tumorMask.shape)
+    else:
+      zoneMask = segmentLabelmapMask(probeNode, referenceGeometry)
+    volumeCoverage = yield ("thread", computeVolumeCoverageOnGrid, (tumorMask, zoneMask, spacing, marginDistance))
+    return volumeCoverage
+
+  @profiler.spanned()
+  def evaluateStructureProximity(self, zone, structures, probePoses=None, spacing=0.5):
+    """Check how close the ablation zone comes to organs at risk. structures is a list of (segmentation node,
+    segment ID) pairs, from any number of segmentation nodes. zone is the combined ablation zone segmentation, or an
+    EllipsoidProfile with the probePoses of the probes.
+    The zone's distance index is built once and the vertices of all structure surfaces are queried against it in a
+    single pass; the intrusion volume of each structure is counted on labelmaps resampled to a grid with the given
+    spacing (mm) that covers the zone. Every structure surface is copied to a "proximity" model (updated in place
+    by later evaluations) colored by its signed distance to the zone, and the results are written to the
+    "organ_proximity" table.
+    Returns the StructureProximity of each structure, the models and the table node.
+    """
+    names = []
+    polyDatas = []
+    for segmentationNode, segmentID in structures:
+      names.append(segmentationNode.GetSegmentation().GetSegment(segmentID).GetName())
+      polyDatas.append(getSegmentWorldPolyData(segmentationNode, segmentID))
+    vertexCounts = [polyData.GetNumberOfPoints() for polyData in polyDatas]
+    structurePoints = np.concatenate([numpy_support.vtk_to_numpy(polyData.GetPoints().GetData()) for polyData in polyDatas
+      if polyData.GetNumberOfPoints() > 0] or [np.zeros((0, 3))])
+
+    startTime = time.perf_counter()
+    if isinstance(zone, EllipsoidProfile):
+      signedDistances = evaluateInChunks(lambda points: zone.signedDistances(points, probePoses), structurePoints)
+      zoneBounds = zone.worldBounds(probePoses)
+    else:
+      zonePolyData = getSegmentWorldPolyData(zone)
+      signedDistances = computeSignedDistancesToSurface(zonePolyData, structurePoints)
+      zoneBounds = zonePolyData.GetBounds()
+
+    # only the part of a structure inside the zone counts, so the grid only covers the zone
+    referenceGeometry, origin, dimensions = gridGeometry(zoneBounds, spacing, spacing)
+    if isinstance(zone, EllipsoidProfile):
+      zoneMask = (zone.signedDistances(gridPoints(origin, spacing, dimensions), probePoses) <= 0).reshape(dimensions[::-1])
+    else:
+      zoneMask = segmentLabelmapMask(zone, referenceGeometry)
+    intrusionVoxelCounts = []
+    for (segmentationNode, segmentID), polyData, structureDistances in zip(structures, polyDatas,
+        splitStructureValues(signedDistances, vertexCounts)):
+      # a structure whose surface is outside the zone can only overlap it if it encloses the whole zone
+      if len(structureDistances) == 0 or (structureDistances.min() > 0 and not boundsContain(polyData.GetBounds(), zoneBounds)):
+        intrusionVoxelCounts.append(0)
+        continue
+      intrusionVoxelCounts.append(np.count_nonzero(zoneMask & segmentLabelmapMask(segmentationNode, referenceGeometry, segmentID)))
+    proximities = structureProximities(names, vertexCounts, signedDistances, intrusionVoxelCounts, spacing ** 3)
+    logging.info("Evaluated the proximity of {0} structures ({1} vertices) in {2:.3f} s".format(
+      len(structures), len(structurePoints), time.perf_counter() - startTime))
+
+    with batchSceneModification():
+      models = self.updateProximityModels(structures, polyDatas, splitStructureValues(signedDistances, vertexCounts))
+      tableNode = self.updateStructureProximityTable(proximities)
+    self.structureProximities = proximities
+    self.printStructureProximities(proximities)
+    return proximities, models, tableNode
+
+  def updateProximityModels(self, structures, polyDatas, signedDistances):
+    """Show each structure surface as a model colored by its signed distance to the ablation zone. The models are
+    output nodes of the module ("ProximityModel" references of the parameter node), reused by later evaluations."""
+    parameterNode = self.getParameterNode()
+    models = []
+    for structureIndex, ((segmentationNode, segmentID), polyData, distances) in enumerate(zip(structures, polyDatas, signedDistances)):
+      segment = segmentationNode.GetSegmentation().GetSegment(segmentID)
+      modelNode = parameterNode.GetNthNodeReference("ProximityModel", structureIndex)
+      if modelNode is None:
+        modelNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLModelNode")
+        modelNode.CreateDefaultDisplayNodes()
+        parameterNode.SetNthNodeReferenceID("ProximityModel", structureIndex, modelNode.GetID())
+      modelNode.SetName(segment.GetName() + " proximity")
+      addSignedDistanceArrays(polyData, distances)
+      modelNode.SetAndObservePolyData(polyData)
+      displayNode = modelNode.GetDisplayNode()
+      displayNode.SetVisibility(True)
+      displayNode.SetActiveScalarName("Signed")
+      displayNode.SetAndObserveColorNodeID("vtkMRMLColorTableNode2")
+      displayNode.SetScalarVisibility(True)
+      displayNode.SetSliceIntersectionVisibility(True)
+      segmentationNode.GetDisplayNode().SetSegmentVisibility(segmentID, False)
+      models.append(modelNode)
+    while parameterNode.GetNumberOfNodeReferences("ProximityModel") > len(structures):
+      modelNode = parameterNode.GetNthNodeReference("ProximityModel", len(structures))
+      parameterNode.RemoveNthNodeReferenceID("ProximityModel", len(structures))
+      if modelNode is not None:
+        slicer.mrmlScene.RemoveNode(modelNode)
+    return models
+
+  def updateStructureProximityTable(self, proximities):
+    """Write one row per structure (minimum distance, intrusion volume, vertices) into the "organ_proximity" table."""
+    tableNode = self.getOutputNode("StructureProximityTable", "vtkMRMLTableNode", "organ_proximity")
+    names = vtk.vtkStringArray()
+    names.SetName("Structure")
+    table = vtk.vtkTable()
+    table.AddColumn(names)
+    columns = []
+    for columnName in ("Minimum distance (mm)", "Intrusion volume (mm3)", "Vertices"):
+      column = vtk.vtkDoubleArray()
+      column.SetName(columnName)
+      table.AddColumn(column)
+      columns.append(column)
+    for proximity in proximities:
+      names.InsertNextValue(proximity.name)
+      for column, value in zip(columns, (proximity.minimumDistance, proximity.intrusionVolume, proximity.numberOfVertices)):
+        column.InsertNextValue(value)
+    tableNode.SetAndObserveTable(table)
+    return tableNode
+
+  def printStructureProximities(self, proximities):
+    for proximity in proximities:
+      print("{0}: closest distance to the ablation zone {1:.2f} mm, {2:.1f} mm3 inside the zone{3}".format(proximity.name,
+        proximity.minimumDistance, proximity.intrusionVolume, " (INTRUSION)" if proximity.intruded else ""))
+
+  @profiler.spanned()
+  def getZoneDistanceField(self, zoneNode, spacing=1.0, padding=15.0):
+    """Return the SignedDistanceField of a combined ablation zone segmentation, on a grid with the given spacing (mm)
+    that extends padding (mm) beyond the zone. It is built once and reused until the zone changes.
+    """
+    key = (zoneNode.GetID(), zoneNode.GetSegmentation().GetMTime(), spacing, padding)
+    if self.zoneDistanceField is None or self.zoneDistanceField[0] != key:
+      startTime = time.perf_counter()
+      distanceField = buildSignedDistanceField(getSegmentWorldPolyData(zoneNode), spacing, padding)
+      logging.info("Built the distance field of the ablation zone ({0} grid points) in {1:.3f} s".format(
+        distanceField.values.size, time.perf_counter() - startTime))
+      self.zoneDistanceField = (key, distanceField)
+    return self.zoneDistanceField[1]
+
+  @profiler.spanned()
+  def updateMarginsForTumor(self, outputMarginModel, tumorNode, zone, probePoses=None, statisticsThresholds=(0, 5, 10),
+                            probeNodeIDs=None):
+    """Update a margin model in place after the tumor moved (re-registration, transform edits or hardening) while
+    the probes stayed put. The tumor surface in its current world position is queried against the cached distance
+    field of the combined ablation zone segmentation (getZoneDistanceField) or, for an EllipsoidProfile, against
+    the closed form zone of the probes at probePoses. No model or CLI run is needed.
+    A zone of None stands for a combined zone that no longer matches the probes (e.g. a probe was dragged since it
+    was built): the tumor surface is then queried against the placed probes probeNodeIDs (updateMarginsFromProbes).
+    Returns the lowest signed distance and the MarginStatistics.
+    """
+    tumorPolyData = getSegmentWorldPolyData(tumorNode)
+    if zone is None:
+      outputMarginModel.SetAndObservePolyData(tumorPolyData)
+      return self.updateMarginsFromProbes(outputMarginModel, probeNodeIDs, statisticsThresholds)
+    tumorPoints = numpy_support.vtk_to_numpy(tumorPolyData.GetPoints().GetData())
+    if isinstance(zone, EllipsoidProfile):
+      signedDistances = zone.signedDistances(tumorPoints, probePoses)
+    else:
+      signedDistances = self.getZoneDistanceField(zone).sample(tumorPoints)
+    addSignedDistanceArrays(tumorPolyData, signedDistances)
+    outputMarginModel.SetAndObservePolyData(tumorPolyData)
+    statistics = self.computeMarginStatistics(outputMarginModel, statisticsThresholds)
+    return statistics.minimum, statistics
+
+  def invalidateProbeDistances(self, probeNodeID):
+    """Forget the cached ablation zone geometry and distances of a probe (e.g. because it was moved)."""
+    self.probeDistanceFunctions.pop(probeNodeID, None)
+    self.probeDistances.pop(probeNodeID, None)
+    self.probePoses.pop(probeNodeID, None)
+
+  @profiler.spanned()
+  def getProbeDistances(self, probeNodeID, tumorPoints):
+    """Return the signed distances of the tumor vertices to the ablation zone of a single placed probe.
+    The zone's distance function and the result are cached, so only new probes or a new tumor surface are queried.
+    """
+    tumorKey = (tumorPoints.GetMTime(), tumorPoints.GetNumberOfPoints())
+    cachedKey, cachedDistances = self.probeDistances.get(probeNodeID, (None, None))
+    if cachedKey == tumorKey:
+      return cachedDistances
+
+    distanceFunction = self.probeDistanceFunctions.get(probeNodeID)
+    if distanceFunction is None:
+      distanceFunction = buildSurfaceDistanceIndex(getSegmentWorldPolyData(slicer.mrmlScene.GetNodeByID(probeNodeID)))
+      self.probeDistanceFunctions[probeNodeID] = distanceFunction
+
+    distances = evaluateSignedDistances(distanceFunction, numpy_support.vtk_to_numpy(tumorPoints.GetData()))
+    self.probeDistances[probeNodeID] = (tumorKey, distances)
+    return distances
+
+  @profiler.spanned()
+  def computeMarginStatistics(self, outputMarginModel, statisticsThresholds=(0, 5, 10)):
+    """Area-weighted statistics of the "Signed" array of a margin model (read without copying)."""
+    signedDistances = numpy_support.vtk_to_numpy(outputMarginModel.GetPolyData().GetPointData().GetArray("Signed"))
+    return computeMarginStatistics(signedDistances, computeVertexAreas(outputMarginModel.GetPolyData()), statisticsThresholds)
+
+  def updateMarginSummaryTable(self, statistics, tableNode=None, volumeCoverage=None):
+    """Write the margin statistics (and the VolumeCoverage, if given) into a two column (statistic, value) table,
+    reused between evaluations. The per-vertex distances are only put into a table on request (createSurfaceDistancesTable).
+    """
+    if tableNode is None:
+      tableNode = self.getOutputNode("MarginSummaryTable", "vtkMRMLTableNode", "margin_summary")
+    rows = [("Minimum signed distance (mm)", statistics.minimum), ("Maximum signed distance (mm)", statistics.maximum),
+      ("Mean (mm)", statistics.mean), ("Median (mm)", statistics.median),
+      ("20th percentile (mm)", statistics.percentile20), ("80th percentile (mm)", statistics.percentile80),
+      ("Tumor surface area (mm2)", statistics.surfaceArea), ("Number of vertices", statistics.numberOfVertices)]
+    rows += [("Surface with margin below {0:g} mm (%)".format(threshold), 100.0 * fraction)
+      for threshold, fraction in zip(statistics.marginThresholds, statistics.fractionBelow)]
+    if volumeCoverage is not None:
+      rows += [("Tumor volume (mm3)", volumeCoverage.tumorVolume), ("Tumor volume covered (%)", 100.0 * volumeCoverage.coverageFraction),
+        ("Uncovered tumor volume (mm3)", volumeCoverage.uncoveredVolume),
+        ("{0:g} mm margin shell covered (%)".format(volumeCoverage.marginDistance), 100.0 * volumeCoverage.shellCoverageFraction),
+        ("Uncovered {0:g} mm margin shell volume (mm3)".format(volumeCoverage.marginDistance), volumeCoverage.shellUncoveredVolume)]
+    names = vtk.vtkStringArray()
+    names.SetName("Statistic")
+    values = vtk.vtkDoubleArray()
+    values.SetName("Value")
+    for name, value in rows:
+      names.InsertNextValue(name)
+      values.InsertNextValue(float("nan") if value is None else value)
+    table = vtk.vtkTable()
+    table.AddColumn(names)
+    table.AddColumn(values)
+    tableNode.SetAndObserveTable(table)
+    return tableNode
+
+  def createSurfaceDistancesTable(self, outputMarginModel):
+    """Return the "surface_distances" table with the point ID, coordinates and signed/absolute distances of every
+    tumor vertex of a margin model. It is built on request only, the table can be large on dense meshes.
+    """
+    arrays = surfaceDistanceArrays(slicer.util.arrayFromModelPoints(outputMarginModel),
+      slicer.util.arrayFromModelPointData(outputMarginModel, "Signed"))
+    table = vtk.vtkTable()
+    for columnName, values in [("PointID", arrays["pointIds"]), ("X", arrays["points"][:,0]), ("Y", arrays["points"][:,1]),
+        ("Z", arrays["points"][:,2]), ("Signed", arrays["signed"]), ("Absolute", arrays["absolute"])]:
+      column = numpy_support.numpy_to_vtk(np.ascontiguousarray(values), deep=True)
+      column.SetName(columnName)
+      table.AddColumn(column)
+    tableNode = self.getOutputNode("SurfaceDistancesTable", "vtkMRMLTableNode", "surface_distances")
+    tableNode.SetAndObserveTable(table)
+    return tableNode
+
+  def exportSurfaceDistances(self, outputMarginModel, path, fileFormat="npz"):
+    """Write the per-vertex distances of a margin model to a compressed .npz file or, with fileFormat "raw",
+    to a directory of memory-mappable raw arrays (see AblationPlannerLib.SurfaceDistanceFiles.loadSurfaceDistances).
+    """
+    return writeSurfaceDistances(path, slicer.util.arrayFromModelPoints(outputMarginModel),
+      slicer.util.arrayFromModelPointData(outputMarginModel, "Signed"), fileFormat)
+
+  def printVolumeCoverage(self, volumeCoverage):
+    print("Tumor volume covered: {0:.1%} ({1:.1f} mm3 uncovered)".format(volumeCoverage.coverageFraction, volumeCoverage.uncoveredVolume))
+    print("{0:g} mm margin shell covered: {1:.1%} ({2:.1f} mm3 uncovered)".format(volumeCoverage.marginDistance,
+      volumeCoverage.shellCoverageFraction, volumeCoverage.shellUncoveredVolume))
+
+  def printSceneMemoryUsage(self, before, after):
+    """Report the scene size and the memory of the application before and after a planning run."""
+    print("Scene nodes: {0} before, {1} after".format(before["nodeCount"], after["nodeCount"]))
+    print("Model and segmentation data (MB): {0:.1f} before, {1:.1f} after".format(before["dataMemory"], after["dataMemory"]))
+    if before["processMemory"] is not None and after["processMemory"] is not None:
+      print("Process memory (MB): {0:.1f} before, {1:.1f} after".format(before["processMemory"], after["processMemory"]))
+
+  def printMarginStatistics(self, statistics):
+    print("Evaluated model to model distance, found range: ", (statistics.minimum, statistics.maximum))
+    print("Mean: ", statistics.mean)
+    print("Median: ", statistics.median)
+    print("80th percentile: ", statistics.percentile80)
+    print("20th percentile: ", statistics.percentile20)
+    for threshold, fraction in zip(statistics.marginThresholds, statistics.fractionBelow):
+      print("Tumor surface with less than {0:g} mm margin: {1:.1%}".format(threshold, fraction))
+
+  @profiler.spanned()
+  def updateMarginsFromProbes(self, outputMarginModel, probeNodeIDs, statisticsThresholds=(0, 5, 10)):
+    """Update the "Signed" and "Absolute" arrays of outputMarginModel in place from the per-probe distances.
+    The margin of the union of the ablation zones is the per-vertex minimum of the per-probe signed distances
+    (exact outside of the zones, conservative where zones overlap). Only probes that are not cached yet
+    (new or moved probes) are queried against the tumor surface.
+    Returns the lowest signed distance and the MarginStatistics of the combined signed distances.
+    """
+    tumorPoints = outputMarginModel.GetPolyData().GetPoints()
+    for probeNodeID in list(self.probeDistances):
+      if probeNodeID not in probeNodeIDs:
+        self.invalidateProbeDistances(probeNodeID)
+
+    signedDistances = self.getProbeDistances(probeNodeIDs[0], tumorPoints)
+    for probeNodeID in probeNodeIDs[1:]:
+      signedDistances = np.minimum(signedDistances, self.getProbeDistances(probeNodeID, tumorPoints))
+
+    setModelPointDataArray(outputMarginModel, "Signed", signedDistances)
+    setModelPointDataArray(outputMarginModel, "Absolute", np.abs(signedDistances))
+    statistics = self.computeMarginStatistics(outputMarginModel, statisticsThresholds)
+    return statistics.minimum, statistics
+
+  @profiler.spanned()
+  def updateParametricMargins(self, outputMarginModel, profile, probePoses, statisticsThresholds=(0, 5, 10)):
+    """Update the "Signed" and "Absolute" arrays of outputMarginModel in place with the closed form distances
+    to the ellipsoids of the probes. Returns the lowest signed distance and the MarginStatistics.
+    """
+    tumorPoints = slicer.util.arrayFromModelPoints(outputMarginModel)
+    signedDistances = profile.signedDistances(tumorPoints, probePoses)
+    setModelPointDataArray(outputMarginModel, "Signed", signedDistances)
+    setModelPointDataArray(outputMarginModel, "Absolute", np.abs(signedDistances))
+    statistics = self.computeMarginStatistics(outputMarginModel, statisticsThresholds)
+    return statistics.minimum, statistics
 
   def updateNodeColor(self, node):
     thisDisplayNode = node.GetDisplayNode()
     thisDisplayNode.SetVisibility(False) # Hide all points
     thisDisplayNode.SetVisibility(True)
 
-  def changeColorsByMargin(self, modelNode, *args):
-    VTKFieldData = modelNode.GetMesh().GetAttributesAsFieldData(0)
-    VTKFieldDataArray = VTKFieldData.GetArray("Signed")
-
-    args = list(args)
-    args.sort(reverse = True)
-
-    for i in range(0,VTKFieldDataArray.GetSize()-1):
-        colorval = VTKFieldDataArray.GetValue(i)
-
-        thresholded = False
-        for j in range(0,len(args)):
-            if (colorval > args[j]):
-                thresholded = True
-                VTKFieldDataArray.SetValue(i,args[j])
-                break
-        if (not thresholded):
-            VTKFieldDataArray.SetValue(i,args[-1]-5)
+  def classifyMargins(self, signedDistances, thresholds):
+    """Return the margin class of each distance: the number of thresholds that are <= the distance.
+    Class 0 therefore holds the vertices below the lowest threshold (the best margins).
+    """
+    thresholds = np.sort(np.asarray(thresholds, dtype=float))
+    return np.digitize(signedDistances, thresholds).astype(np.int16)
 
+  @profiler.spanned()
   def changeColorsByMargin_(self, modelNode, *args):
-    VTKFieldData = modelNode.GetMesh().GetAttributesAsFieldData(0)
-    VTKFieldDataArray = VTKFieldData.GetArray("Signed")
-
-    args = list(args)
-    args.sort(reverse = False)
+    signedDistances = slicer.util.arrayFromModelPointData(modelNode, "Signed")
     num_regions = len(args)
-    
-    for i in range(0,VTKFieldDataArray.GetSize()-1):
-        colorval = VTKFieldDataArray.GetValue(i)
-
-        thresholded = False
-        for j in range(0,len(args)):
-            if (colorval < args[j]):
-                thresholded = True
-                VTKFieldDataArray.SetValue(i,j)
-                break
-        if (not thresholded):
-            VTKFieldDataArray.SetValue(i,num_regions)
-    
-    modelDisplayNode = modelNode.GetModelDisplayNode()
 
+    marginClasses = self.classifyMargins(signedDistances, args)
+    setModelPointDataArray(modelNode, "MarginClass", marginClasses)
+
+    modelDisplayNode = modelNode.GetModelDisplayNode()
+    modelDisplayNode.SetActiveScalarName("MarginClass")
     modelDisplayNode.AutoScalarRangeOff()
     modelDisplayNode.SetScalarRange(0,num_regions)
 
-  def regenerateOriginalModelColors(self, modelNode, originalColorArray):
-
-    VTKFieldData = modelNode.GetMesh().GetAttributesAsFieldData(0)
-    VTKFieldDataArray = VTKFieldData.GetArray("Signed")
-
-    for i in range(0, len(originalColorArray)-1):
-        loopArray = originalColorArray[i]
-        colorval = loopArray[0]
-        VTKFieldDataArray.SetValue(i,colorval)
-
+  @profiler.spanned()
+  def regenerateOriginalModelColors(self, modelNode):
+    # The classification is stored in its own array, so the raw distances only need to be re-activated
     modelDisplayNode = modelNode.GetModelDisplayNode()
+    modelDisplayNode.SetActiveScalarName("Signed")
     modelDisplayNode.AutoScalarRangeOn()
-    print("current color table id: "+str(modelDisplayNode.GetColorNodeID()))
-        
-  def convertSegmentsToSegment(self, probeNode, nodeIds):
+
+  @profiler.spanned()
+  def convertSegmentsToSegment(self, probeNode, nodeIds, spacing=0.5):
+    """Combine the ablation zones of the placed probes into a single segment.
+    All zones are rasterized onto one shared image grid (isotropic spacing in mm) and OR-ed with NumPy,
+    then the union replaces the segment of the "translated probe" segmentation node, which is reused by every call.
+    """
+    startTime = time.perf_counter()
     thisScene = probeNode.GetScene()
-    
-    #probeNode.GetSegmentation().CreateRepresentation("Binary labelmap") #added 2/22
-    #probeNode.GetSegmentation().SetMasterRepresentationName("Binary labelmap") #added 2/22
 
     probeName = "ablation zone"
     if len(nodeIds)>1:
         print("Found multiple probe nodes, combining them into a single segment!: ", nodeIds)
         probeName = "combined ablation zone"
 
-    segmentationNode = slicer.vtkMRMLSegmentationNode()
-    slicer.mrmlScene.AddNode(segmentationNode)
-    segmentationNode.CreateDefaultDisplayNodes() # only needed for display
-
-    slicer.app.processEvents() 
-
-    for probeNodeID in nodeIds:
-        duplicateProbeNode = thisScene.GetNodeByID(probeNodeID)
-        #duplicateProbeNode.GetSegmentation().SetMasterRepresentationName("Binary labelmap") #ADDED 2/22
-        segmentType = duplicateProbeNode.GetSegmentation().GetMasterRepresentationName()
-        slicer.app.processEvents() 
-        if (segmentType == "Closed surface"):
-            mergedImage = vtk.vtkPolyData()
-            duplicateProbeNode.GetClosedSurfaceRepresentation(duplicateProbeNode.GetSegmentation().GetNthSegmentID(0), mergedImage)
-            newSegmentID = segmentationNode.AddSegmentFromClosedSurfaceRepresentation(mergedImage,probeNodeID,[0,1,0])
-            newSegment = segmentationNode.GetSegmentation().GetSegment(newSegmentID)
-            newSegment.SetName(probeName)
-        else:
-            labelmapImage = vtkSegmentationCore.vtkOrientedImageData()
-            duplicateProbeNode.GetBinaryLabelmapRepresentation(duplicateProbeNode.GetSegmentation().GetNthSegmentID(0),labelmapImage)
-            newSegmentID = segmentationNode.AddSegmentFromBinaryLabelmapRepresentation(labelmapImage,probeNodeID,[1,0,0])
-            newSegment = segmentationNode.GetSegmentation().GetSegment(newSegmentID)
-            newSegment.SetName(probeName)
-            duplicateProbeNode.GetSegmentation().CreateRepresentation("Closed Surface")
-            #segmentationNode.GetSegmentation().CreateRepresentation("Closed surface")
-            #segmentationNode.GetSegmentation().SetMasterRepresentationName("Closed surface")
-        #slicer.mrmlScene.RemoveNode(duplicateProbeNode)
-        duplicateProbeNode.SetDisplayVisibility(0)
-
-    segmentEditorWidget = slicer.qMRMLSegmentEditorWidget()
-    segmentEditorWidget.setMRMLScene(slicer.mrmlScene)
-    segmentEditorNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentEditorNode")
-    segmentEditorWidget.setMRMLSegmentEditorNode(segmentEditorNode)
-    segmentEditorWidget.setSegmentationNode(segmentationNode)
-
-
-    for i in range(1, segmentationNode.GetSegmentation().GetNumberOfSegments()+1):  #TWO ADDITIONAL PROBES
-        segmentEditorWidget.setActiveEffectByName("Logical operators")
-        effect = segmentEditorWidget.activeEffect()
-        effect.self().scriptedEffect.setParameter("Operation","UNION")
-        effect.self().scriptedEffect.setParameter("ModifierSegmentID",segmentationNode.GetSegmentation().GetNthSegmentID(i))
-        effect.self().onApply()
-        #segmentationNode.GetSegmentation().RemoveSegment(segmentationNode.GetSegmentation().GetNthSegmentID(i))
-
-    #for i in range(1, segmentationNode.GetSegmentation().GetNumberOfSegments()):  #TWO ADDITIONAL PROBES
-    #    segmentationNode.GetSegmentation().RemoveSegment(segmentationNode.GetSegmentation().GetNthSegmentID(i))
-
-    segDisplayNode = segmentationNode.GetDisplayNode()
-    segDisplayNode.SetOpacity(0.3)
-
-    segmentationNode.GetSegmentation().CreateRepresentation("Closed surface")
-    segmentationNode.GetSegmentation().SetMasterRepresentationName("Closed surface")
-    
-    segNum = segmentationNode.GetSegmentation().GetNumberOfSegments()
-    for i in range(0,segNum):
-      segmentationNode.GetSegmentation().RemoveSegment(segmentationNode.GetSegmentation().GetNthSegmentID(1))
+    zonePolyDatas = []
+    with batchSceneModification(thisScene):
+      for probeNodeID in nodeIds:
+          duplicateProbeNode = thisScene.GetNodeByID(probeNodeID)
+          zonePolyDatas.append(getSegmentWorldPolyData(duplicateProbeNode))
+          duplicateProbeNode.SetDisplayVisibility(0)
 
-    segmentationNode.SetName("translated probe")
-    #segmentationNode.GetSegmentation().GetNthSegment(0).SetName(probeName)
-    return segmentationNode
+    unionImage = unionPolyDataLabelmap(zonePolyDatas, spacing)
 
+    with batchSceneModification():
+      segmentationNode = self.getOutputNode("CombinedAblationZone", "vtkMRMLSegmentationNode", "translated probe")
+      if segmentationNode.GetDisplayNode() is None:
+        segmentationNode.CreateDefaultDisplayNodes() # only needed for display
+      segmentationNode.GetSegmentation().RemoveAllSegments()
+      segmentationNode.AddSegmentFromBinaryLabelmapRepresentation(unionImage, probeName, [1,0,0])
+      segmentationNode.GetSegmentation().CreateRepresentation("Closed surface")
 
-def applyTransformToProbe(rm, probeNode, xyz1):
-    transformNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLTransformNode")
-  
-    transformMatrixNP = np.array(
-    [[rm[0,0],rm[0,1],rm[0,2], xyz1[0]],
-    [rm[1,0],rm[1,1],rm[1,2], xyz1[1]],
-    [rm[2,0],rm[2,1],rm[2,2], xyz1[2]],
-    [0,0,0,1]])
+      segDisplayNode = segmentationNode.GetDisplayNode()
+      segDisplayNode.SetOpacity(0.3)
 
-    #print(transformMatrixNP)
+    logging.info("Combined {0} ablation zones in {1:.3f} s".format(len(nodeIds), time.perf_counter() - startTime))
+    return segmentationNode
 
-    transformNode.SetMatrixTransformToParent(slicer.util.vtkMatrixFromArray(transformMatrixNP))
-    
-    slicer.app.processEvents()  
-    time.sleep(0.05)
-    probeNode.SetAndObserveTransformNodeID(transformNode.GetID())
-    slicer.app.processEvents()  #harden transform would often cause slicer to crash before slowing the program down. 
-    time.sleep(0.05)
-    probeNode.HardenTransform()
-    time.sleep(0.05)
-    slicer.app.processEvents()
-    slicer.mrmlScene.RemoveNode(transformNode)
-
-
-
-def rotationMatrixFromVectors(vec1, vec2):
-    """ Find the rotation matrix that aligns vec1 to vec2
-    :param vec1: A 3d "source" vector
-    :param vec2: A 3d "destination" vector
-    :return mat: A transform matrix (3x3) which when applied to vec1, aligns it with vec2.
-    """
-    a, b = (vec1 / np.linalg.norm(vec1)).reshape(3), (vec2 / np.linalg.norm(vec2)).reshape(3)
-    v = np.cross(a, b)
-    c = np.dot(a, b)
-    s = np.linalg.norm(v)
-    kmat = np.array([[0, -v[2], v[1]], [v[2], 0, -v[0]], [-v[1], v[0], 0]])
-    rotationMatrix = np.eye(3) + kmat + kmat.dot(kmat) * ((1 - c) / (s ** 2))
-    return rotationMatrix
-
-def duplicateProbeNode(fidPairs, probeNode):
-    #print("Copying: ", probeNode)
-    numDuplicates = int(fidPairs)
-    nodeIds = []
-    #nodeIds.append(probeNode.GetID())
-    if (numDuplicates > 0):
-        for i in range(0,numDuplicates):
-            
-            mergedImage = vtk.vtkPolyData()
-            probeNode.GetClosedSurfaceRepresentation(probeNode.GetSegmentation().GetNthSegmentID(0), mergedImage)
-            
-            segmentationNode = slicer.vtkMRMLSegmentationNode()
-            slicer.mrmlScene.AddNode(segmentationNode)
-            
-            slicer.app.processEvents()  #force update as occasionally the follow steps cause slicer to crash
-            time.sleep(0.1)
-
-            segmentationNode.CreateDefaultDisplayNodes() # only needed for display
-            segmentationNode.AddSegmentFromClosedSurfaceRepresentation(mergedImage,"duplicate_node",[0,1,0])
-            segmentationNode.GetSegmentation().CreateRepresentation("Closed surface")
-            segmentationNode.GetSegmentation().SetMasterRepresentationName("Binary labelmap")
-
-            segDisplayNode = probeNode.GetDisplayNode()
-            segDisplayNode.SetOpacity(0.3)
-            segDisplayNode = segmentationNode.GetDisplayNode()
-            segDisplayNode.SetOpacity(0.3)
-
-            slicer.app.processEvents() 
-            time.sleep(0.1)
-
-            nodeIds.append(segmentationNode.GetID()) #CHANGED THIS
-            seg_name = probeNode.GetName()
-            new_seg_name = seg_name + "_" + str(i)
-            segmentationNode.SetName(new_seg_name)
-
-    #probeNode.GetSegmentation().CreateRepresentation("Binary labelmap")
-    #probeNode.GetSegmentation().SetMasterRepresentationName("Binary labelmap")
-    return nodeIds
 
+def rasterizePolyData(polyData, origin, spacing, extent):
+    """Rasterize a closed surface onto the given extent of an axis aligned grid.
+    Returns a uint8 array (0/1) with shape (k, j, i) matching the extent.
+    """
+    stencilFilter = vtk.vtkPolyDataToImageStencil()
+    stencilFilter.SetInputData(polyData)
+    stencilFilter.SetOutputOrigin(origin)
+    stencilFilter.SetOutputSpacing(spacing)
+    stencilFilter.SetOutputWholeExtent(extent)
+    stencilToImage = vtk.vtkImageStencilToImage()
+    stencilToImage.SetInputConnection(stencilFilter.GetOutputPort())
+    stencilToImage.SetInsideValue(1)
+    stencilToImage.SetOutsideValue(0)
+    stencilToImage.SetOutputScalarTypeToUnsignedChar()
+    stencilToImage.Update()
+    dimensions = [extent[1]-extent[0]+1, extent[3]-extent[2]+1, extent[5]-extent[4]+1]
+    return numpy_support.vtk_to_numpy(stencilToImage.GetOutput().GetPointData().GetScalars()).reshape(dimensions[::-1])
+
+@profiler.spanned()
+def unionPolyDataLabelmap(polyDatas, spacing=0.5):
+    """Return a vtkOrientedImageData labelmap (1 inside) of the union of closed surfaces.
+    The grid covers the bounds of all surfaces; each surface is only rasterized within its own bounds.
+    """
+    bounds = np.array([polyData.GetBounds() for polyData in polyDatas])
+    origin = bounds[:,0::2].min(axis=0) - spacing
+    dimensions = np.ceil((bounds[:,1::2].max(axis=0) + spacing - origin) / spacing).astype(int) + 1
+    unionArray = np.zeros(dimensions[::-1], dtype=np.uint8)
+
+    for polyData, zoneBounds in zip(polyDatas, bounds):
+        minIndex = np.maximum(np.floor((zoneBounds[0::2] - origin) / spacing).astype(int), 0)
+        maxIndex = np.minimum(np.ceil((zoneBounds[1::2] - origin) / spacing).astype(int), dimensions - 1)
+        extent = [minIndex[0], maxIndex[0], minIndex[1], maxIndex[1], minIndex[2], maxIndex[2]]
+        zoneArray = rasterizePolyData(polyData, origin, [spacing]*3, extent)
+        unionRegion = unionArray[minIndex[2]:maxIndex[2]+1, minIndex[1]:maxIndex[1]+1, minIndex[0]:maxIndex[0]+1]
+        np.logical_or(unionRegion, zoneArray, out=unionRegion)
+
+    unionImage = vtkSegmentationCore.vtkOrientedImageData()
+    unionImage.SetOrigin(origin)
+    unionImage.SetSpacing([spacing]*3)
+    unionImage.SetExtent(0, dimensions[0]-1, 0, dimensions[1]-1, 0, dimensions[2]-1)
+    unionImage.AllocateScalars(vtk.VTK_UNSIGNED_CHAR, 1)
+    numpy_support.vtk_to_numpy(unionImage.GetPointData().GetScalars())[:] = unionArray.ravel()
+    return unionImage
+
+def processBatchCase(caseArguments):
+    """Entry point of the Slicer processes started by AblationPlannerLogic.runBatch: evaluate one case and exit."""
+    exitCode = 0
+    try:
+      AblationPlannerLogic().processCase(*json.loads(caseArguments))
+    except Exception:
+      logging.exception("Case failed")
+      exitCode = 1
+    slicer.util.exit(exitCode)
+
+def describePipelineResult(result):
+    """Sizes of the result of a pipeline stage for the timing log: mesh points and cells, number of segments..."""
+    if isinstance(result, tuple) and result:
+      result = result[0]
+    if isinstance(result, slicer.vtkMRMLModelNode):
+      result = result.GetPolyData()
+    if isinstance(result, vtk.vtkPolyData):
+      return {"points": result.GetNumberOfPoints(), "cells": result.GetNumberOfCells()}
+    if isinstance(result, vtk.vtkImageData):
+      return {"voxels": result.GetNumberOfPoints()}
+    if isinstance(result, slicer.vtkMRMLSegmentationNode):
+      return {"segments": result.GetSegmentation().GetNumberOfSegments()}
+    if isinstance(result, np.ndarray):
+      return {"values": result.size}
+    if isinstance(result, list):
+      return {"items": len(result)}
+    return {}
+
+def processMemoryUsage():
+    """Resident memory of the application process in MB, or None if it cannot be determined on this platform."""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / 2**20
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/statm") as statmFile:
+            return int(statmFile.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def sceneMemoryUsage():
+    """Number of scene nodes, memory of the model and segmentation data in the scene (MB) and process memory (MB)."""
+    dataMemory = 0
+    for modelNode in slicer.util.getNodesByClass("vtkMRMLModelNode"):
+        if modelNode.GetPolyData() is not None:
+            dataMemory += modelNode.GetPolyData().GetActualMemorySize()
+    representations = set() # segments can share a labelmap
+    for segmentationNode in slicer.util.getNodesByClass("vtkMRMLSegmentationNode"):
+        segmentation = segmentationNode.GetSegmentation()
+        for segmentIndex in range(segmentation.GetNumberOfSegments()):
+            segment = segmentation.GetNthSegment(segmentIndex)
+            for representationName in ("Binary labelmap", "Closed surface"):
+                representation = segment.GetRepresentation(representationName)
+                if representation is not None:
+                    representations.add(representation)
+    dataMemory += sum(representation.GetActualMemorySize() for representation in representations)
+    return {"nodeCount": slicer.mrmlScene.GetNumberOfNodes(), "dataMemory": dataMemory / 1024.0,
+      "processMemory": processMemoryUsage()}
+
+@profiler.spanned()
+def decimateSurface(polyData, vertexBudget):
+    """Return a triangulated copy of a closed surface decimated to about vertexBudget points (or fewer)."""
+    triangleFilter = vtk.vtkTriangleFilter()
+    triangleFilter.SetInputData(polyData)
+    triangleFilter.Update()
+    triangles = triangleFilter.GetOutput()
+    if triangles.GetNumberOfPoints() <= vertexBudget:
+      return triangles
+    decimation = vtk.vtkQuadricDecimation()
+    decimation.SetInputData(triangles)
+    decimation.SetTargetReduction(1.0 - float(vertexBudget) / triangles.GetNumberOfPoints())
+    decimation.VolumePreservationOn()
+    decimation.Update()
+    return decimation.GetOutput()
+
+def surfaceApproximationError(fullPolyData, coarsePolyData):
+    """Estimate of the Hausdorff distance (mm) between two surfaces: the largest distance from the vertices of each
+    surface to the other surface. Points inside the triangles are not sampled, so the true distance can be larger.
+    """
+    fullPoints = numpy_support.vtk_to_numpy(fullPolyData.GetPoints().GetData())
+    coarsePoints = numpy_support.vtk_to_numpy(coarsePolyData.GetPoints().GetData())
+    fullToCoarse = np.abs(evaluateSignedDistances(buildSurfaceDistanceIndex(coarsePolyData), fullPoints)).max()
+    coarseToFull = np.abs(evaluateSignedDistances(buildSurfaceDistanceIndex(fullPolyData), coarsePoints)).max()
+    return float(max(fullToCoarse, coarseToFull))
+
+def computeVertexAreas(polyData):
+    """Return the surface area represented by each point of a surface mesh (a third of each adjacent triangle)."""
+    if polyData.GetPolys().GetMaxCellSize() != 3 or polyData.GetNumberOfStrips() > 0:
+      triangleFilter = vtk.vtkTriangleFilter()
+      triangleFilter.SetInputData(polyData)
+      triangleFilter.Update()
+      polyData = triangleFilter.GetOutput()
+    triangles = numpy_support.vtk_to_numpy(polyData.GetPolys().GetConnectivityArray())
+    return vertexAreas(numpy_support.vtk_to_numpy(polyData.GetPoints().GetData()), triangles)
+
+def setModelPointDataArray(modelNode, arrayName, values):
+    """Store values as a named point data array of the model, reusing the existing array when its shape matches."""
+    pointData = modelNode.GetMesh().GetPointData()
+    values = np.asarray(values)
+    vtkArray = pointData.GetArray(arrayName)
+    if vtkArray is not None and vtkArray.GetNumberOfTuples() == len(values) and vtkArray.GetDataType() == numpy_support.get_vtk_array_type(values.dtype):
+        numpy_support.vtk_to_numpy(vtkArray)[:] = values
+        vtkArray.Modified()
+    else:
+        vtkArray = numpy_support.numpy_to_vtk(values, deep=True)
+        vtkArray.SetName(arrayName)
+        pointData.AddArray(vtkArray)
+    modelNode.GetMesh().Modified()
+    return vtkArray
+
+@contextlib.contextmanager
+def batchSceneModification(scene=None):
+    """Group scene edits into one batch processing transaction: observers and views are updated once when the
+    outermost batch ends instead of after every node change. Batches can be nested."""
+    scene = scene or slicer.mrmlScene
+    scene.StartState(slicer.vtkMRMLScene.BatchProcessState)
+    try:
+        yield scene
+    finally:
+        scene.EndState(slicer.vtkMRMLScene.BatchProcessState)
+
+def transformPolyData(polyData, matrix):
+    """Return a transformed copy of polyData; matrix is a 4x4 numpy array."""
+    transform = vtk.vtkTransform()
+    transform.SetMatrix(np.asarray(matrix, dtype=float).ravel())
+    transformFilter = vtk.vtkTransformPolyDataFilter()
+    transformFilter.SetTransform(transform)
+    transformFilter.SetInputData(polyData)
+    transformFilter.Update()
+    return transformFilter.GetOutput()
+
+@profiler.spanned()
 def convertSegmentToModel(segmentNode, folderName="Folder"):
 
     shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
@@ -800,21 +2616,402 @@ def convertSegmentToModel(segmentNode, folderName="Folder"):
     displayNode.SetOpacity(0.2)
     return folder
 
-def findModelToModelDistance(modelNode1,modelNode2):
-    print("Executing model to model distance!")
-
-    vtkOutput = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLModelNode")
-    vtkOutput.SetName("m2md")
+@profiler.spanned()
+def updateModelFromSegment(segmentationNode, modelNode, segmentID=None):
+    """Replace the surface of an existing model by the closed surface of a segment (the first one by default)
+    in world coordinates. Unlike convertSegmentToModel, no folder or model node is added to the scene.
+    """
+    if segmentID is None:
+        segmentID = segmentationNode.GetSegmentation().GetNthSegmentID(0)
+    modelNode.SetAndObservePolyData(getSegmentWorldPolyData(segmentationNode, segmentID))
+    if modelNode.GetDisplayNode() is None:
+        modelNode.CreateDefaultDisplayNodes()
+        modelNode.GetDisplayNode().SetOpacity(0.2)
+    modelNode.GetDisplayNode().SetColor(segmentationNode.GetSegmentation().GetSegment(segmentID).GetColor())
+    return modelNode
+
+@profiler.spanned()
+def getSegmentWorldPolyData(segmentationNode, segmentID=None):
+    """Return the closed surface of a segment (the first one by default) in world coordinates."""
+    if segmentID is None:
+        segmentID = segmentationNode.GetSegmentation().GetNthSegmentID(0)
+    segmentationNode.CreateClosedSurfaceRepresentation()
+    polyData = vtk.vtkPolyData()
+    slicer.vtkSlicerSegmentationsModuleLogic.GetSegmentClosedSurfaceRepresentation(segmentationNode, segmentID, polyData, True)
+    return polyData
+
+def gridGeometry(bounds, spacing, padding=0.0):
+    """Return an axis aligned vtkOrientedImageData geometry (no voxels allocated) with isotropic spacing (mm) that
+    covers bounds (xmin, xmax, ymin, ymax, zmin, zmax) and padding (mm) around them, with its origin and dimensions."""
+    bounds = np.asarray(bounds, dtype=float)
+    origin = bounds[0::2] - padding
+    dimensions = np.ceil((bounds[1::2] - bounds[0::2] + 2 * padding) / spacing).astype(int) + 1
+    referenceGeometry = vtkSegmentationCore.vtkOrientedImageData()
+    referenceGeometry.SetOrigin(origin)
+    referenceGeometry.SetSpacing(spacing, spacing, spacing)
+    referenceGeometry.SetExtent(0, dimensions[0]-1, 0, dimensions[1]-1, 0, dimensions[2]-1)
+    return referenceGeometry, origin, dimensions
+
+@profiler.spanned()
+def segmentLabelmapMask(segmentationNode, referenceGeometry, segmentID=None):
+    """Return the binary labelmap of a segment (the first one by default) resampled onto the geometry of
+    referenceGeometry (a vtkOrientedImageData in world coordinates, nearest neighbor), as a (k,j,i) boolean array.
+    """
+    segmentation = segmentationNode.GetSegmentation()
+    if segmentID is None:
+        segmentID = segmentation.GetNthSegmentID(0)
+    segmentation.CreateRepresentation("Binary labelmap")
+    segment = segmentation.GetSegment(segmentID)
+    segmentToWorld = None
+    if segmentationNode.GetParentTransformNode() is not None:
+        segmentToWorld = vtk.vtkGeneralTransform()
+        slicer.vtkMRMLTransformNode.GetTransformBetweenNodes(segmentationNode.GetParentTransformNode(), None, segmentToWorld)
+    labelmap = vtkSegmentationCore.vtkOrientedImageData()
+    vtkSegmentationCore.vtkOrientedImageDataResample.ResampleOrientedImageToReferenceOrientedImage(
+        segment.GetRepresentation("Binary labelmap"), referenceGeometry, labelmap, False, True, segmentToWorld)
+    dimensions = labelmap.GetDimensions()
+    return numpy_support.vtk_to_numpy(labelmap.GetPointData().GetScalars()).reshape(dimensions[::-1]) == segment.GetLabelValue()
+
+def boundsContain(outerBounds, innerBounds):
+    """Whether the box outerBounds (xmin, xmax, ymin, ymax, zmin, zmax) contains the box innerBounds."""
+    outerBounds = np.asarray(outerBounds, dtype=float)
+    innerBounds = np.asarray(innerBounds, dtype=float)
+    return bool(np.all(outerBounds[0::2] <= innerBounds[0::2]) and np.all(outerBounds[1::2] >= innerBounds[1::2]))
+
+def packSegmentLabelmap(segmentationNode, segmentID=None):
+    """Return the binary labelmap of a segment (the first one by default) as a dictionary of compact arrays:
+    the voxels packed into bits, the extent and the image to world matrix, and the segment name and color."""
+    segmentation = segmentationNode.GetSegmentation()
+    if segmentID is None:
+        segmentID = segmentation.GetNthSegmentID(0)
+    segment = segmentation.GetSegment(segmentID)
+    labelmap = segment.GetRepresentation("Binary labelmap")
+    imageToWorld = vtk.vtkMatrix4x4()
+    labelmap.GetImageToWorldMatrix(imageToWorld)
+    voxels = numpy_support.vtk_to_numpy(labelmap.GetPointData().GetScalars()) == segment.GetLabelValue()
+    return {"bits": np.packbits(voxels), "extent": np.array(labelmap.GetExtent()), "imageToWorld": slicer.util.arrayFromVTKMatrix(imageToWorld),
+      "name": segment.GetName(), "color": segment.GetColor()}
+
+def unpackSegmentLabelmap(packedLabelmap, segmentationNode):
+    """Replace the segments of a segmentation node by a labelmap packed with packSegmentLabelmap."""
+    extent = [int(value) for value in packedLabelmap["extent"]]
+    labelmap = vtkSegmentationCore.vtkOrientedImageData()
+    labelmap.SetExtent(extent)
+    labelmap.SetImageToWorldMatrix(slicer.util.vtkMatrixFromArray(packedLabelmap["imageToWorld"]))
+    voxelCount = (extent[1]-extent[0]+1) * (extent[3]-extent[2]+1) * (extent[5]-extent[4]+1)
+    voxels = np.unpackbits(packedLabelmap["bits"], count=voxelCount)
+    labelmap.GetPointData().SetScalars(numpy_support.numpy_to_vtk(voxels, deep=True, array_type=vtk.VTK_UNSIGNED_CHAR))
+    segmentationNode.GetSegmentation().RemoveAllSegments()
+    segmentationNode.AddSegmentFromBinaryLabelmapRepresentation(labelmap, packedLabelmap["name"], packedLabelmap["color"])
+    segmentationNode.GetSegmentation().CreateRepresentation("Closed surface")
 
-    parameters = {}
-    parameters["vtkFile1"] = modelNode2
-    parameters["vtkFile2"] = modelNode1
-    parameters['distanceType'] = "signed_closest_point"
-    parameters["vtkOutput"] = vtkOutput
+def euclideanDistanceMap(mask, spacing):
+    """Distance (mm) from every voxel of a (k,j,i) boolean mask on an isotropic grid to the nearest voxel outside
+    of the mask (0 outside of the mask)."""
+    image = vtk.vtkImageData()
+    image.SetDimensions(mask.shape[::-1])
+    image.GetPointData().SetScalars(numpy_support.numpy_to_vtk(np.ascontiguousarray(mask, dtype=np.uint8).ravel(), deep=True))
+    distanceFilter = vtk.vtkImageEuclideanDistance()
+    distanceFilter.SetInputData(image)
+    distanceFilter.InitializeOn()
+    distanceFilter.ConsiderAnisotropyOff()
+    distanceFilter.SetAlgorithmToSaito()
+    distanceFilter.Update()
+    squaredDistances = numpy_support.vtk_to_numpy(distanceFilter.GetOutput().GetPointData().GetScalars())
+    return spacing * np.sqrt(squaredDistances).reshape(mask.shape)
+
+def computeVolumeCoverageOnGrid(tumorMask, zoneMask, spacing, marginDistance, task=None):
+    """VolumeCoverage of boolean masks on an isotropic grid; safe to run in a worker thread (no scene access)."""
+    # distance to the tumor = distance to the nearest voxel outside of the complement of the tumor
+    distanceToTumor = euclideanDistanceMap(~tumorMask, spacing)
+    return computeVolumeCoverage(tumorMask, zoneMask, distanceToTumor, spacing ** 3, marginDistance)
+
+def createProcessPool(maximumWorkers=None, initializer=None, initargs=()):
+    """Return a process pool executor whose workers are spawned Python interpreters of Slicer.
+    Workers do not share the application state, they can only run code of AblationPlannerLib (NumPy only).
+    """
+    context = multiprocessing.get_context("spawn")
+    context.set_executable(shutil.which("PythonSlicer") or sys.executable)
+    return concurrent.futures.ProcessPoolExecutor(max_workers=maximumWorkers, mp_context=context,
+      initializer=initializer, initargs=initargs)
+
+@profiler.spanned()
+def getWorldPolyData(modelNode):
+    """Return the surface of the model in world coordinates (parent transforms applied, the node is not modified)."""
+    polyData = modelNode.GetPolyData()
+    if modelNode.GetParentTransformNode() is None:
+        return polyData
+    modelToWorld = vtk.vtkGeneralTransform()
+    slicer.vtkMRMLTransformNode.GetTransformBetweenNodes(modelNode.GetParentTransformNode(), None, modelToWorld)
+    transformFilter = vtk.vtkTransformPolyDataFilter()
+    transformFilter.SetTransform(modelToWorld)
+    transformFilter.SetInputData(polyData)
+    transformFilter.Update()
+    return transformFilter.GetOutput()
+
+@profiler.spanned()
+def buildSurfaceDistanceIndex(surfacePolyData):
+    """Build a reusable signed distance function of a closed surface.
+    The function keeps a cell locator of the surface, so it can be queried many times without rebuilding it.
+    """
+    triangleFilter = vtk.vtkTriangleFilter()
+    triangleFilter.SetInputData(surfacePolyData)
+    triangleFilter.Update()
+    distanceFunction = vtk.vtkImplicitPolyDataDistance()
+    distanceFunction.SetInput(triangleFilter.GetOutput())
+    return distanceFunction
+
+def evaluateInChunks(function, points, task=None, chunkSize=20000):
+    """Evaluate function on an (N,3) array of points chunk by chunk, so that a running PipelineTask
+    can report progress and be cancelled between chunks. Returns the (N,) results."""
+    values = np.empty(len(points))
+    for start in range(0, len(points), chunkSize):
+        if task is not None:
+            task.checkCancelled()
+            task.setThreadProgress(float(start) / len(points))
+        values[start:start+chunkSize] = function(points[start:start+chunkSize])
+    return values
+
+def polyDataFromTriangles(points, triangles):
+    """Return a surface mesh made of points (N,3) and triangles (T,3) point indices."""
+    polyData = vtk.vtkPolyData()
+    vtkPoints = vtk.vtkPoints()
+    vtkPoints.SetData(numpy_support.numpy_to_vtk(np.asarray(points, dtype=np.float32), deep=True))
+    polyData.SetPoints(vtkPoints)
+    triangles = np.asarray(triangles, dtype=np.int64).reshape(-1, 3)
+    offsets = numpy_support.numpy_to_vtk(np.arange(0, 3 * len(triangles) + 1, 3, dtype=np.int64), deep=True, array_type=vtk.VTK_ID_TYPE)
+    connectivity = numpy_support.numpy_to_vtk(triangles.ravel(), deep=True, array_type=vtk.VTK_ID_TYPE)
+    cells = vtk.vtkCellArray()
+    cells.SetData(offsets, connectivity)
+    polyData.SetPolys(cells)
+    return polyData
+
+@profiler.spanned()
+def buildSignedDistanceField(surfacePolyData, spacing=1.0, padding=15.0, task=None):
+    """Sample the signed distance to a closed surface on an axis aligned grid covering the surface and padding (mm)
+    around it. Returns a SignedDistanceField; safe to run in a worker thread (no scene access).
+    """
+    bounds = np.array(surfacePolyData.GetBounds())
+    origin = bounds[0::2] - padding
+    dimensions = np.ceil((bounds[1::2] - bounds[0::2] + 2 * padding) / spacing).astype(int) + 1
+    values = computeSignedDistancesToSurface(surfacePolyData, gridPoints(origin, spacing, dimensions), task)
+    return SignedDistanceField(origin, spacing, values.reshape(dimensions[::-1]))
+
+def computeSignedDistancesToSurface(surfacePolyData, points, task=None):
+    """Signed distances of points to a closed surface; safe to run in a worker thread (no scene access)."""
+    distanceFunction = buildSurfaceDistanceIndex(surfacePolyData)
+    return evaluateInChunks(lambda chunk: evaluateSignedDistances(distanceFunction, chunk), points, task)
+
+def evaluateSignedDistances(distanceFunction, points):
+    """Evaluate the signed distance (negative inside the surface) of an (N,3) array of points in a single call."""
+    points = np.ascontiguousarray(points, dtype=np.float64)
+    distances = vtk.vtkDoubleArray()
+    if len(points) > 0:
+        distanceFunction.FunctionValue(numpy_support.numpy_to_vtk(points, deep=True), distances)
+    return numpy_support.vtk_to_numpy(distances).copy() if len(points) > 0 else np.zeros(0)
+
+def createEllipsoidProfileSurface(profile, resolution=32):
+    """Return a closed surface of the ellipsoid profile in the probe frame."""
+    sphereSource = vtk.vtkSphereSource()
+    sphereSource.SetRadius(1.0)
+    sphereSource.SetThetaResolution(2*resolution)
+    sphereSource.SetPhiResolution(resolution)
+    sphereSource.Update()
+    sphereToProbe = np.diag(list(profile.semiAxes) + [1.0])
+    sphereToProbe[:3,3] = profile.center()
+    return transformPolyData(sphereSource.GetOutput(), sphereToProbe)
+
+def addSignedDistanceArrays(polyData, signedDistances):
+    """Add the "Signed" and "Absolute" distance point data arrays used by the margin coloring and tables."""
+    signedArray = numpy_support.numpy_to_vtk(np.asarray(signedDistances, dtype=np.float64), deep=True)
+    signedArray.SetName("Signed")
+    polyData.GetPointData().AddArray(signedArray)
+    absoluteArray = numpy_support.numpy_to_vtk(np.abs(signedDistances).astype(np.float64), deep=True)
+    absoluteArray.SetName("Absolute")
+    polyData.GetPointData().AddArray(absoluteArray)
+
+class EvaluationCancelled(Exception):
+    """Raised in the steps of a PipelineTask when the task is cancelled."""
+
+class PipelineTask:
+    """Runs the steps of a pipeline generator, either synchronously (run) or without blocking the application
+    event loop (start). The generator yields requests and is sent their results:
+    ("progress", fraction, message): report the progress of the pipeline (0..1)
+    ("thread", function, args): compute function(*args, task); start() runs it in a worker thread, so it must
+      not access the scene, and it should call task.checkCancelled() regularly
+    ("cli", module, parameters): run a CLI module; the CLI node is sent once it completed
+    The value returned by the generator is the result of the task. Cancelling raises EvaluationCancelled in the
+    generator at its current step (and cancels a running CLI), as does a failed thread or CLI step.
+    While timing is on, the task is recorded as a span named after the generator, with a child span for each
+    thread and CLI step.
+    """
 
-    cliNode = slicer.cli.runSync(slicer.modules.modeltomodeldistance, None, parameters)
-    return vtkOutput
+    # a single worker thread, so that a cancelled task cannot compete with the task that replaced it
+    workerThreads = None
+    pollIntervalMs = 50
+
+    def __init__(self, steps, progressCallback=None, finishedCallback=None):
+        self.steps = steps
+        self.progressCallback = progressCallback
+        self.finishedCallback = finishedCallback
+        self.cancelled = False
+        self.finished = False
+        self.result = None
+        self.error = None
+        self.progressFraction = 0.0
+        self.progressMessage = ""
+        self.threadProgress = None
+        self.name = getattr(steps, "__name__", "PipelineTask")
+        self._waitingFor = None
+        self._spanIndex = None
+        self._stepName = None
+        self._stepStart = None
+
+    def checkCancelled(self):
+        if self.cancelled:
+            raise EvaluationCancelled()
+
+    def setThreadProgress(self, fraction):
+        self.threadProgress = fraction
+
+    def _reportProgress(self, fraction, message):
+        self.progressFraction, self.progressMessage = fraction, message
+        if self.progressCallback is not None:
+            self.progressCallback(fraction, message)
+
+    @staticmethod
+    def stepName(request):
+        """Name of the span of a thread or CLI step."""
+        if request[0] == "thread":
+            return "thread: " + getattr(request[1], "__name__", "function")
+        return "cli: " + request[1].name
+
+    def run(self):
+        """Run all steps in this thread and return the result (exceptions are raised)."""
+        value = None
+        error = None
+        try:
+            with profiler.span(self.name):
+                while True:
+                    if error is None and self.cancelled:
+                        error = EvaluationCancelled()
+                    request = self.steps.throw(error) if error is not None else self.steps.send(value)
+                    value = None
+                    error = None
+                    if request[0] not in ("progress", "thread", "cli"):
+                        raise ValueError("Unknown pipeline request: " + str(request[0]))
+                    try:
+                        if request[0] == "progress":
+                            self._reportProgress(request[1], request[2])
+                        elif request[0] == "thread":
+                            with profiler.span(self.stepName(request)):
+                                value = request[1](*request[2], self)
+                        else:
+                            with profiler.span(self.stepName(request)):
+                                value = slicer.cli.runSync(request[1], None, request[2])
+                    except Exception as e:
+                        # raised in the generator at its current step, so that it cleans up as with start()
+                        error = e
+        except StopIteration as stop:
+            self.result = stop.value
+        except Exception as e:
+            self.error = e
+            raise
+        finally:
+            self.finished = True
+        self._reportProgress(1.0, "Done")
+        return self.result
+
+    def start(self):
+        """Start running the steps from the application event loop; finishedCallback(task) is called at the end."""
+        self._spanIndex = profiler.recordSpan(self.name, time.perf_counter())
+        qt.QTimer.singleShot(0, lambda: self._advance(None))
+
+    def cancel(self):
+        if self.finished:
+            return
+        self.cancelled = True
+        if isinstance(self._waitingFor, slicer.vtkMRMLCommandLineModuleNode):
+            self._waitingFor.Cancel()
 
+    def _advance(self, value, error=None):
+        if self.finished:
+            return
+        try:
+            # spans of the steps run by the application thread are nested in the span of the task
+            with profiler.resumedSpan(self._spanIndex):
+                self._step(value, error)
+        except StopIteration as stop:
+            self._finish(result=stop.value)
+        except Exception as e:
+            self._finish(error=e)
+
+    def _step(self, value, error):
+        if error is None and self.cancelled:
+            error = EvaluationCancelled()
+        request = self.steps.throw(error) if error is not None else self.steps.send(value)
+        if request[0] == "progress":
+            self._reportProgress(request[1], request[2])
+            # let the application update (and the user cancel) before the next step
+            qt.QTimer.singleShot(0, lambda: self._advance(None))
+            return
+        if request[0] == "thread":
+            if PipelineTask.workerThreads is None:
+                PipelineTask.workerThreads = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+            self.threadProgress = None
+            self._waitingFor = PipelineTask.workerThreads.submit(request[1], *request[2], self)
+        elif request[0] == "cli":
+            self._waitingFor = slicer.cli.run(request[1], None, request[2])
+        else:
+            raise ValueError("Unknown pipeline request: " + str(request[0]))
+        self._stepName = self.stepName(request)
+        self._stepStart = time.perf_counter()
+        qt.QTimer.singleShot(self.pollIntervalMs, self._poll)
+
+    def _recordStep(self, status):
+        """Record the thread or CLI step that just finished as a child span of the task (on the application thread)."""
+        if self._spanIndex is not None:
+            profiler.recordSpan(self._stepName, self._stepStart, time.perf_counter() - self._stepStart, self._spanIndex, status=status)
+
+    def _poll(self):
+        waitingFor = self._waitingFor
+        if isinstance(waitingFor, concurrent.futures.Future):
+            if not waitingFor.done():
+                if self.threadProgress is not None and self.progressCallback is not None:
+                    self.progressCallback(self.progressFraction, "{0} ({1:.0%})".format(self.progressMessage, self.threadProgress))
+                qt.QTimer.singleShot(self.pollIntervalMs, self._poll)
+                return
+            self._waitingFor = None
+            error = waitingFor.exception()
+            self._recordStep("failed" if error else "done")
+            self._advance(None if error else waitingFor.result(), error)
+            return
+        if waitingFor.IsBusy():
+            qt.QTimer.singleShot(self.pollIntervalMs, self._poll)
+            return
+        self._waitingFor = None
+        error = None
+        if self.cancelled or waitingFor.GetStatus() == waitingFor.Cancelled:
+            error = EvaluationCancelled()
+        elif waitingFor.GetStatus() & waitingFor.ErrorsMask:
+            error = RuntimeError("{0} failed: {1}".format(waitingFor.GetModuleTitle(), waitingFor.GetErrorText()))
+        self._recordStep("cancelled" if isinstance(error, EvaluationCancelled) else "failed" if error else "done")
+        self._advance(waitingFor, error)
+
+    def _finish(self, result=None, error=None):
+        self.finished = True
+        self.result = result
+        self.error = error
+        if isinstance(error, EvaluationCancelled):
+            self.cancelled = True
+        elif error is not None:
+            logging.error("Pipeline step failed: " + str(error))
+        else:
+            self._reportProgress(1.0, "Done")
+        profiler.finishRecordedSpan(self._spanIndex, time.perf_counter(),
+            status="cancelled" if self.cancelled else "failed" if error is not None else "done")
+        if self.finishedCallback is not None:
+            self.finishedCallback(self)
 
 
 #
@@ -833,11 +3030,85 @@ class AblationPlannerTest(ScriptedLoadableModuleTest):
     """
     slicer.mrmlScene.Clear()
 
+  # the tumor and the ablation profile most tests plan with
+  testTumor = EllipsoidProfile((8, 8, 10), 0)
+  testProfile = EllipsoidProfile((12, 12, 16), 10)
+
+  def createSegmentationFromSurface(self, polyData, name):
+    """Add a segmentation node with a single segment (of the same name) from a closed surface, e.g. an ellipsoid
+    tumor or ablation profile made by createEllipsoidProfileSurface."""
+    segmentationNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode", name)
+    segmentationNode.CreateDefaultDisplayNodes()
+    segmentationNode.AddSegmentFromClosedSurfaceRepresentation(polyData, name)
+    return segmentationNode
+
+  def waitForTask(self, task, timeout=60.0):
+    """Process application events until a PipelineTask started with start() has finished."""
+    startTime = time.perf_counter()
+    while not task.finished:
+      self.assertLess(time.perf_counter() - startTime, timeout)
+      slicer.app.processEvents()
+      time.sleep(0.01)
+
+  def createEllipsoidTumorAndProfile(self):
+    """Add the "tumor" and "profile" segmentations of testTumor and testProfile and return them."""
+    tumorNode = self.createSegmentationFromSurface(createEllipsoidProfileSurface(self.testTumor), "tumor")
+    probeNode = self.createSegmentationFromSurface(createEllipsoidProfileSurface(self.testProfile), "profile")
+    return tumorNode, probeNode
+
   def runTest(self):
     """Run as few or as many tests as needed here.
     """
     self.setUp()
     self.test_AblationPlanner1()
+    self.setUp()
+    self.test_ModelToModelDistanceCli()
+    self.setUp()
+    self.test_PipelineTiming()
+    self.setUp()
+    self.test_IncrementalProbeMargins()
+    self.setUp()
+    self.test_TumorMovedAfterDrag()
+    self.setUp()
+    self.test_ProbeUnionScaling()
+    self.setUp()
+    self.test_EllipsoidProfileDistances()
+    self.setUp()
+    self.test_MarginStatistics()
+    self.setUp()
+    self.test_SurfaceDistanceExport()
+    self.setUp()
+    self.test_PreviewMargins()
+    self.setUp()
+    self.test_PipelineTaskTiming()
+    self.setUp()
+    self.test_PipelineTaskCancel()
+    self.setUp()
+    self.test_TrajectoryOptimizer()
+    self.setUp()
+    self.test_BatchResume()
+    self.setUp()
+    self.test_TumorRegistration()
+    self.setUp()
+    self.test_RepeatedPlanningNodeCount()
+    self.setUp()
+    self.test_VolumeCoverage()
+    self.setUp()
+    self.test_ZoneDistanceField()
+    self.setUp()
+    self.test_ProfileCache()
+    self.setUp()
+    self.test_PlanCache()
+    self.setUp()
+    self.test_ProbeNodesUpdatedInPlace()
+    self.setUp()
+    self.test_DragPreviewThrottle()
+    self.setUp()
+    self.test_PlacementUncertainty()
+    self.setUp()
+    self.test_StructureProximity()
+    self.setUp()
+    self.test_WatchFolder()
 
   def test_AblationPlanner1(self):
     """ Ideally you should have several levels of tests.  At the lowest level
@@ -854,10 +3125,923 @@ class AblationPlannerTest(ScriptedLoadableModuleTest):
     self.delayDisplay("Starting the test")
     
     # Get/create input data
-
-   
+    testingDirectory = os.path.join(os.path.dirname(__file__), "Testing")
+    tumorNode = slicer.util.loadSegmentation(os.path.join(testingDirectory, "tumor.seg.nrrd"))
+    endPointsNode = slicer.util.loadMarkups(os.path.join(testingDirectory, "Endpoints.mrk.json"))
+    probeNode = self.createSegmentationFromSurface(createEllipsoidProfileSurface(EllipsoidProfile((15, 15, 20), 10)), "profile")
     self.delayDisplay('Loaded test data set')
 
+    logic = AblationPlannerLogic()
+    endPointPairs = logic.endPointPairsFromMarkups(endPointsNode)
+    probeNodeIDs = logic.placeProbes(probeNode, endPointPairs)
+    self.assertEqual(len(probeNodeIDs), len(endPointPairs))
+    combinedProbeNode = logic.convertSegmentsToSegment(probeNode, probeNodeIDs)
+    outputNode = logic.evaluateMargins(tumorNode, combinedProbeNode)[0]
+
+    signedDistances = slicer.util.arrayFromModelPointData(outputNode, "Signed")
+    self.assertEqual(len(signedDistances), outputNode.GetPolyData().GetNumberOfPoints())
+    logic.changeColorsByMargin_(outputNode, -10, -5, -2)
+    np.testing.assert_array_equal(slicer.util.arrayFromModelPointData(outputNode, "MarginClass"),
+      logic.classifyMargins(signedDistances, [-10, -5, -2]))
+    self.delayDisplay('Test passed')
+
+  def test_ModelToModelDistanceCli(self):
+    """ The in-process distances should match the signed_closest_point distances of the ModelToModelDistance CLI
+    on the bundled case (skipped if the CLI is not installed).
+    """
+    self.delayDisplay("Starting the ModelToModelDistance comparison test")
+    if not hasattr(slicer.modules, "modeltomodeldistance"):
+      self.delayDisplay("The ModelToModelDistance module is not installed, test skipped")
+      return
+    testingDirectory = os.path.join(os.path.dirname(__file__), "Testing")
+    tumorNode = slicer.util.loadSegmentation(os.path.join(testingDirectory, "tumor.seg.nrrd"))
+    endPointsNode = slicer.util.loadMarkups(os.path.join(testingDirectory, "Endpoints.mrk.json"))
+    probeNode = self.createSegmentationFromSurface(createEllipsoidProfileSurface(EllipsoidProfile((15, 15, 20), 10)), "profile")
+    logic = AblationPlannerLogic()
+    combinedProbeNode = logic.convertSegmentsToSegment(probeNode, logic.placeProbes(probeNode, logic.endPointPairsFromMarkups(endPointsNode)))
+
+    signedDistances = {}
+    for distanceBackend in ("InProcess", "ModelToModelDistance"):
+      outputNode = logic.evaluateMargins(tumorNode, combinedProbeNode, distanceBackend)[0]
+      signedDistances[distanceBackend] = slicer.util.arrayFromModelPointData(outputNode, "Signed").copy()
+    inProcessDistances, cliDistances = signedDistances["InProcess"], signedDistances["ModelToModelDistance"]
+    self.assertEqual(inProcessDistances.shape, cliDistances.shape)
+    np.testing.assert_allclose(np.abs(inProcessDistances), np.abs(cliDistances), atol=0.01)
+    # the sign of vertices lying on the zone surface may differ
+    awayFromSurface = np.abs(cliDistances) > 0.1
+    np.testing.assert_array_equal(np.sign(inProcessDistances[awayFromSurface]), np.sign(cliDistances[awayFromSurface]))
+    self.delayDisplay('Test passed')
+
+  def test_PipelineTiming(self):
+    """ Stages recorded while timing is on should nest under the stage that called them and fill the timing table,
+    calls made from worker threads should not be recorded.
+    """
+    import threading
+    self.delayDisplay("Starting the pipeline timing test")
+    logic = AblationPlannerLogic()
+    tumorNode, probeNode = self.createEllipsoidTumorAndProfile()
+
+    logic.setTimingEnabled(True)
+    profiler.clear()
+    try:
+      with profiler.span("Test stage", case="nesting"):
+        logic.evaluateMargins(tumorNode, probeNode)
+      spanCount = len(profiler.spans)
+      worker = threading.Thread(target=profiler.spanned("Worker stage")(np.zeros), args=(10,))
+      worker.start()
+      worker.join()
+      self.assertEqual(len(profiler.spans), spanCount)
+      spans = list(profiler.spans)
+    finally:
+      logic.setTimingEnabled(False)
+      profiler.clear()
+
+    self.assertEqual(spans[0]["name"], "Test stage")
+    self.assertIsNone(spans[0]["parent"])
+    self.assertEqual(spans[0]["attributes"]["case"], "nesting")
+    children = [span for span in spans if span["parent"] == 0]
+    self.assertIn("evaluateMargins", [span["name"] for span in children])
+    self.assertGreater(len(spans), len(children) + 1)
+    for span in spans[1:]:
+      parent = spans[span["parent"]]
+      self.assertEqual(span["depth"], parent["depth"] + 1)
+      self.assertGreaterEqual(span["start"], parent["start"])
+      self.assertLessEqual(span["start"] + span["duration"], parent["start"] + parent["duration"] + 1e-6)
+
+    # the table was written when the top-level stage finished
+    tableNode = slicer.mrmlScene.GetFirstNodeByName("AblationPlanner timing")
+    self.assertIsNotNone(tableNode)
+    self.assertEqual(tableNode.GetNumberOfRows(), len(spans))
+    self.assertEqual(tableNode.GetCellText(0, 0), "Test stage")
+    self.assertTrue(tableNode.GetCellText(1, 0).startswith("  "))
+    self.delayDisplay('Test passed')
+
+  def test_IncrementalProbeMargins(self):
+    """ After a probe is dragged, the per-probe minimum of the incremental update should match a full evaluation of
+    the rebuilt union outside of the zones, and never report more margin than it inside, where the zones overlap.
+    """
+    self.delayDisplay("Starting the incremental probe margin test")
+    logic = AblationPlannerLogic()
+    tumorNode, probeNode = self.createEllipsoidTumorAndProfile()
+    # the zones of the two probes overlap over most of the tumor
+    endPointPairs = [([-4, 0, 0], [-4, 0, 100]), ([4, 0, 0], [4, 0, 100])]
+    probeNodeIDs = logic.placeProbes(probeNode, endPointPairs)
+    outputNode = logic.evaluateMargins(tumorNode, logic.convertSegmentsToSegment(probeNode, probeNodeIDs))[0]
+    logic.updateMarginsFromProbes(outputNode, probeNodeIDs)
+    perProbeDistances = [logic.probeDistances[probeNodeID][1] for probeNodeID in probeNodeIDs]
+    self.assertGreater(np.count_nonzero((perProbeDistances[0] < -1) & (perProbeDistances[1] < -1)), 0)
+
+    for movedPair in (([-4, 3, 2], [-4, 3, 102]), ([-6, 3, 2], [-20, 3, 100])):
+      logic.placeProbes(probeNode, [movedPair], reuseNodeIDs=probeNodeIDs[:1])
+      lowerMargin, statistics = logic.updateMarginsFromProbes(outputNode, probeNodeIDs)
+      incrementalDistances = slicer.util.arrayFromModelPointData(outputNode, "Signed").copy()
+      fullDistances = slicer.util.arrayFromModelPointData(
+        logic.evaluateMargins(tumorNode, logic.convertSegmentsToSegment(probeNode, probeNodeIDs))[0], "Signed")
+      self.assertEqual(incrementalDistances.shape, fullDistances.shape)
+      # the union is rebuilt from 0.5 mm labelmaps, its surface deviates from the probe surfaces by about a voxel
+      outside = fullDistances > 0
+      self.assertLess(np.abs(incrementalDistances[outside] - fullDistances[outside]).max(), 0.6)
+      self.assertGreaterEqual((incrementalDistances - fullDistances).min(), -0.6)
+      self.assertAlmostEqual(lowerMargin, incrementalDistances.min(), places=6)
+    self.delayDisplay('Test passed')
+
+  def test_TumorMovedAfterDrag(self):
+    """ When the tumor moves after a probe was dragged, the combined zone built before the drag must not be sampled:
+    the margins should match a full evaluation of the rebuilt union instead.
+    """
+    self.delayDisplay("Starting the tumor moved after drag test")
+    logic = AblationPlannerLogic()
+    tumorNode, probeNode = self.createEllipsoidTumorAndProfile()
+    endPointPairs = [([-4, 0, 0], [-4, 0, 100]), ([4, 0, 0], [4, 0, 100])]
+    probeNodeIDs = logic.placeProbes(probeNode, endPointPairs)
+    zoneNode = logic.convertSegmentsToSegment(probeNode, probeNodeIDs)
+    logic.setCombinedZone(zoneNode, logic.getZoneKey(probeNode, endPointPairs))
+    outputNode = logic.evaluateMargins(tumorNode, zoneNode)[0]
+
+    # a probe is dragged: it is moved in place, the combined zone is not rebuilt
+    movedPairs = [([-4, 6, 2], [-4, 6, 102]), endPointPairs[1]]
+    logic.placeProbes(probeNode, movedPairs[:1], reuseNodeIDs=probeNodeIDs[:1])
+    logic.updateMarginsFromProbes(outputNode, probeNodeIDs)
+    self.assertIs(logic.getCombinedZone(logic.getZoneKey(probeNode, endPointPairs)), zoneNode)
+    self.assertIsNone(logic.getCombinedZone(logic.getZoneKey(probeNode, movedPairs)))
+
+    # then the tumor moves
+    transformNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLinearTransformNode")
+    transformNode.SetMatrixTransformToParent(slicer.util.vtkMatrixFromArray(np.array(
+      [[1, 0, 0, 3], [0, 1, 0, -2], [0, 0, 1, 1], [0, 0, 0, 1]], dtype=float)))
+    tumorNode.SetAndObserveTransformNodeID(transformNode.GetID())
+    logic.updateMarginsForTumor(outputNode, tumorNode, zoneNode)
+    staleDistances = slicer.util.arrayFromModelPointData(outputNode, "Signed").copy()
+    lowerMargin, statistics = logic.updateMarginsForTumor(outputNode, tumorNode,
+      logic.getCombinedZone(logic.getZoneKey(probeNode, movedPairs)), probeNodeIDs=probeNodeIDs)
+    distances = slicer.util.arrayFromModelPointData(outputNode, "Signed").copy()
+    self.assertAlmostEqual(lowerMargin, distances.min(), places=6)
+
+    fullDistances = slicer.util.arrayFromModelPointData(
+      logic.evaluateMargins(tumorNode, logic.convertSegmentsToSegment(probeNode, probeNodeIDs))[0], "Signed")
+    self.assertEqual(distances.shape, fullDistances.shape)
+    # as in test_IncrementalProbeMargins: equal outside of the zones, conservative where they overlap
+    outside = fullDistances > 0
+    self.assertLess(np.abs(distances[outside] - fullDistances[outside]).max(), 0.6)
+    self.assertGreaterEqual((distances - fullDistances).min(), -0.6)
+    # the zone built before the drag gives different margins
+    self.assertGreater(np.abs(staleDistances - fullDistances).max(), 1.0)
+    self.delayDisplay('Test passed')
+
+  def test_ProbeUnionScaling(self):
+    """ Report the runtime of combining 1 to 16 ablation zones into a single segment.
+    """
+    self.delayDisplay("Starting the probe union scaling test")
+    logic = AblationPlannerLogic()
+
+    probeNode = self.createSegmentationFromSurface(createEllipsoidProfileSurface(EllipsoidProfile((15, 15, 20), 15)), "profile")
+
+    runtimes = []
+    for probeCount in range(1, 17):
+      angles = np.linspace(0, 2*np.pi, probeCount, endpoint=False)
+      tips = np.stack([10*np.cos(angles), 10*np.sin(angles), np.zeros(probeCount)], axis=1)
+      endPointPairs = [(tip, tip + [0, 0, 100]) for tip in tips]
+      probeNodeIDs = logic.placeProbes(probeNode, endPointPairs)
+      startTime = time.perf_counter()
+      combinedProbeNode = logic.convertSegmentsToSegment(probeNode, probeNodeIDs)
+      runtimes.append(time.perf_counter() - startTime)
+      self.assertEqual(combinedProbeNode.GetSegmentation().GetNumberOfSegments(), 1)
+      logging.info("Union of {0:2d} ablation zones: {1:.3f} s".format(probeCount, runtimes[-1]))
+      logic.removeProbes(probeNodeIDs)
+
+    self.assertEqual(len(slicer.util.getNodesByClass("vtkMRMLSegmentEditorNode")), 0)
+    self.delayDisplay('Test passed')
+
+  def test_RepeatedPlanningNodeCount(self):
+    """ Repeated planning iterations should update the output nodes in place and keep a bounded history.
+    """
+    self.delayDisplay("Starting the repeated planning test")
+    logic = AblationPlannerLogic()
+    logic.getParameterNode().SetParameter("HistoryLength", "2")
+
+    probeNode = self.createSegmentationFromSurface(createEllipsoidProfileSurface(EllipsoidProfile((15, 15, 20), 15)), "profile")
+    tumorNode = self.createSegmentationFromSurface(createEllipsoidProfileSurface(EllipsoidProfile((8, 8, 8), 0)), "tumor")
+
+    probeNodeIDs = []
+    nodeCounts = []
+    for iteration in range(5):
+      logic.removeProbes(probeNodeIDs)
+      probeNodeIDs = logic.placeProbes(probeNode, [([iteration, 0, -5], [iteration, 0, 95])])
+      combinedProbeNode = logic.convertSegmentsToSegment(probeNode, probeNodeIDs)
+      outputNode = logic.evaluateMargins(tumorNode, combinedProbeNode)[0]
+      nodeCounts.append(slicer.mrmlScene.GetNumberOfNodes())
+
+    self.assertEqual(outputNode.GetID(), logic.getParameterNode().GetNodeReferenceID("MarginModel"))
+    self.assertEqual(logic.getParameterNode().GetNumberOfNodeReferences("MarginHistory"), 2)
+    # once the history is full, an iteration does not add any node
+    self.assertEqual(nodeCounts[2], nodeCounts[-1])
+    self.delayDisplay('Test passed')
+
+  def test_EllipsoidProfileDistances(self):
+    """ The closed form ellipsoid distances should match the in-process engine on a tessellated ellipsoid.
+    """
+    self.delayDisplay("Starting the ellipsoid profile test")
+    profile = EllipsoidProfile((10, 12, 20), 8)
+    probePoses = probePosesFromEndPoints([[5, -3, 2]], [[40, 20, 60]])
+    zonePolyData = transformPolyData(createEllipsoidProfileSurface(profile, resolution=128), probePoses[0])
+
+    points = np.random.RandomState(0).uniform(-40, 50, (2000, 3))
+    closedFormDistances = profile.signedDistances(points, probePoses)
+    surfaceDistances = evaluateSignedDistances(buildSurfaceDistanceIndex(zonePolyData), points)
+    # the tessellated surface deviates from the ellipsoid by a fraction of a millimeter
+    self.assertLess(np.abs(closedFormDistances - surfaceDistances).max(), 0.2)
+    self.assertTrue(np.all(np.sign(closedFormDistances[np.abs(closedFormDistances) > 0.2]) == np.sign(surfaceDistances[np.abs(closedFormDistances) > 0.2])))
+    self.delayDisplay('Test passed')
+
+  def test_MarginStatistics(self):
+    """ On a sphere with the signed distance set to the height z, the area between two heights is proportional to their
+    difference, so the area-weighted statistics are known even though the vertices are not uniformly spread.
+    """
+    self.delayDisplay("Starting the margin statistics test")
+    logic = AblationPlannerLogic()
+    radius = 10.0
+    sphere = vtk.vtkSphereSource()
+    sphere.SetRadius(radius)
+    sphere.SetThetaResolution(96)
+    sphere.SetPhiResolution(96)
+    sphere.Update()
+    modelNode = slicer.modules.models.logic().AddModel(sphere.GetOutput())
+    heights = slicer.util.arrayFromModelPoints(modelNode)[:,2].copy()
+    setModelPointDataArray(modelNode, "Signed", heights)
+
+    statistics = logic.computeMarginStatistics(modelNode, (0, 5, 10))
+    self.assertAlmostEqual(statistics.surfaceArea, 4 * np.pi * radius**2, delta=0.01 * 4 * np.pi * radius**2)
+    self.assertAlmostEqual(statistics.mean, 0.0, delta=0.05)
+    self.assertAlmostEqual(statistics.median, 0.0, delta=0.2)
+    self.assertAlmostEqual(statistics.percentile20, -0.6 * radius, delta=0.2)
+    self.assertAlmostEqual(statistics.percentile80, 0.6 * radius, delta=0.2)
+    # margin below t mm = z > -t, i.e. (radius + t) / (2 radius) of the area; counting vertices would give about 2/3 at 5 mm
+    np.testing.assert_allclose(statistics.fractionBelow, [0.5, 0.75, 1.0], atol=0.01)
+    self.assertAlmostEqual(float(statistics.histogramAreas.sum()), statistics.surfaceArea, delta=1e-3 * statistics.surfaceArea)
+
+    # every vertex counts, including the last one
+    heights[-1] = -2 * radius
+    setModelPointDataArray(modelNode, "Signed", heights)
+    statistics = logic.computeMarginStatistics(modelNode, (0, 5, 10))
+    self.assertEqual(statistics.numberOfVertices, modelNode.GetPolyData().GetNumberOfPoints())
+    self.assertAlmostEqual(statistics.minimum, -2 * radius, places=4)
+    self.assertAlmostEqual(statistics.histogramEdges[0], -2 * radius, places=4)
+    self.assertAlmostEqual(float(statistics.histogramAreas.sum()), statistics.surfaceArea, delta=1e-3 * statistics.surfaceArea)
+    self.delayDisplay('Test passed')
+
+  def test_SurfaceDistanceExport(self):
+    """ Distances exported in both file formats should load back unchanged.
+    """
+    import tempfile
+    from AblationPlannerLib.SurfaceDistanceFiles import loadSurfaceDistances
+    self.delayDisplay("Starting the surface distance export test")
+    logic = AblationPlannerLogic()
+    tumorNode, probeNode = self.createEllipsoidTumorAndProfile()
+    outputNode = logic.evaluateMargins(tumorNode, probeNode)[0]
+    points = slicer.util.arrayFromModelPoints(outputNode)
+    signedDistances = slicer.util.arrayFromModelPointData(outputNode, "Signed")
+
+    outputDirectory = tempfile.mkdtemp()
+    try:
+      for fileFormat, fileName in [("npz", "distances.npz"), ("raw", "distances")]:
+        path = logic.exportSurfaceDistances(outputNode, os.path.join(outputDirectory, fileName), fileFormat)
+        arrays = loadSurfaceDistances(path)
+        self.assertEqual(os.path.isdir(path), fileFormat == "raw")
+        np.testing.assert_array_equal(arrays["pointIds"], np.arange(len(signedDistances)))
+        np.testing.assert_allclose(arrays["points"], points, atol=1e-4)
+        np.testing.assert_allclose(arrays["signed"], signedDistances, atol=1e-5)
+        np.testing.assert_allclose(arrays["absolute"], np.abs(signedDistances), atol=1e-5)
+        # release the memory-mapped files before the directory is removed
+        del arrays
+      with self.assertRaises(ValueError):
+        logic.exportSurfaceDistances(outputNode, os.path.join(outputDirectory, "distances.csv"), "csv")
+    finally:
+      shutil.rmtree(outputDirectory, ignore_errors=True)
+    self.delayDisplay('Test passed')
 
+  def test_PreviewMargins(self):
+    """ The margins previewed on decimated surfaces should be within the reported error estimate of the full
+    resolution margins, here evaluated in closed form for the ellipsoid the profile was tessellated from.
+    """
+    self.delayDisplay("Starting the preview margins test")
+    logic = AblationPlannerLogic()
+    profile = self.testProfile
+    tumorNode, probeNode = self.createEllipsoidTumorAndProfile()
+    probeNodeIDs = logic.placeProbes(probeNode, [([-4, 0, 0], [-4, 0, 100]), ([4, 2, 0], [4, 2, 100])])
+    probePoses = [logic.probePoses[probeNodeID] for probeNodeID in probeNodeIDs]
+
+    previewModel, previewStatistics, errorEstimate = logic.evaluatePreviewMargins(tumorNode, probeNode, probePoses, vertexBudget=300)
+    outputNode, resultTable, lowerMargin, statistics = logic.evaluateMargins(tumorNode, profile, probePoses=probePoses)
+    self.assertLess(previewModel.GetPolyData().GetNumberOfPoints(), outputNode.GetPolyData().GetNumberOfPoints())
+    self.assertGreater(errorEstimate, 0.0)
+
+    # the signed distance changes by at most the distance between two tumor points, so each preview vertex is compared
+    # with the closest full resolution vertex; the tessellation of the ellipsoid adds a fraction of a millimeter
+    tolerance = errorEstimate + 0.3
+    locator = vtk.vtkPointLocator()
+    locator.SetDataSet(outputNode.GetPolyData())
+    locator.BuildLocator()
+    fullPoints = slicer.util.arrayFromModelPoints(outputNode)
+    fullDistances = slicer.util.arrayFromModelPointData(outputNode, "Signed")
+    previewDistances = slicer.util.arrayFromModelPointData(previewModel, "Signed")
+    for point, previewDistance in zip(slicer.util.arrayFromModelPoints(previewModel), previewDistances):
+      closestPointId = locator.FindClosestPoint(point)
+      self.assertLessEqual(abs(previewDistance - fullDistances[closestPointId]),
+        tolerance + np.linalg.norm(point - fullPoints[closestPointId]))
+    # the coarse tumor has fewer vertices, its deepest one can be shallower than the full resolution minimum but not deeper
+    self.assertGreaterEqual(previewStatistics.minimum, statistics.minimum - tolerance)
+    self.assertAlmostEqual(previewStatistics.median, statistics.median, delta=tolerance)
+    self.delayDisplay('Test passed')
 
+  def test_PipelineTaskTiming(self):
+    """ The worker thread step of a pipeline task should be recorded as a child span of the task, whether the task
+    runs synchronously or from the event loop.
+    """
+    self.delayDisplay("Starting the pipeline task timing test")
+    logic = AblationPlannerLogic()
+    def sleepStep(duration, task):
+      time.sleep(duration)
+      return duration
+    def steps():
+      yield ("progress", 0.0, "Waiting")
+      value = yield ("thread", sleepStep, (0.05,))
+      return value
+
+    logic.setTimingEnabled(True)
+    profiler.clear()
+    try:
+      self.assertEqual(PipelineTask(steps()).run(), 0.05)
+      task = PipelineTask(steps())
+      task.start()
+      self.waitForTask(task)
+      self.assertEqual(task.result, 0.05)
+      spans = list(profiler.spans)
+    finally:
+      logic.setTimingEnabled(False)
+      profiler.clear()
+
+    taskSpanIndices = [index for index, span in enumerate(spans) if span["name"] == "steps"]
+    self.assertEqual(len(taskSpanIndices), 2)
+    for index in taskSpanIndices:
+      self.assertIsNone(spans[index]["parent"])
+      stepSpans = [span for span in spans if span["parent"] == index]
+      self.assertEqual([span["name"] for span in stepSpans], ["thread: sleepStep"])
+      self.assertEqual(stepSpans[0]["depth"], 1)
+      self.assertGreaterEqual(stepSpans[0]["duration"], 0.04)
+      self.assertLessEqual(stepSpans[0]["duration"], spans[index]["duration"])
+    self.assertEqual(spans[taskSpanIndices[1]]["attributes"]["status"], "done")
+    self.delayDisplay('Test passed')
+
+  def test_PipelineTaskCancel(self):
+    """ A cancelled task should stop at its current step and remove its temporary nodes, and a margin evaluation
+    superseded by a new one should be cancelled without leaving nodes behind.
+    """
+    self.delayDisplay("Starting the pipeline task cancel test")
+    logic = AblationPlannerLogic()
+    tumorNode, probeNode = self.createEllipsoidTumorAndProfile()
+    def cancelStep(task):
+      task.cancel()
+      task.checkCancelled()
+    def steps():
+      temporaryNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLModelNode", "temporary")
+      try:
+        yield ("progress", 0.0, "Starting")
+        yield ("thread", cancelStep, ())
+        yield ("progress", 0.5, "Not reached")
+      finally:
+        slicer.mrmlScene.RemoveNode(temporaryNode)
+
+    nodeCount = slicer.mrmlScene.GetNumberOfNodes()
+    messages = []
+    task = PipelineTask(steps(), progressCallback=lambda fraction, message: messages.append(message))
+    with self.assertRaises(EvaluationCancelled):
+      task.run()
+    self.assertTrue(task.finished)
+    self.assertTrue(task.cancelled)
+    self.assertEqual(messages, ["Starting"])
+    self.assertEqual(slicer.mrmlScene.GetNumberOfNodes(), nodeCount)
+
+    finishedTasks = []
+    task = PipelineTask(steps(), finishedCallback=finishedTasks.append)
+    task.start()
+    self.waitForTask(task)
+    self.assertEqual(finishedTasks, [task])
+    self.assertIsInstance(task.error, EvaluationCancelled)
+    self.assertEqual(slicer.mrmlScene.GetNumberOfNodes(), nodeCount)
+
+    # the output nodes are created by a first evaluation, later evaluations update them
+    outputNode = logic.evaluateMargins(tumorNode, probeNode)[0]
+    nodeCount = slicer.mrmlScene.GetNumberOfNodes()
+    firstTask = logic.evaluateMarginsAsync(tumorNode, probeNode)
+    secondTask = logic.evaluateMarginsAsync(tumorNode, probeNode)
+    self.assertTrue(firstTask.cancelled)
+    self.assertIs(logic.marginEvaluationTask, secondTask)
+    self.waitForTask(firstTask)
+    self.waitForTask(secondTask)
+    self.assertIsInstance(firstTask.error, EvaluationCancelled)
+    self.assertIsNone(firstTask.result)
+    self.assertIsNone(secondTask.error)
+    self.assertIs(secondTask.result[0], outputNode)
+    self.assertEqual(slicer.mrmlScene.GetNumberOfNodes(), nodeCount)
+    self.delayDisplay('Test passed')
+
+  def test_TrajectoryOptimizer(self):
+    """ The optimized plan of a probe should ablate an off-center tumor with a positive margin, much better than a
+    probe placed at the origin, and be written to the end points with the usual tip/entry ordering.
+    """
+    self.delayDisplay("Starting the trajectory optimizer test")
+    logic = AblationPlannerLogic()
+    tumorPose = np.eye(4)
+    tumorPose[:3,3] = [20, 5, 0]
+    tumorNode = self.createSegmentationFromSurface(transformPolyData(createEllipsoidProfileSurface(EllipsoidProfile((6, 6, 8), 0)), tumorPose), "tumor")
+    profile = self.testProfile
+    entryRegionNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode", "entry region")
+    slicer.util.updateMarkupsControlPointsFromArray(entryRegionNode,
+      np.array([[x, y, 100] for x in range(-40, 41, 10) for y in range(-40, 41, 10)], dtype=float))
+
+    tumorPoints = numpy_support.vtk_to_numpy(getSegmentWorldPolyData(tumorNode).GetPoints().GetData())
+    initialScore = TrajectoryOptimizer.scorePlans(profile, tumorPoints, [[[0, 0, 0]]], [[[0, 0, 100]]])[0][0]
+    endPointsNode, plans = logic.optimizeProbeTrajectories(tumorNode, profile, 1, entryRegionNode, maximumWorkers=1,
+      iterations=15, populationSize=128, randomSeed=0)
+    logging.info("Minimum margin {0:.2f} mm before and {1:.2f} mm after the optimization".format(initialScore, plans[0]["score"]))
+    self.assertGreater(plans[0]["minimumMargin"], 0.0)
+    self.assertGreater(plans[0]["score"], initialScore + 5.0)
+    self.assertEqual(endPointsNode.GetNumberOfControlPoints(), 2)
+    self.assertEqual(endPointsNode.GetNthControlPointLabel(0), "tip-1")
+    tip, entry = logic.endPointPairsFromMarkups(endPointsNode)[0]
+    np.testing.assert_allclose(tip, plans[0]["tips"][0], atol=1e-4)
+    np.testing.assert_allclose(entry, plans[0]["entries"][0], atol=1e-4)
+    self.delayDisplay('Test passed')
+
+  def test_BatchResume(self):
+    """ A batch run again in the same output directory should only evaluate the cases without a summary, and the
+    summary CSV should report the failed cases.
+    """
+    self.delayDisplay("Starting the batch resume test")
+    import csv
+    import tempfile
+    outputDirectory = tempfile.mkdtemp()
+    cases = [{"name": name, "tumor": name + ".seg.nrrd", "endPoints": name + ".mrk.json"} for name in ("case1", "case2", "case3")]
+    points = np.random.RandomState(0).uniform(-10, 10, (50, 3))
+    # case1 was completed by an earlier, interrupted batch
+    BatchProcessing.writeCaseResults(os.path.join(outputDirectory, "case1"), points, np.linspace(-5, 5, 50))
+
+    evaluatedCases = []
+    def caseCommand(case, caseOutputDirectory):
+      # stands in for a Slicer process: case2 succeeds, case3 fails without writing its results
+      evaluatedCases.append(case["name"])
+      if case["name"] == "case3":
+        return [sys.executable, "-c", "import sys; sys.exit(1)"]
+      BatchProcessing.writeCaseResults(caseOutputDirectory, points, np.linspace(-2, 8, 50))
+      return [sys.executable, "-c", "pass"]
+
+    try:
+      summaryPath = BatchProcessing.runBatch(cases, outputDirectory, caseCommand, maximumWorkers=2)
+      self.assertEqual(sorted(evaluatedCases), ["case2", "case3"])
+      with open(summaryPath, newline="") as summaryFile:
+        rows = {row["name"]: row for row in csv.DictReader(summaryFile)}
+      self.assertEqual([rows[name]["status"] for name in ("case1", "case2", "case3")], ["done", "done", "failed"])
+      self.assertAlmostEqual(float(rows["case1"]["minimum"]), -5.0, places=4)
+
+      del evaluatedCases[:]
+      BatchProcessing.runBatch(cases, outputDirectory, caseCommand, maximumWorkers=2)
+      self.assertEqual(evaluatedCases, ["case3"])
+      self.assertTrue(os.path.exists(os.path.join(outputDirectory, "case3", BatchProcessing.LOG_FILE_NAME)))
+
+      del evaluatedCases[:]
+      BatchProcessing.runBatch(cases, outputDirectory, caseCommand, maximumWorkers=1, resume=False)
+      self.assertEqual(evaluatedCases, ["case1", "case2", "case3"])
+    finally:
+      shutil.rmtree(outputDirectory, ignore_errors=True)
+    self.delayDisplay('Test passed')
+
+  def test_VolumeCoverage(self):
+    """ A spherical tumor (8 mm) inside a concentric spherical ablation zone (11 mm) is fully covered, and about
+    (11^3 - 8^3) / (13^3 - 8^3) of its 5 mm margin shell is covered, with both the labelmap and the closed form zone.
+    """
+    self.delayDisplay("Starting the volume coverage test")
+    logic = AblationPlannerLogic()
+    tumorNode = self.createSegmentationFromSurface(createEllipsoidProfileSurface(EllipsoidProfile((8, 8, 8), 0), resolution=64), "tumor")
+    profile = EllipsoidProfile((11, 11, 11), 0)
+    probeNode = self.createSegmentationFromSurface(createEllipsoidProfileSurface(profile, resolution=64), "profile")
+    endPointPairs = [([0, 0, 0], [0, 0, 100])]
+    combinedProbeNode = logic.convertSegmentsToSegment(probeNode, logic.placeProbes(probeNode, endPointPairs))
+
+    expectedShellCoverage = (11**3 - 8**3) / (13**3 - 8**3)
+    for zone, probePoses in [(combinedProbeNode, None), (profile, probePosesFromEndPoints([[0, 0, 0]], [[0, 0, 100]]))]:
+      volumeCoverage = logic.evaluateVolumeCoverage(tumorNode, zone, probePoses, 5.0)
+      logging.info(str(volumeCoverage))
+      self.assertGreater(volumeCoverage.coverageFraction, 0.99)
+      self.assertAlmostEqual(volumeCoverage.tumorVolume, 4 / 3 * np.pi * 8**3, delta=0.05 * 4 / 3 * np.pi * 8**3)
+      self.assertAlmostEqual(volumeCoverage.shellCoverageFraction, expectedShellCoverage, delta=0.05)
+    self.delayDisplay('Test passed')
+
+  def test_ZoneDistanceField(self):
+    """ After the tumor moved, the margins sampled from the cached distance field of the ablation zone should match
+    an exact evaluation.
+    """
+    self.delayDisplay("Starting the zone distance field test")
+    logic = AblationPlannerLogic()
+    tumorNode, probeNode = self.createEllipsoidTumorAndProfile()
+    zoneNode = logic.convertSegmentsToSegment(probeNode, logic.placeProbes(probeNode, [([-4, 0, 0], [-4, 0, 100]), ([4, 0, 0], [4, 0, 100])]))
+    outputNode = logic.evaluateMargins(tumorNode, zoneNode)[0]
+    logic.getZoneDistanceField(zoneNode)
+
+    transformNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLinearTransformNode")
+    tumorNode.SetAndObserveTransformNodeID(transformNode.GetID())
+    for translation in ([3, 0, 0], [0, -2, 5]):
+      tumorToWorld = np.eye(4)
+      tumorToWorld[:3,3] = translation
+      transformNode.SetMatrixTransformToParent(slicer.util.vtkMatrixFromArray(tumorToWorld))
+      startTime = time.perf_counter()
+      lowerMargin, statistics = logic.updateMarginsForTumor(outputNode, tumorNode, zoneNode)
+      runtime = time.perf_counter() - startTime
+      logging.info("Margins of the moved tumor updated in {0:.3f} s".format(runtime))
+      exactDistances = computeSignedDistancesToSurface(getSegmentWorldPolyData(zoneNode), slicer.util.arrayFromModelPoints(outputNode))
+      self.assertLess(np.abs(slicer.util.arrayFromModelPointData(outputNode, "Signed") - exactDistances).max(), 0.5)
+    self.delayDisplay('Test passed')
+
+  def test_ProfileCache(self):
+    """ A profile file is preprocessed once; loading it again in a new scene comes from the profile cache.
+    A cache beyond its maximum size removes its least recently used entries.
+    """
+    self.delayDisplay("Starting the profile cache test")
+    import tempfile
+    cacheDirectory = tempfile.mkdtemp()
+    try:
+      profileNode = self.createSegmentationFromSurface(createEllipsoidProfileSurface(self.testProfile), "profile")
+      profilePath = os.path.join(cacheDirectory, "profile.seg.nrrd")
+      slicer.util.saveNode(profileNode, profilePath)
+      slicer.mrmlScene.Clear(0)
+
+      preprocessedPaths = []
+      for attempt in range(2):
+        logic = AblationPlannerLogic()
+        logic.profileCache = ProfileCache(os.path.join(cacheDirectory, "cache"))
+        def recordedPreprocessProfile(path, *args, preprocessProfile=logic.preprocessProfile):
+          preprocessedPaths.append(path)
+          return preprocessProfile(path, *args)
+        logic.preprocessProfile = recordedPreprocessProfile
+        startTime = time.perf_counter()
+        loadedNode = logic.loadProfile(profilePath, distanceFieldSpacing=1.0)
+        logging.info("Profile loaded in {0:.3f} s".format(time.perf_counter() - startTime))
+        entry = logic.getProfileEntry(loadedNode)
+        self.assertIsNotNone(entry.distanceField)
+        self.assertAlmostEqual(entry.tipOffset, 10.0, delta=1.0)
+        slicer.mrmlScene.Clear(0)
+      # only the first load preprocessed the file, the second one was a cache hit
+      self.assertEqual(preprocessedPaths, [profilePath])
+      self.assertEqual(len(os.listdir(os.path.join(cacheDirectory, "cache"))), 1)
+
+      # room for three entries: the least recently used one is removed by the fourth, get counts as a use
+      cache = ProfileCache(os.path.join(cacheDirectory, "lru"))
+      entry = ProfileEntry(np.zeros((4, 3)), [[0, 1, 2], [0, 2, 3]], [1, 1, 1], 0)
+      cache.put("a", entry)
+      cache.maximumSize = 3 * os.path.getsize(cache.entryPath("a"))
+      cache.put("b", entry)
+      cache.put("c", entry)
+      self.assertIsNotNone(cache.get("a"))
+      cache.put("d", entry)
+      self.assertEqual(sorted(os.listdir(cache.directory)), ["a.npz", "c.npz", "d.npz"])
+      cache.put("e", entry)
+      self.assertEqual(sorted(os.listdir(cache.directory)), ["a.npz", "d.npz", "e.npz"])
+    finally:
+      shutil.rmtree(cacheDirectory, ignore_errors=True)
+    self.delayDisplay('Test passed')
+
+  def test_PlanCache(self):
+    """ Moving the probes back to an evaluated plan should restore its margins and combined zone from the plan cache.
+    """
+    self.delayDisplay("Starting the plan cache test")
+    logic = AblationPlannerLogic()
+    tumorNode, probeNode = self.createEllipsoidTumorAndProfile()
+
+    plans = [[([-4, 0, 0], [-4, 0, 100]), ([4, 0, 0], [4, 0, 100])], [([-4, 2, 0], [-4, 2, 100]), ([4, 0, 0], [4, 0, 100])]]
+    signedDistances = []
+    probeNodeIDs = []
+    for endPointPairs in plans:
+      logic.removeProbes(probeNodeIDs)
+      probeNodeIDs = logic.placeProbes(probeNode, endPointPairs)
+      zoneNode = logic.convertSegmentsToSegment(probeNode, probeNodeIDs)
+      outputNode = logic.evaluateMargins(tumorNode, zoneNode, planKey=logic.getPlanKey(probeNode, endPointPairs, tumorNode))[0]
+      signedDistances.append(slicer.util.arrayFromModelPointData(outputNode, "Signed").copy())
+    self.assertEqual(len(logic.planCache), 2)
+
+    # back to the first plan, with the end points moved by less than the key resolution
+    firstPlan = [(np.array(tip) + 0.02, np.array(entry)) for tip, entry in plans[0]]
+    startTime = time.perf_counter()
+    lowerMargin, statistics, zoneRestored = logic.restorePlanEvaluation(logic.getPlanKey(probeNode, firstPlan, tumorNode), outputNode,
+      zoneNode=zoneNode)
+    runtime = time.perf_counter() - startTime
+    logging.info("Plan evaluation restored in {0:.3f} s".format(runtime))
+    self.assertTrue(zoneRestored)
+    np.testing.assert_allclose(slicer.util.arrayFromModelPointData(outputNode, "Signed"), signedDistances[0])
+    self.assertAlmostEqual(lowerMargin, signedDistances[0].min(), places=4)
+    self.assertGreater(zoneNode.GetSegmentation().GetNumberOfSegments(), 0)
+
+    # evaluating a cached plan exports no surface, and the tumor surface is only hashed again when the tumor changes
+    tumorKey = logic.tumorKey
+    tumorPolyData = logic.getParameterNode().GetNodeReference("TumorModel").GetPolyData()
+    logic.evaluateMargins(tumorNode, zoneNode, planKey=logic.getPlanKey(probeNode, plans[0], tumorNode))
+    self.assertIs(logic.tumorKey, tumorKey)
+    self.assertIs(logic.getParameterNode().GetNodeReference("TumorModel").GetPolyData(), tumorPolyData)
+    np.testing.assert_allclose(slicer.util.arrayFromModelPointData(outputNode, "Signed"), signedDistances[0])
+
+    # margins of an incremental update are restored while dragging, but evaluateMargins evaluates the plan again
+    setModelPointDataArray(outputNode, "Signed", signedDistances[0] + 100)
+    approximateKey = logic.getPlanKey(probeNode, plans[0], tumorNode, resolution=0.2)
+    logic.storePlanEvaluation(approximateKey, outputNode, logic.computeMarginStatistics(outputNode), exact=False)
+    self.assertIsNotNone(logic.restorePlanEvaluation(approximateKey, outputNode))
+    logic.evaluateMargins(tumorNode, zoneNode, planKey=approximateKey)
+    # the zone was restored from its labelmap, its surface is generated again
+    np.testing.assert_allclose(slicer.util.arrayFromModelPointData(outputNode, "Signed"), signedDistances[0], atol=0.5)
+    self.assertTrue(logic.planCache.get(approximateKey).exact)
+    self.delayDisplay('Test passed')
+
+  def test_ProbeNodesUpdatedInPlace(self):
+    """ Placing the probes and their lines again should move the module's nodes in place and leave other line markups alone.
+    """
+    self.delayDisplay("Starting the in-place probe update test")
+    logic = AblationPlannerLogic()
+    probeNode = self.createSegmentationFromSurface(createEllipsoidProfileSurface(self.testProfile), "profile")
+    userLineNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsLineNode", "user line")
+
+    endPointPairs = [([-4, 0, 0], [-4, 0, 100]), ([4, 0, 0], [4, 0, 100])]
+    probeNodeIDs = logic.placeProbes(probeNode, endPointPairs)
+    lineNodeIDs = [lineNode.GetID() for lineNode in logic.updateProbeLines(endPointPairs)]
+    movedPairs = [([-4, 3, 0], [-4, 3, 100]), ([4, 0, 0], [4, 0, 100])]
+    self.assertEqual(logic.placeProbes(probeNode, movedPairs, reuseNodeIDs=probeNodeIDs), probeNodeIDs)
+    self.assertEqual([lineNode.GetID() for lineNode in logic.updateProbeLines(movedPairs)], lineNodeIDs)
+
+    bounds = [0.0] * 6
+    slicer.mrmlScene.GetNodeByID(probeNodeIDs[0]).GetRASBounds(bounds)
+    self.assertAlmostEqual((bounds[2] + bounds[3]) / 2, 3.0, delta=0.5)
+    np.testing.assert_allclose(slicer.util.arrayFromMarkupsControlPoints(slicer.mrmlScene.GetNodeByID(lineNodeIDs[0])),
+      np.array(movedPairs[0], dtype=float))
+
+    logic.updateProbeLines(movedPairs[:1])
+    self.assertIsNone(slicer.mrmlScene.GetNodeByID(lineNodeIDs[1]))
+    self.assertIsNotNone(slicer.mrmlScene.GetNodeByID(userLineNode.GetID()))
+
+    # dragging only moves the probe with a transform, placing it again removes the transform
+    draggedProbeNode = slicer.mrmlScene.GetNodeByID(probeNodeIDs[0])
+    logic.previewProbeDrag(probeNodeIDs[0], [-4, 8, 0], [-4, 8, 100], lineIndex=0)
+    self.assertIsNotNone(draggedProbeNode.GetParentTransformNode())
+    draggedProbeNode.GetRASBounds(bounds)
+    self.assertAlmostEqual((bounds[2] + bounds[3]) / 2, 8.0, delta=0.5)
+    logic.placeProbes(probeNode, [([-4, 8, 0], [-4, 8, 100])], reuseNodeIDs=probeNodeIDs[:1])
+    self.assertIsNone(draggedProbeNode.GetParentTransformNode())
+    draggedProbeNode.GetRASBounds(bounds)
+    self.assertAlmostEqual((bounds[2] + bounds[3]) / 2, 8.0, delta=0.5)
+    self.delayDisplay('Test passed')
+
+  def test_DragPreviewThrottle(self):
+    """ While end points are dragged, their point modified events should be merged into a single pending preview per
+    frame budget, and ending the drag should place the probe and remove its drag transform. Placing the probes again
+    should not observe the end points twice.
+    """
+    self.delayDisplay("Starting the drag preview test")
+    widget = slicer.util.getModuleWidget("AblationPlanner")
+    widget.initializeParameterNode()
+    parameterNode = widget._parameterNode
+    probeNode = self.createSegmentationFromSurface(createEllipsoidProfileSurface(self.testProfile), "profile")
+    endPointsNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode", "end points")
+    slicer.util.updateMarkupsControlPointsFromArray(endPointsNode,
+      np.array([[-4, 0, 0], [-4, 0, 100], [4, 0, 0], [4, 0, 100]], dtype=float))
+    parameterNode.SetParameter("ProfileType", "Segmentation")
+    parameterNode.SetNodeReferenceID("InputSurface", probeNode.GetID())
+    parameterNode.SetNodeReferenceID("EndPoints", endPointsNode.GetID())
+    widget.onProbeButton()
+    # placing the probes again must not observe the end of a drag twice
+    widget.onProbeButton()
+    self.assertEqual(len([observation for observation in widget.Observations if observation[0] is endPointsNode
+      and observation[1] == slicer.vtkMRMLMarkupsNode.PointEndInteractionEvent]), 1)
+    probeNodeIDs = list(widget.probeNodeIDs)
+    self.assertEqual(len(probeNodeIDs), 2)
+    draggedProbe = slicer.mrmlScene.GetNodeByID(probeNodeIDs[0])
+
+    previewTimes = []
+    updateDragPreview = widget.updateDragPreview
+    def recordedUpdateDragPreview():
+      previewTimes.append(time.perf_counter())
+      updateDragPreview()
+    widget.updateDragPreview = recordedUpdateDragPreview
+    try:
+      endPointsNode.InvokeEvent(slicer.vtkMRMLMarkupsNode.PointStartInteractionEvent)
+      self.assertTrue(widget.endPointsDragging)
+      # the previous preview was just shown, the next one waits for the rest of the frame budget
+      widget.lastDragPreviewTime = time.perf_counter()
+      dragStartTime = widget.lastDragPreviewTime
+      for step in range(1, 11):
+        endPointsNode.SetNthControlPointPosition(0, -4, 0.5 * step, 0)
+        endPointsNode.SetNthControlPointPosition(1, -4, 0.5 * step, 100)
+      self.assertTrue(widget.dragPreviewPending)
+      self.assertEqual(previewTimes, [])
+      while widget.dragPreviewPending:
+        self.assertLess(time.perf_counter() - dragStartTime, 5.0)
+        slicer.app.processEvents()
+        time.sleep(0.005)
+      # one preview for all twenty events, of the last position
+      self.assertEqual(len(previewTimes), 1)
+      self.assertGreaterEqual(previewTimes[0] - dragStartTime, widget.dragFrameBudget - 0.005)
+      transformNode = draggedProbe.GetParentTransformNode()
+      self.assertIsNotNone(transformNode)
+      self.assertIsNotNone(transformNode.GetAttribute("AblationPlanner.DragTransform"))
+      np.testing.assert_allclose(slicer.util.arrayFromTransformMatrix(transformNode)[:3,3], [0, 5, 0], atol=1e-6)
+      self.assertIsNone(slicer.mrmlScene.GetNodeByID(probeNodeIDs[1]).GetParentTransformNode())
+
+      # the end of the drag places the probe in place of its transform
+      endPointsNode.InvokeEvent(slicer.vtkMRMLMarkupsNode.PointEndInteractionEvent)
+      self.assertFalse(widget.endPointsDragging)
+      self.assertEqual(widget.probeNodeIDs, probeNodeIDs)
+      self.assertIsNone(draggedProbe.GetParentTransformNode())
+      self.assertEqual([node for node in slicer.util.getNodesByClass("vtkMRMLLinearTransformNode")
+        if node.GetAttribute("AblationPlanner.DragTransform") is not None], [])
+      bounds = [0.0] * 6
+      draggedProbe.GetRASBounds(bounds)
+      self.assertAlmostEqual((bounds[2] + bounds[3]) / 2, 5.0, delta=0.5)
+
+      # points moved outside of a drag are not previewed
+      endPointsNode.SetNthControlPointPosition(0, -4, 6, 0)
+      self.assertFalse(widget.dragPreviewPending)
+    finally:
+      del widget.updateDragPreview
+      widget.logic.removeProbes(widget.probeNodeIDs)
+      widget.probeNodeIDs = []
+    self.delayDisplay('Test passed')
+
+  def test_PlacementUncertainty(self):
+    """ Without placement errors every sample should match the nominal plan; with errors a centered probe should
+    typically lose margin, and the per-vertex probabilities should be stored on the tumor model.
+    """
+    self.delayDisplay("Starting the placement uncertainty test")
+    logic = AblationPlannerLogic()
+    tumorNode = self.createSegmentationFromSurface(createEllipsoidProfileSurface(EllipsoidProfile((6, 6, 6), 0)), "tumor")
+    profile = EllipsoidProfile((15, 15, 20), 10)
+    # the ellipsoid is centered on the tumor
+    endPointPairs = [([0, 0, -10], [0, 0, 100])]
+
+    uncertainty = logic.analyzePlacementUncertainty(tumorNode, profile, endPointPairs, 20, 0.0, 0.0, maximumWorkers=1)[0]
+    np.testing.assert_allclose(uncertainty.minimumMargins, uncertainty.nominalMinimumMargin, atol=1e-6)
+    self.assertEqual(uncertainty.failureProbability(0.0), 0.0)
+
+    startTime = time.perf_counter()
+    uncertainty, tumorModel, tableNode = logic.analyzePlacementUncertainty(tumorNode, profile, endPointPairs, 500, 3.0, 3.0,
+      requiredMargin=5.0, randomSeed=0)
+    logging.info("Placement uncertainty of 500 samples evaluated in {0:.1f} s".format(time.perf_counter() - startTime))
+    self.assertEqual(uncertainty.sampleCount, 500)
+    self.assertLess(np.median(uncertainty.minimumMargins), uncertainty.nominalMinimumMargin)
+    probabilities = slicer.util.arrayFromModelPointData(tumorModel, "InadequateMarginProbability")
+    self.assertEqual(len(probabilities), tumorModel.GetPolyData().GetNumberOfPoints())
+    self.assertTrue(0.0 < probabilities.max() <= 1.0)
+    self.assertEqual(uncertainty.zoneModel, "parametric ellipsoid")
+    self.assertEqual(tableNode.GetNumberOfRows(), 15)
+    self.assertEqual(tableNode.GetCellText(0, 0), "Zone model: parametric ellipsoid")
+
+    # a profile segmentation loaded without a distance field is approximated by its bounding box ellipsoid
+    probeNode = self.createSegmentationFromSurface(createEllipsoidProfileSurface(profile), "profile")
+    uncertainty, tumorModel, tableNode = logic.analyzePlacementUncertainty(tumorNode, probeNode, endPointPairs, 20, 1.0, 1.0,
+      maximumWorkers=1)
+    self.assertIn("approximation", uncertainty.zoneModel)
+    self.assertIn("approximation", tableNode.GetCellText(0, 0))
+    self.delayDisplay('Test passed')
+
+  def test_StructureProximity(self):
+    """ Structures of two segmentation nodes are evaluated in one pass: a structure crossing the zone should report
+    its intrusion, a distant one its gap to the zone.
+    """
+    self.delayDisplay("Starting the organ proximity test")
+    logic = AblationPlannerLogic()
+    profile = EllipsoidProfile((10, 10, 10), 10)
+    # a sphere of 10 mm radius centered at the origin
+    probePoses = probePosesFromEndPoints([[0, 0, -10]], [[0, 0, 100]])
+    zoneNode = self.createSegmentationFromSurface(transformPolyData(createEllipsoidProfileSurface(profile, resolution=64), probePoses[0]), "zone")
+
+    structureNodes = []
+    for nodeName, segments in (("vessels", [("vessel", [15, 0, 0])]), ("bowel", [("bowel", [30, 0, 0]), ("ureter", [0, 0, -40])])):
+      structureNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode", nodeName)
+      for segmentName, center in segments:
+        segmentPose = np.eye(4)
+        segmentPose[:3,3] = center
+        structureNode.AddSegmentFromClosedSurfaceRepresentation(
+          transformPolyData(createEllipsoidProfileSurface(EllipsoidProfile((8, 8, 8), 0), resolution=64), segmentPose), segmentName)
+      structureNodes.append(structureNode)
+    structures = [(structureNode, structureNode.GetSegmentation().GetNthSegmentID(i))
+      for structureNode in structureNodes for i in range(structureNode.GetSegmentation().GetNumberOfSegments())]
+
+    for zone in (profile, zoneNode):
+      proximities, models, tableNode = logic.evaluateStructureProximity(zone, structures, probePoses)
+      self.assertEqual([proximity.name for proximity in proximities], ["vessel", "bowel", "ureter"])
+      # the vessel reaches 3 mm into the zone, the bowel is 12 mm and the ureter 22 mm away
+      self.assertAlmostEqual(proximities[0].minimumDistance, -3.0, delta=0.5)
+      self.assertGreater(proximities[0].intrusionVolume, 0)
+      self.assertAlmostEqual(proximities[1].minimumDistance, 12.0, delta=0.5)
+      self.assertAlmostEqual(proximities[2].minimumDistance, 22.0, delta=0.5)
+      self.assertEqual(proximities[1].intrusionVolume, 0)
+      self.assertEqual(len(models), 3)
+      self.assertEqual(tableNode.GetNumberOfRows(), 3)
+      self.assertIsNotNone(models[0].GetPolyData().GetPointData().GetArray("Signed"))
+    self.delayDisplay('Test passed')
+
+  def test_WatchFolder(self):
+    """ Scans copied into a watched folder should run the pipeline stage by stage: the first one places the probes,
+    the next one only moves the tumor, whose margins then come from the cached zone.
+    """
+    self.delayDisplay("Starting the watch folder test")
+    import tempfile
+    logic = AblationPlannerLogic()
+    parameterNode = logic.getParameterNode()
+    probeNode = self.createSegmentationFromSurface(createEllipsoidProfileSurface(EllipsoidProfile((15, 15, 20), 15)), "profile")
+    tumorNode = self.createSegmentationFromSurface(createEllipsoidProfileSurface(EllipsoidProfile((8, 8, 8), 0)), "tumor")
+    nativePoints = np.array([[0, 0, 0], [50, 0, 0], [0, 40, 0], [10, 10, 30]], dtype=float)
+    nativeFiducials = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode", "native")
+    slicer.util.updateMarkupsControlPointsFromArray(nativeFiducials, nativePoints)
+    newFiducials = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode", "new")
+    endPointsNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode", "end points")
+    slicer.util.updateMarkupsControlPointsFromArray(endPointsNode, np.array([[0, 0, -5], [0, 0, 95]], dtype=float))
+    for role, node in (("InputSurface", probeNode), ("InputTumor", tumorNode), ("NativeFiducials", nativeFiducials),
+                       ("NewFiducials", newFiducials), ("EndPoints", endPointsNode)):
+      parameterNode.SetNodeReferenceID(role, node.GetID())
+
+    watchedDirectory = tempfile.mkdtemp()
+    def copyScan(scanName, shift, withVolume):
+      # written like a scanner export: the fiducials located on the scan and optionally its image
+      scanDirectory = os.path.join(watchedDirectory, scanName)
+      os.makedirs(scanDirectory)
+      scanFiducials = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode")
+      slicer.util.updateMarkupsControlPointsFromArray(scanFiducials, nativePoints + shift)
+      slicer.util.saveNode(scanFiducials, os.path.join(scanDirectory, "fiducials.mrk.json"))
+      slicer.mrmlScene.RemoveNode(scanFiducials)
+      if withVolume:
+        volumeNode = slicer.util.addVolumeFromArray(np.zeros((8, 8, 8), dtype=np.int16))
+        slicer.util.saveNode(volumeNode, os.path.join(scanDirectory, "scan.nrrd"))
+        slicer.mrmlScene.RemoveNode(volumeNode)
+
+    stages = []
+    try:
+      logic.startWatching(watchedDirectory, stageCallback=lambda series, stage, result: stages.append(stage),
+        settleTime=0, pollInterval=None)
+      self.assertIsNone(logic.processNewSeries(synchronous=True))
+
+      copyScan("scan1", [2, 0, 0], True)
+      task = logic.processNewSeries(synchronous=True)
+      self.assertIsNone(task.error)
+      self.assertEqual(stages, ["registration", "placement", "union", "margins", "volume"])
+      transformNode = tumorNode.GetParentTransformNode()
+      np.testing.assert_allclose(slicer.util.arrayFromTransformMatrix(transformNode)[:3,3], [2, 0, 0], atol=1e-6)
+      self.assertIsNotNone(parameterNode.GetNodeReference("IntraopVolume"))
+      probeNodeIDs = list(logic.watchProbeNodeIDs)
+      self.assertEqual(len(probeNodeIDs), 1)
+
+      del stages[:]
+      copyScan("scan2", [4, 0, 0], False)
+      statistics = logic.processNewSeries(synchronous=True).result
+      self.assertEqual(stages, ["registration", "placement", "union", "margins"])
+      # the probes stayed put
+      self.assertEqual(logic.watchProbeNodeIDs, probeNodeIDs)
+      fullMinimum = logic.evaluateMargins(tumorNode, parameterNode.GetNodeReference("combinedProbeNode"))[2]
+      self.assertAlmostEqual(statistics.minimum, fullMinimum, delta=0.5)
+
+      # the combined zone was rebuilt for other end points (e.g. a probe was dragged and moved back): it is not sampled
+      otherEndPointPairs = [([20, 0, -5], [20, 0, 95])]
+      otherProbeNodeIDs = logic.placeProbes(probeNode, otherEndPointPairs)
+      logic.setCombinedZone(logic.convertSegmentsToSegment(probeNode, otherProbeNodeIDs), logic.getZoneKey(probeNode, otherEndPointPairs))
+      logic.removeProbes(otherProbeNodeIDs)
+      del stages[:]
+      copyScan("scan3", [6, 0, 0], False)
+      statistics = logic.processNewSeries(synchronous=True).result
+      self.assertEqual(stages, ["registration", "placement", "union", "margins"])
+      zoneNode = logic.getCombinedZone(logic.getZoneKey(probeNode, logic.endPointPairsFromMarkups(endPointsNode)))
+      self.assertIsNotNone(zoneNode)
+      fullMinimum = logic.evaluateMargins(tumorNode, zoneNode)[2]
+      self.assertAlmostEqual(statistics.minimum, fullMinimum, delta=0.5)
+    finally:
+      logic.stopWatching()
+      shutil.rmtree(watchedDirectory, ignore_errors=True)
+    self.delayDisplay('Test passed')
+
+  def test_TumorRegistration(self):
+    """ The closed form registration should recover a known transform and reuse its transform node.
+    """
+    self.delayDisplay("Starting the tumor registration test")
+    logic = AblationPlannerLogic()
+    nativePoints = np.array([[0, 0, 0], [50, 0, 0], [0, 40, 0], [10, 10, 30]], dtype=float)
+    nativeToNew = np.eye(4)
+    nativeToNew[:3,:3] = rotationMatricesFromVectors([0, 0, 1], [np.array([0, 1, 1]) / np.sqrt(2)])[0]
+    nativeToNew[:3,3] = [10, -20, 5]
+    newPoints = nativePoints.dot(nativeToNew[:3,:3].T) + nativeToNew[:3,3]
+    nativeFiducials = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode", "native")
+    newFiducials = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode", "new")
+    slicer.util.updateMarkupsControlPointsFromArray(nativeFiducials, nativePoints)
+    slicer.util.updateMarkupsControlPointsFromArray(newFiducials, newPoints)
+
+    transformNode, errors, rmsError = logic.updateTumorRegistration(nativeFiducials, newFiducials)
+    np.testing.assert_allclose(slicer.util.arrayFromTransformMatrix(transformNode), nativeToNew, atol=1e-6)
+    self.assertLess(rmsError, 1e-6)
+
+    newFiducials.SetNthControlPointPosition(3, *(newPoints[3] + [0, 0, 2]))
+    movedTransformNode, errors, rmsError = logic.updateTumorRegistration(nativeFiducials, newFiducials)
+    self.assertIs(movedTransformNode, transformNode)
+    self.assertEqual(len(errors), 4)
+    self.assertGreater(rmsError, 0.1)
     self.delayDisplay('Test passed')
@@ -0,0 +1,103 @@
+import csv
+import glob
+import json
+import os
+import subprocess
+import concurrent.futures
+
+import numpy as np
+
+from .MarginStatistics import computeMarginStatistics
+from .SurfaceDistanceFiles import surfaceDistanceArrays
+
+#
+# Headless batch processing
+#
+# Each case (a tumor segmentation, an end points markups file and an ablation profile) is evaluated
+# in its own Slicer process and writes its results to <outputDirectory>/<case name>/. The summary
+# file is written last, so a case with a summary is complete and is skipped when a batch is resumed.
+#
+
+SUMMARY_FILE_NAME = "summary.json"
+DISTANCES_FILE_NAME = "distances.npz"
+LOG_FILE_NAME = "log.txt"
+BATCH_SUMMARY_FILE_NAME = "summary.csv"
+SUMMARY_FIELDS = ["minimum", "mean", "median", "percentile20", "percentile80", "numberOfVertices", "surfaceArea"]
+
+def findCases(inputDirectory, tumorPattern="*.seg.nrrd", endPointsPattern="*.mrk.json"):
+    """Return one case per subdirectory of inputDirectory that contains exactly one tumor segmentation
+    and one end points file. Cases are dictionaries with name, tumor and endPoints entries."""
+    cases = []
+    for caseDirectory in sorted(glob.glob(os.path.join(inputDirectory, "*"))):
+      if not os.path.isdir(caseDirectory):
+        continue
+      tumorFiles = glob.glob(os.path.join(caseDirectory, tumorPattern))
+      endPointsFiles = glob.glob(os.path.join(caseDirectory, endPointsPattern))
+      if len(tumorFiles) != 1 or len(endPointsFiles) != 1:
+        continue
+      cases.append({"name": os.path.basename(caseDirectory), "tumor": tumorFiles[0], "endPoints": endPointsFiles[0]})
+    return cases
+
+def isCaseComplete(caseOutputDirectory):
+    return os.path.exists(os.path.join(caseOutputDirectory, SUMMARY_FILE_NAME))
+
+def _writeAtomically(path, writeFunction):
+    # write to a temporary file first, so that an interrupted case never leaves a partial result behind
+    temporaryPath = path + ".partial"
+    with open(temporaryPath, "wb") as temporaryFile:
+      writeFunction(temporaryFile)
+    os.replace(temporaryPath, path)
+
+def writeCaseResults(caseOutputDirectory, points, signedDistances, caseInfo=None, vertexAreas=None):
+    """Write the per-vertex distances and the summary of a case (area-weighted if vertexAreas are given).
+    Returns the summary."""
+    os.makedirs(caseOutputDirectory, exist_ok=True)
+    signedDistances = np.asarray(signedDistances, dtype=np.float32).ravel()
+    _writeAtomically(os.path.join(caseOutputDirectory, DISTANCES_FILE_NAME),
+      lambda f: np.savez_compressed(f, **surfaceDistanceArrays(points, signedDistances)))
+    summary = dict(caseInfo or {})
+    summary.update(computeMarginStatistics(signedDistances, vertexAreas).toDict())
+    _writeAtomically(os.path.join(caseOutputDirectory, SUMMARY_FILE_NAME),
+      lambda f: f.write(json.dumps(summary, indent=2).encode()))
+    return summary
+
+def writeBatchSummary(outputDirectory, cases):
+    """Collect the summaries of all cases into one CSV file (one row per case, empty if it failed)."""
+    path = os.path.join(outputDirectory, BATCH_SUMMARY_FILE_NAME)
+    with open(path, "w", newline="") as summaryFile:
+      writer = csv.writer(summaryFile)
+      writer.writerow(["name", "status"] + SUMMARY_FIELDS)
+      for case in cases:
+        summaryPath = os.path.join(outputDirectory, case["name"], SUMMARY_FILE_NAME)
+        if not os.path.exists(summaryPath):
+          writer.writerow([case["name"], "failed"] + [""] * len(SUMMARY_FIELDS))
+          continue
+        with open(summaryPath) as f:
+          summary = json.load(f)
+        writer.writerow([case["name"], "done"] + [summary[field] for field in SUMMARY_FIELDS])
+    return path
+
+def runBatch(cases, outputDirectory, caseCommand, maximumWorkers=2, resume=True, timeout=None):
+    """Evaluate cases in parallel, at most maximumWorkers at a time.
+    caseCommand(case, caseOutputDirectory) returns the command line that evaluates one case and writes its
+    results with writeCaseResults; its output goes to the log file of the case.
+    With resume, cases that already have a summary are not evaluated again.
+    Returns the path of the batch summary CSV file.
+    """
+    os.makedirs(outputDirectory, exist_ok=True)
+
+    def runCase(case):
+      caseOutputDirectory = os.path.join(outputDirectory, case["name"])
+      if resume and isCaseComplete(caseOutputDirectory):
+        return
+      os.makedirs(caseOutputDirectory, exist_ok=True)
+      with open(os.path.join(caseOutputDirectory, LOG_FILE_NAME), "w") as logFile:
+        try:
+          subprocess.run(caseCommand(case, caseOutputDirectory), stdout=logFile, stderr=subprocess.STDOUT, timeout=timeout)
+        except subprocess.TimeoutExpired:
+          logFile.write("\nCase timed out after {0} s\n".format(timeout))
+
+    # the cases run in their own processes, threads only wait for them
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, maximumWorkers)) as executor:
+      list(executor.map(runCase, cases))
+    return writeBatchSummary(outputDirectory, cases)
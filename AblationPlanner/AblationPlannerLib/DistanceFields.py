@@ -0,0 +1,57 @@
+import numpy as np
+
+#
+# Sampled signed distance fields
+#
+# The signed distance to a surface (negative inside) stored on an axis aligned grid, so that it is computed
+# once and then queried at any set of points by trilinear interpolation, e.g. the vertices of a tumor that
+# keeps being re-registered while the ablation zone stays where it is.
+#
+
+def gridPoints(origin, spacing, dimensions):
+    """World coordinates (N,3) of the points of an axis aligned grid with isotropic spacing, in the order of a
+    (k,j,i) array with the given (i,j,k) dimensions (i fastest)."""
+    indices = np.indices(tuple(dimensions)[::-1]).reshape(3, -1)[::-1].T
+    return np.asarray(origin, dtype=float) + spacing * indices
+
+class SignedDistanceField:
+    """Signed distances values[k,j,i] at the grid points origin + spacing * (i,j,k)."""
+
+    def __init__(self, origin, spacing, values):
+      self.origin = np.asarray(origin, dtype=float).reshape(3)
+      self.spacing = float(spacing)
+      self.values = np.asarray(values, dtype=np.float32)
+      if self.values.ndim != 3 or min(self.values.shape) < 2:
+        raise ValueError("the distance field needs at least 2 grid points along each axis")
+
+    def sample(self, points):
+      """Trilinear interpolation of the field at world points (N,3).
+      Outside of the grid, the value at the nearest point of the grid is increased by the distance to that point,
+      which overestimates the distance to the surface there; the grid should cover the distances of interest.
+      """
+      points = np.asarray(points, dtype=float).reshape(-1, 3)
+      maximumIndex = np.array(self.values.shape[::-1]) - 1
+      continuousIndex = np.clip((points - self.origin) / self.spacing, 0, maximumIndex)
+      outsideDistance = np.linalg.norm(points - (self.origin + self.spacing * continuousIndex), axis=1)
+      lowerIndex = np.minimum(continuousIndex.astype(np.intp), maximumIndex - 1)
+      fx, fy, fz = (continuousIndex - lowerIndex).T
+      i, j, k = lowerIndex.T
+      v = self.values
+      lowerSlice = (v[k,j,i] * (1-fx) + v[k,j,i+1] * fx) * (1-fy) + (v[k,j+1,i] * (1-fx) + v[k,j+1,i+1] * fx) * fy
+      upperSlice = (v[k+1,j,i] * (1-fx) + v[k+1,j,i+1] * fx) * (1-fy) + (v[k+1,j+1,i] * (1-fx) + v[k+1,j+1,i+1] * fx) * fy
+      return lowerSlice * (1-fz) + upperSlice * fz + outsideDistance
+
+    def signedDistancesForPlans(self, points, planProbePoses):
+      """Union of copies of the field placed at planProbePoses (P,M,4,4 probe to world matrices), the field being
+      given in the probe frame (like a profile entry). Returns the (P,N) signed distances of world points (N,3),
+      the same as ParametricZones.EllipsoidProfile.signedDistancesForPlans.
+      """
+      points = np.asarray(points, dtype=float).reshape(-1, 3)
+      planProbePoses = np.asarray(planProbePoses, dtype=float)
+      signedDistances = np.full((len(planProbePoses), len(points)), np.inf)
+      for probeIndex in range(planProbePoses.shape[1]):
+        rotations = planProbePoses[:, probeIndex, :3, :3]
+        translations = planProbePoses[:, probeIndex, :3, 3]
+        localPoints = np.matmul(points[np.newaxis] - translations[:, np.newaxis], rotations)
+        np.minimum(signedDistances, self.sample(localPoints.reshape(-1, 3)).reshape(signedDistances.shape), out=signedDistances)
+      return signedDistances
@@ -0,0 +1,75 @@
+import numpy as np
+
+#
+# Margin statistics
+#
+# Tumor surface meshes are not uniformly dense, so every vertex is weighted by the surface area it
+# represents (a third of the area of each triangle it belongs to). Statistics are computed on the
+# signed distances: negative inside the ablation zone, so the margin of a vertex is -signed.
+#
+
+def vertexAreas(points, triangles):
+    """Return the surface area represented by each vertex. points: (N,3), triangles: (T,3) point indices."""
+    points = np.asarray(points, dtype=float)
+    triangles = np.asarray(triangles, dtype=np.int64).reshape(-1, 3)
+    edge1 = points[triangles[:,1]] - points[triangles[:,0]]
+    edge2 = points[triangles[:,2]] - points[triangles[:,0]]
+    triangleAreas = 0.5 * np.linalg.norm(np.cross(edge1, edge2), axis=1)
+    return np.bincount(triangles.ravel(), weights=np.repeat(triangleAreas / 3.0, 3), minlength=len(points))
+
+def weightedQuantiles(values, weights, quantiles):
+    """Quantiles of values weighted by weights, interpolated between the weight midpoints of sorted values."""
+    order = np.argsort(values)
+    sortedValues = values[order]
+    sortedWeights = weights[order]
+    cumulativeWeights = np.cumsum(sortedWeights) - 0.5 * sortedWeights
+    return np.interp(np.asarray(quantiles) * sortedWeights.sum(), cumulativeWeights, sortedValues)
+
+class MarginStatistics:
+    """Area-weighted statistics of the signed distances from the tumor surface to the ablation zone (mm).
+    fractionBelow[i] is the fraction of the tumor surface with a margin smaller than marginThresholds[i]
+    (0 mm: not ablated). histogramAreas[i] is the surface area (mm2, or the number of vertices if no areas
+    were given) with signed distances between histogramEdges[i] and histogramEdges[i+1].
+    """
+
+    __slots__ = ("minimum", "maximum", "mean", "median", "percentile20", "percentile80", "surfaceArea",
+                 "numberOfVertices", "marginThresholds", "fractionBelow", "histogramEdges", "histogramAreas")
+
+    def toDict(self):
+      result = {}
+      for name in self.__slots__:
+        value = getattr(self, name)
+        result[name] = value.tolist() if isinstance(value, np.ndarray) else value
+      return result
+
+    def __repr__(self):
+      return "MarginStatistics(minimum={0:.2f}, median={1:.2f}, {2})".format(self.minimum, self.median,
+        ", ".join("below {0:g} mm: {1:.1%}".format(threshold, fraction) for threshold, fraction in zip(self.marginThresholds, self.fractionBelow)))
+
+def computeMarginStatistics(signedDistances, areas=None, marginThresholds=(0, 5, 10), histogramBinWidth=1.0):
+    """Return the MarginStatistics of signedDistances (N,), weighted by the vertex areas (N,) if given."""
+    signedDistances = np.asarray(signedDistances).ravel()
+    if signedDistances.size == 0:
+      raise ValueError("no distances to summarize")
+    weights = np.ones(signedDistances.size) if areas is None else np.asarray(areas, dtype=float).ravel()
+    totalWeight = weights.sum()
+
+    statistics = MarginStatistics()
+    statistics.minimum = float(signedDistances.min())
+    statistics.maximum = float(signedDistances.max())
+    statistics.mean = float(np.dot(signedDistances, weights) / totalWeight)
+    statistics.median, statistics.percentile20, statistics.percentile80 = (float(value) for value in
+      weightedQuantiles(signedDistances, weights, [0.5, 0.2, 0.8]))
+    statistics.surfaceArea = float(totalWeight) if areas is not None else None
+    statistics.numberOfVertices = int(signedDistances.size)
+
+    statistics.marginThresholds = np.asarray(marginThresholds, dtype=np.float32)
+    # margin below a threshold = signed distance above -threshold
+    statistics.fractionBelow = np.array([weights[signedDistances > -threshold].sum() / totalWeight
+      for threshold in statistics.marginThresholds], dtype=np.float32)
+
+    firstEdge = np.floor(statistics.minimum / histogramBinWidth) * histogramBinWidth
+    binCount = max(int(np.ceil((statistics.maximum - firstEdge) / histogramBinWidth)), 1)
+    statistics.histogramEdges = (firstEdge + histogramBinWidth * np.arange(binCount + 1)).astype(np.float32)
+    statistics.histogramAreas = np.histogram(signedDistances, statistics.histogramEdges, weights=weights)[0].astype(np.float32)
+    return statistics
@@ -0,0 +1,100 @@
+import numpy as np
+
+#
+# Closed form ablation zone geometry
+#
+
+class EllipsoidProfile(object):
+  """Parametric ablation profile: an ellipsoid around the probe shaft.
+  The probe frame is the one of the profile segmentations: the tip is at the origin and the shaft points
+  towards -z (the entry point). semiAxes are the (x, y, z) semi-axes in mm, z being along the shaft, and
+  tipOffset is the distance from the tip to the center of the ellipsoid, measured along the shaft.
+  """
+
+  def __init__(self, semiAxes, tipOffset=0.0):
+    semiAxes = [float(semiAxis) for semiAxis in semiAxes]
+    if len(semiAxes) != 3 or min(semiAxes) <= 0:
+      raise ValueError("an ellipsoid profile needs three positive semi-axes, got {0}".format(semiAxes))
+    self.semiAxes = tuple(semiAxes)
+    self.tipOffset = float(tipOffset)
+
+  def __repr__(self):
+    return "EllipsoidProfile(semiAxes={0}, tipOffset={1})".format(self.semiAxes, self.tipOffset)
+
+  @classmethod
+  def fromBounds(cls, bounds):
+    """Approximate a profile surface given in the probe frame by the ellipsoid inscribed in its bounding box
+    (xmin, xmax, ymin, ymax, zmin, zmax). The ellipsoid is assumed to be centered on the shaft.
+    """
+    bounds = np.asarray(bounds, dtype=float)
+    semiAxes = (bounds[1::2] - bounds[0::2]) / 2.0
+    return cls(semiAxes, -(bounds[4] + bounds[5]) / 2.0)
+
+  def center(self):
+    """Center of the ellipsoid in the probe frame."""
+    return np.array([0.0, 0.0, -self.tipOffset])
+
+  def worldBounds(self, probePoses):
+    """Bounds (xmin, xmax, ymin, ymax, zmin, zmax) in world coordinates of the ellipsoids of the probes placed at
+    probePoses (M,4,4): the union of the transformed bounding boxes of the ellipsoids."""
+    corners = self.center() + np.array(self.semiAxes) * np.array([[x, y, z] for x in (-1, 1) for y in (-1, 1) for z in (-1, 1)])
+    probePoses = np.asarray(probePoses, dtype=float).reshape(-1, 4, 4)
+    worldCorners = np.matmul(corners, probePoses[:, :3, :3].transpose(0, 2, 1)) + probePoses[:, np.newaxis, :3, 3]
+    worldCorners = worldCorners.reshape(-1, 3)
+    return np.stack([worldCorners.min(axis=0), worldCorners.max(axis=0)], axis=1).ravel()
+
+  def signedDistances(self, points, probePoses):
+    """Signed distance (negative inside) of world points (N,3) to the union of the ellipsoids of the probes
+    placed at probePoses (M,4,4 probe to world matrices). The union is the per-point minimum over the probes.
+    """
+    return self.signedDistancesForPlans(points, np.asarray(probePoses, dtype=float).reshape(1, -1, 4, 4))[0]
+
+  def signedDistancesForPlans(self, points, planProbePoses):
+    """Evaluate many plans at once: planProbePoses is (P,M,4,4), M probes per plan.
+    Returns the (P,N) signed distances of the points to the union of the ellipsoids of each plan.
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 3)
+    planProbePoses = np.asarray(planProbePoses, dtype=float)
+    signedDistances = np.full((len(planProbePoses), len(points)), np.inf)
+    for probeIndex in range(planProbePoses.shape[1]):
+      rotations = planProbePoses[:, probeIndex, :3, :3]
+      translations = planProbePoses[:, probeIndex, :3, 3]
+      # rows of (p - t) @ R are R^T (p - t), for all plans at once
+      localPoints = np.matmul(points[np.newaxis] - translations[:, np.newaxis], rotations) - self.center()
+      probeDistances = ellipsoidSignedDistances(localPoints.reshape(-1, 3), self.semiAxes).reshape(signedDistances.shape)
+      np.minimum(signedDistances, probeDistances, out=signedDistances)
+    return signedDistances
+
+def ellipsoidSignedDistances(points, semiAxes, tolerance=1e-10, maximumIterations=50):
+    """Signed distance (negative inside) of points (N,3) to the axis aligned ellipsoid centered at the origin.
+    The closest point x_i = a_i^2 y_i / (t + a_i^2) is found by solving sum((a_i y_i / (t + a_i^2))^2) = 1 for t
+    with Newton iterations started on the side where the (convex, decreasing) function is positive, so the
+    iteration converges monotonically. Only points that have not converged yet are iterated.
+    """
+    semiAxes = np.asarray(semiAxes, dtype=float)
+    squaredSemiAxes = semiAxes * semiAxes
+    y = np.abs(np.asarray(points, dtype=float).reshape(-1, 3))
+    inside = np.sum((y / semiAxes) ** 2, axis=1) <= 1.0
+    # points on a symmetry plane make the root bracket degenerate, move them by a negligible amount
+    clampedY = np.maximum(y, 1e-7 * semiAxes.max())
+    scaledY = semiAxes * clampedY
+
+    # starting points where the function is known to be positive: inside the term of the smallest axis is 1,
+    # outside sum(...) >= (a_min |y| / (t + a_max^2))^2 >= 1
+    smallestAxis = semiAxes.argmin()
+    outsideStart = np.maximum(semiAxes.min() * np.linalg.norm(y, axis=1) - squaredSemiAxes.max(), 0.0)
+    t = np.where(inside, -squaredSemiAxes[smallestAxis] + scaledY[:, smallestAxis], outsideStart)
+    active = np.arange(len(t))
+    for iteration in range(maximumIterations):
+        denominators = t[active, np.newaxis] + squaredSemiAxes
+        ratios = (scaledY[active] / denominators) ** 2
+        residuals = np.sum(ratios, axis=1) - 1.0
+        notConverged = np.abs(residuals) >= tolerance
+        active = active[notConverged]
+        if len(active) == 0:
+            break
+        t[active] += residuals[notConverged] / (2.0 * np.sum(ratios[notConverged] / denominators[notConverged], axis=1))
+
+    closestPoints = squaredSemiAxes * clampedY / (t[:, np.newaxis] + squaredSemiAxes)
+    distances = np.linalg.norm(closestPoints - y, axis=1)
+    return np.where(inside, -distances, distances)
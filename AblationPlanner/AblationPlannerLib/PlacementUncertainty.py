@@ -0,0 +1,130 @@
+import numpy as np
+
+from .ProbePoses import probePosesFromEndPoints
+
+#
+# Probe placement uncertainty
+#
+# Probes rarely land exactly on the planned tip and entry points. The robustness of a plan is estimated by
+# Monte Carlo sampling: every sample perturbs the tip and entry of each probe by a random error, and the
+# margins of the perturbed plan are evaluated with a vectorized distance backend (the closed form distances
+# of an EllipsoidProfile or a SignedDistanceField of the profile). Samples are evaluated in batches, which
+# can be sent to worker processes like the batches of the trajectory search.
+#
+
+ERROR_DISTRIBUTIONS = ("normal", "uniform")
+
+def sampleEndPointErrors(sampleCount, probeCount, error, distribution="normal", randomState=None):
+    """Return (sampleCount, probeCount, 3) random placement errors (mm).
+    "normal": isotropic Gaussian errors with a standard deviation of error along each axis;
+    "uniform": errors uniformly distributed in a ball of radius error.
+    """
+    if randomState is None:
+      randomState = np.random.RandomState()
+    shape = (sampleCount, probeCount, 3)
+    if distribution == "normal":
+      return error * randomState.standard_normal(shape)
+    if distribution == "uniform":
+      directions = randomState.standard_normal(shape)
+      directions /= np.maximum(np.linalg.norm(directions, axis=2, keepdims=True), 1e-12)
+      radii = error * np.cbrt(randomState.uniform(size=shape[:2] + (1,)))
+      return directions * radii
+    raise ValueError("Unknown error distribution: " + str(distribution))
+
+def evaluatePlanSamples(profile, tumorPoints, tips, entries, requiredMargin=5.0):
+    """Evaluate perturbed plans: tips, entries are (S,M,3) arrays. profile is anything with a
+    signedDistancesForPlans(points, planProbePoses) method. Returns the minimum margin (S,) and the coverage (S,)
+    (fraction of tumor vertices with at least requiredMargin of margin) of each sample, and the number of samples
+    (N,) in which each tumor vertex has less than requiredMargin of margin.
+    """
+    tips = np.asarray(tips, dtype=float)
+    entries = np.asarray(entries, dtype=float)
+    sampleCount, probeCount = tips.shape[:2]
+    planProbePoses = probePosesFromEndPoints(tips.reshape(-1, 3), entries.reshape(-1, 3)).reshape(sampleCount, probeCount, 4, 4)
+    signedDistances = profile.signedDistancesForPlans(tumorPoints, planProbePoses)
+    inadequate = signedDistances > -requiredMargin
+    return -signedDistances.max(axis=1), 1.0 - inadequate.mean(axis=1), inadequate.sum(axis=0)
+
+# Inputs shared by all batches of a worker process, set once by initializeWorker
+_workerInputs = None
+
+def initializeWorker(profile, tumorPoints, requiredMargin):
+    global _workerInputs
+    _workerInputs = (profile, tumorPoints, requiredMargin)
+
+def evaluateSampleBatch(tipsAndEntries):
+    """Evaluate a (tips, entries) batch of samples with the inputs given to initializeWorker."""
+    profile, tumorPoints, requiredMargin = _workerInputs
+    return evaluatePlanSamples(profile, tumorPoints, tipsAndEntries[0], tipsAndEntries[1], requiredMargin)
+
+class PlacementUncertainty:
+    """Distribution of the margins of a plan under placement errors: the minimumMargins and coverages (S,) of the
+    samples, the probability of inadequate margin (less than requiredMargin) of each tumor vertex (N,) and the
+    nominal (unperturbed) minimum margin and coverage. zoneModel describes how the ablation zones were evaluated
+    (set by the caller, None if unknown).
+    """
+
+    __slots__ = ("minimumMargins", "coverages", "inadequateMarginProbability", "nominalMinimumMargin", "nominalCoverage",
+                 "requiredMargin", "tipError", "entryError", "distribution", "zoneModel")
+
+    @property
+    def sampleCount(self):
+      return len(self.minimumMargins)
+
+    def minimumMarginPercentiles(self, percentiles=(5, 50, 95)):
+      return np.percentile(self.minimumMargins, percentiles)
+
+    def coveragePercentiles(self, percentiles=(5, 50, 95)):
+      return np.percentile(self.coverages, percentiles)
+
+    def failureProbability(self, margin=0.0):
+      """Fraction of samples whose minimum margin is below margin (by default: part of the tumor is not ablated)."""
+      return float(np.mean(self.minimumMargins < margin))
+
+    def __repr__(self):
+      lower, median, upper = self.minimumMarginPercentiles()
+      return "PlacementUncertainty({0} samples, minimum margin {1:.2f} mm nominal, median {2:.2f} mm, 5-95%: {3:.2f} to {4:.2f} mm)".format(
+        self.sampleCount, self.nominalMinimumMargin, median, lower, upper)
+
+def analyzePlacementUncertainty(profile, tumorPoints, tips, entries, sampleCount=500, tipError=2.0, entryError=2.0,
+                                distribution="normal", requiredMargin=5.0, mapBatches=None, batchSize=32, randomSeed=None):
+    """Monte Carlo estimate of the margins of a plan (tips, entries: (M,3) planned positions) when every tip and entry
+    is displaced by an error (mm) drawn from distribution (see sampleEndPointErrors).
+    mapBatches(function, batches) evaluates evaluateSampleBatch on each batch; it defaults to a serial map after
+    calling initializeWorker in this process (pass e.g. a process pool executor's map instead).
+    Returns a PlacementUncertainty.
+    """
+    tumorPoints = np.asarray(tumorPoints, dtype=float).reshape(-1, 3)
+    tips = np.asarray(tips, dtype=float).reshape(-1, 3)
+    entries = np.asarray(entries, dtype=float).reshape(-1, 3)
+    if len(tips) == 0 or len(tips) != len(entries):
+      raise ValueError("one entry point is required for each probe tip")
+    if sampleCount < 1:
+      raise ValueError("at least one sample is required")
+    randomState = np.random.RandomState(randomSeed)
+    sampledTips = tips + sampleEndPointErrors(sampleCount, len(tips), tipError, distribution, randomState)
+    sampledEntries = entries + sampleEndPointErrors(sampleCount, len(tips), entryError, distribution, randomState)
+    if mapBatches is None:
+      initializeWorker(profile, tumorPoints, requiredMargin)
+      mapBatches = map
+
+    batches = [(sampledTips[start:start+batchSize], sampledEntries[start:start+batchSize]) for start in range(0, sampleCount, batchSize)]
+    minimumMargins, coverages, inadequateCounts = [], [], np.zeros(len(tumorPoints))
+    for batchMinimumMargins, batchCoverages, batchInadequateCounts in mapBatches(evaluateSampleBatch, batches):
+      minimumMargins.append(batchMinimumMargins)
+      coverages.append(batchCoverages)
+      inadequateCounts += batchInadequateCounts
+
+    uncertainty = PlacementUncertainty()
+    uncertainty.minimumMargins = np.concatenate(minimumMargins)
+    uncertainty.coverages = np.concatenate(coverages)
+    uncertainty.inadequateMarginProbability = (inadequateCounts / sampleCount).astype(np.float32)
+    nominalMinimumMargins, nominalCoverages, _ = evaluatePlanSamples(profile, tumorPoints, tips[np.newaxis], entries[np.newaxis], requiredMargin)
+    uncertainty.nominalMinimumMargin = float(nominalMinimumMargins[0])
+    uncertainty.nominalCoverage = float(nominalCoverages[0])
+    uncertainty.requiredMargin = float(requiredMargin)
+    uncertainty.tipError = float(tipError)
+    uncertainty.entryError = float(entryError)
+    uncertainty.distribution = distribution
+    uncertainty.zoneModel = None
+    return uncertainty
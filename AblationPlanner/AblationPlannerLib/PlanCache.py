@@ -0,0 +1,79 @@
+import collections
+import hashlib
+
+import numpy as np
+
+#
+# Plan evaluation cache
+#
+# Operators often move a probe and move it back. A plan is identified by its ablation profile, its end points
+# (quantized, so that a probe dropped back within a fraction of a millimeter is the same plan) and the tumor
+# surface in world coordinates, so its evaluation can be kept and restored instead of computed again.
+#
+
+def quantizeEndPoints(endPointPairs, resolution=0.1):
+    """Return the (tip, entry) pairs (M,2,3) rounded to integer multiples of resolution (mm)."""
+    return np.round(np.asarray(endPointPairs, dtype=float).reshape(-1, 2, 3) / resolution).astype(np.int64)
+
+def pointsDigest(points):
+    """Hex digest of surface points (N,3), e.g. the tumor surface in world coordinates."""
+    return hashlib.sha1(np.ascontiguousarray(points, dtype=np.float32).tobytes()).hexdigest()
+
+def planKey(profileKey, endPointPairs, tumorKey, resolution=0.1):
+    """Hex digest identifying a plan: profileKey (a string or an array describing the profile), the end point pairs
+    quantized to resolution (mm) and tumorKey, the tumor surface points (N,3) in world coordinates or their pointsDigest."""
+    digest = hashlib.sha1()
+    tumorKey = tumorKey if isinstance(tumorKey, str) else np.asarray(tumorKey, dtype=np.float32)
+    for part in (profileKey, quantizeEndPoints(endPointPairs, resolution), tumorKey):
+      data = part.encode() if isinstance(part, str) else np.ascontiguousarray(part).tobytes()
+      digest.update(len(data).to_bytes(8, "little"))
+      digest.update(data)
+    return digest.hexdigest()
+
+class PlanEvaluation:
+    """Stored evaluation of a plan: the margin surface with its "Signed" array, its MarginStatistics, the combined
+    ablation zone labelmap (a dictionary of arrays, None for closed form zones or when the zone was not built for
+    this plan) and the VolumeCoverage, if it was evaluated. exact is False for margins of an incremental update
+    (per-probe minimum), which are conservative where the ablation zones overlap."""
+
+    __slots__ = ("marginPolyData", "statistics", "zoneLabelmap", "volumeCoverage", "exact")
+
+    def __init__(self, marginPolyData, statistics, zoneLabelmap=None, volumeCoverage=None, exact=True):
+      self.marginPolyData = marginPolyData
+      self.statistics = statistics
+      self.zoneLabelmap = zoneLabelmap
+      self.volumeCoverage = volumeCoverage
+      self.exact = exact
+
+class PlanCache:
+    """Least recently used plan evaluations, at most maximumSize bytes in total (the size of each entry is given
+    when it is stored). The most recent entry is always kept."""
+
+    def __init__(self, maximumSize=256 * 2**20):
+      self.maximumSize = maximumSize
+      self.entries = collections.OrderedDict()
+      self.totalSize = 0
+
+    def __len__(self):
+      return len(self.entries)
+
+    def __contains__(self, key):
+      return key in self.entries
+
+    def get(self, key):
+      if key not in self.entries:
+        return None
+      self.entries.move_to_end(key)
+      return self.entries[key][0]
+
+    def put(self, key, value, size):
+      if key in self.entries:
+        self.totalSize -= self.entries.pop(key)[1]
+      self.entries[key] = (value, size)
+      self.totalSize += size
+      while self.totalSize > self.maximumSize and len(self.entries) > 1:
+        self.totalSize -= self.entries.popitem(last=False)[1][1]
+
+    def clear(self):
+      self.entries.clear()
+      self.totalSize = 0
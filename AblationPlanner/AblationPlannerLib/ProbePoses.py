@@ -0,0 +1,43 @@
+import numpy as np
+
+#
+# Rigid probe poses from planned tip and entry points
+#
+
+def probePosesFromEndPoints(tips, entries, templateTip=(0,0,0), templateEntry=(0,0,-1)):
+    """Compute the rigid poses (N,4,4) that move the probe template (tip at templateTip, shaft towards templateEntry)
+    to each planned tip and entry point.
+    """
+    tips = np.asarray(tips, dtype=float).reshape(-1, 3)
+    entries = np.asarray(entries, dtype=float).reshape(-1, 3)
+    rotationMatrices = rotationMatricesFromVectors(np.subtract(templateEntry, templateTip), entries - tips)
+    poses = np.tile(np.eye(4), (len(tips), 1, 1))
+    poses[:,:3,:3] = rotationMatrices
+    poses[:,:3,3] = tips - rotationMatrices.dot(np.asarray(templateTip, dtype=float))
+    return poses
+
+def rotationMatricesFromVectors(vec1, vec2s):
+    """ Find the rotation matrices that align vec1 to each row of vec2s
+    :param vec1: A 3d "source" vector
+    :param vec2s: (N,3) "destination" vectors
+    :return mat: (N,3,3) rotation matrices. Parallel vectors give the identity, antiparallel vectors
+      a half turn around an axis perpendicular to vec1.
+    """
+    a = np.asarray(vec1, dtype=float).reshape(3)
+    a = a / np.linalg.norm(a)
+    b = np.asarray(vec2s, dtype=float).reshape(-1, 3)
+    b = b / np.linalg.norm(b, axis=1)[:, np.newaxis]
+    v = np.cross(a, b)
+    c = b.dot(a)
+    kmat = np.zeros((len(b), 3, 3))
+    kmat[:, 0, 1], kmat[:, 0, 2], kmat[:, 1, 2] = -v[:, 2], v[:, 1], -v[:, 0]
+    kmat[:, 1, 0], kmat[:, 2, 0], kmat[:, 2, 1] = v[:, 2], -v[:, 1], v[:, 0]
+    # (1 - c) / s**2 == 1 / (1 + c), which stays finite for parallel vectors
+    antiparallel = c < -1.0 + 1e-9
+    scale = 1.0 / np.where(antiparallel, 1.0, 1.0 + c)
+    rotationMatrices = np.eye(3) + kmat + np.matmul(kmat, kmat) * scale[:, np.newaxis, np.newaxis]
+    if np.any(antiparallel):
+        perpendicular = np.cross(a, np.eye(3)[np.argmin(np.abs(a))])
+        perpendicular = perpendicular / np.linalg.norm(perpendicular)
+        rotationMatrices[antiparallel] = 2.0 * np.outer(perpendicular, perpendicular) - np.eye(3)
+    return rotationMatrices
@@ -0,0 +1,121 @@
+import hashlib
+import os
+import time
+
+import numpy as np
+
+from .DistanceFields import SignedDistanceField
+
+#
+# Preprocessed ablation profiles
+#
+# Loading a profile segmentation means reading the labelmap and converting it to a closed surface, which takes
+# seconds for the dense profiles of the vendor libraries. The results of this preprocessing (the closed surface
+# in the probe frame, its ellipsoid approximation and optionally a distance field) are kept on disk, one
+# compressed .npz file per profile named after the content hash of the profile file, so that an edited file gets
+# a new entry. The least recently used entries are removed when the cache grows beyond its maximum size.
+#
+
+ENTRY_FILE_EXTENSION = ".npz"
+
+def fileContentHash(path, blockSize=2**20):
+    """SHA-256 hex digest of the content of a file."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as hashedFile:
+      for block in iter(lambda: hashedFile.read(blockSize), b""):
+        digest.update(block)
+    return digest.hexdigest()
+
+class ProfileEntry:
+    """Preprocessed profile: closed surface points (N,3) and triangles (T,3) in the probe frame, the semi-axes and tip
+    offset of its ellipsoid approximation (see ParametricZones.EllipsoidProfile.fromBounds) and an optional
+    SignedDistanceField of the surface in the probe frame.
+    """
+
+    def __init__(self, points, triangles, semiAxes, tipOffset, distanceField=None):
+      self.points = np.asarray(points, dtype=np.float32).reshape(-1, 3)
+      self.triangles = np.asarray(triangles, dtype=np.int32).reshape(-1, 3)
+      self.semiAxes = np.asarray(semiAxes, dtype=float).reshape(3)
+      self.tipOffset = float(tipOffset)
+      self.distanceField = distanceField
+
+    def toArrays(self):
+      arrays = {"points": self.points, "triangles": self.triangles, "semiAxes": self.semiAxes, "tipOffset": np.array(self.tipOffset)}
+      if self.distanceField is not None:
+        arrays.update(distanceFieldOrigin=self.distanceField.origin, distanceFieldSpacing=np.array(self.distanceField.spacing),
+          distanceFieldValues=self.distanceField.values)
+      return arrays
+
+    @classmethod
+    def fromArrays(cls, arrays):
+      distanceField = None
+      if "distanceFieldValues" in arrays:
+        distanceField = SignedDistanceField(arrays["distanceFieldOrigin"], float(arrays["distanceFieldSpacing"]), arrays["distanceFieldValues"])
+      return cls(arrays["points"], arrays["triangles"], arrays["semiAxes"], float(arrays["tipOffset"]), distanceField)
+
+class ProfileCache:
+    """Directory of preprocessed profiles (ProfileEntry), keyed by the content hash of the profile file.
+    Its total size is kept below maximumSize bytes by removing the least recently used entries.
+    """
+
+    def __init__(self, directory, maximumSize=500 * 2**20):
+      self.directory = directory
+      self.maximumSize = maximumSize
+
+    def entryPath(self, key):
+      return os.path.join(self.directory, key + ENTRY_FILE_EXTENSION)
+
+    def get(self, key):
+      """Return the cached ProfileEntry or None."""
+      path = self.entryPath(key)
+      try:
+        with np.load(path) as npzFile:
+          entry = ProfileEntry.fromArrays(dict(npzFile))
+      except (OSError, KeyError, ValueError):
+        # missing, or a damaged file: it is preprocessed again
+        return None
+      self.touch(path)
+      return entry
+
+    def touch(self, path):
+      # the modification time records the last use; it is set from the clock explicitly, because the time the file
+      # system stamps can be too coarse to order entries used in quick succession
+      now = time.time_ns()
+      os.utime(path, ns=(now, now))
+
+    def put(self, key, entry):
+      """Store a ProfileEntry, then remove the least recently used entries beyond the maximum size."""
+      os.makedirs(self.directory, exist_ok=True)
+      path = self.entryPath(key)
+      # written to a temporary file first, so that an interrupted write never leaves a damaged entry behind
+      temporaryPath = path + ".partial"
+      with open(temporaryPath, "wb") as entryFile:
+        np.savez_compressed(entryFile, **entry.toArrays())
+      os.replace(temporaryPath, path)
+      self.touch(path)
+      self.evict(keep=key)
+
+    def evict(self, keep=None):
+      """Remove the least recently used entries until the cache fits in maximumSize (the keep entry is never removed)."""
+      if not os.path.isdir(self.directory):
+        return
+      entries = []
+      for fileName in os.listdir(self.directory):
+        if fileName.endswith(ENTRY_FILE_EXTENSION):
+          status = os.stat(os.path.join(self.directory, fileName))
+          entries.append((status.st_mtime, status.st_size, fileName))
+      entries.sort()
+      totalSize = sum(size for modificationTime, size, fileName in entries)
+      for modificationTime, size, fileName in entries:
+        if totalSize <= self.maximumSize:
+          break
+        if keep is not None and fileName == keep + ENTRY_FILE_EXTENSION:
+          continue
+        os.remove(os.path.join(self.directory, fileName))
+        totalSize -= size
+
+    def clear(self):
+      if os.path.isdir(self.directory):
+        for fileName in os.listdir(self.directory):
+          if fileName.endswith(ENTRY_FILE_EXTENSION):
+            os.remove(os.path.join(self.directory, fileName))
@@ -0,0 +1,185 @@
+import cProfile
+import contextlib
+import functools
+import io
+import json
+import pstats
+import threading
+import time
+
+#
+# Pipeline timing
+#
+# Stages of the pipeline are recorded as nested spans (a button handler, the logic methods it calls,
+# the helpers they call...). Recording is switched on and off at runtime; when it is off, span() returns
+# a shared do-nothing context and decorated functions only pay for one attribute check.
+# Only the thread that created the profiler (the application thread) records spans, work done in
+# worker threads is part of the span that waits for it. Work that is not waited for in a span (a task
+# running across event loop iterations, its worker thread and CLI steps) is recorded from the application
+# thread with recordSpan once its duration is known.
+#
+
+class _NullSpan:
+    def __enter__(self):
+      return self
+    def __exit__(self, *exc):
+      return False
+    def __setitem__(self, key, value):
+      pass
+    def update(self, *args, **kwargs):
+      pass
+
+_NULL_SPAN = _NullSpan()
+
+class _Span:
+    def __init__(self, profiler, name, attributes):
+      self.profiler = profiler
+      self.record = {"name": name, "parent": None, "depth": 0, "start": 0.0, "duration": 0.0, "attributes": dict(attributes)}
+      self._profile = None
+
+    def __setitem__(self, key, value):
+      self.record["attributes"][key] = value
+
+    def update(self, *args, **kwargs):
+      self.record["attributes"].update(*args, **kwargs)
+
+    def __enter__(self):
+      profiler = self.profiler
+      record = self.record
+      if profiler._stack:
+        record["parent"] = profiler._stack[-1]
+        record["depth"] = profiler.spans[record["parent"]]["depth"] + 1
+      profiler._stack.append(len(profiler.spans))
+      profiler.spans.append(record)
+      if profiler.stateFunction is not None:
+        record["stateBefore"] = profiler.stateFunction()
+      if profiler.captureProfile and record["parent"] is None:
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+      record["start"] = time.perf_counter() - profiler._origin
+      return self
+
+    def __exit__(self, *exc):
+      profiler = self.profiler
+      record = self.record
+      record["duration"] = time.perf_counter() - profiler._origin - record["start"]
+      if self._profile is not None:
+        self._profile.disable()
+        record["profile"] = profileSummary(self._profile, profiler.profileFunctionCount)
+        profiler.profiles.append(self._profile)
+      if profiler.stateFunction is not None:
+        record["stateAfter"] = profiler.stateFunction()
+      profiler._stack.pop()
+      if record["parent"] is None and profiler.topLevelSpanFinishedCallback is not None:
+        profiler.topLevelSpanFinishedCallback()
+      return False
+
+def profileSummary(profile, functionCount):
+    """Return the functions with the largest cumulative time of a cProfile profile."""
+    stats = pstats.Stats(profile, stream=io.StringIO())
+    stats.sort_stats("cumulative")
+    summary = []
+    for function in stats.fcn_list[:functionCount]:
+      primitiveCalls, callCount, totalTime, cumulativeTime, callers = stats.stats[function]
+      summary.append({"function": "{0}:{1}({2})".format(*function), "calls": callCount,
+        "totalTime": totalTime, "cumulativeTime": cumulativeTime})
+    return summary
+
+class PipelineProfiler:
+    """Records hierarchical timing spans of the planning pipeline.
+    stateFunction() may return a dictionary (e.g. the number of scene nodes) that is recorded when a span starts
+    and ends; resultAttributesFunction(result) may return attributes (e.g. mesh sizes) describing the result of a
+    function decorated with spanned(). With captureProfile, each top-level span is also run under cProfile.
+    """
+
+    def __init__(self, stateFunction=None, resultAttributesFunction=None):
+      self.enabled = False
+      self.captureProfile = False
+      self.profileFunctionCount = 20
+      self.stateFunction = stateFunction
+      self.resultAttributesFunction = resultAttributesFunction
+      self.topLevelSpanFinishedCallback = None
+      self.threadIdent = threading.get_ident()
+      self.clear()
+
+    def clear(self):
+      self.spans = []
+      self.profiles = []
+      self._stack = []
+      self._origin = time.perf_counter()
+
+    def span(self, name, **attributes):
+      """Context manager that records a span; attributes can be added with span[key] = value."""
+      if not self.enabled or threading.get_ident() != self.threadIdent:
+        return _NULL_SPAN
+      return _Span(self, name, attributes)
+
+    def spanned(self, name=None):
+      """Decorator that records each call of a function as a span."""
+      def decorator(function):
+        spanName = name or function.__name__
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+          if not self.enabled or threading.get_ident() != self.threadIdent:
+            return function(*args, **kwargs)
+          with self.span(spanName) as span:
+            result = function(*args, **kwargs)
+            if self.resultAttributesFunction is not None:
+              span.update(self.resultAttributesFunction(result))
+            return result
+        return wrapper
+      return decorator
+
+    def recordSpan(self, name, start, duration=0.0, parent=None, **attributes):
+      """Record a span that was not measured with span(): start is a time.perf_counter() value, parent the index
+      of the span it belongs to (by default the current span). The duration of a span that is still running can be
+      set later with finishRecordedSpan. Returns the index of the span, None when spans are not recorded.
+      """
+      if not self.enabled or threading.get_ident() != self.threadIdent:
+        return None
+      if parent is None and self._stack:
+        parent = self._stack[-1]
+      if parent is not None and parent >= len(self.spans):
+        # the spans were cleared since the parent was recorded
+        parent = None
+      self.spans.append({"name": name, "parent": parent, "depth": 0 if parent is None else self.spans[parent]["depth"] + 1,
+        "start": start - self._origin, "duration": duration, "attributes": dict(attributes)})
+      return len(self.spans) - 1
+
+    def finishRecordedSpan(self, index, end, **attributes):
+      """Set the duration of a span recorded with recordSpan when the work it stands for ends (end: time.perf_counter())."""
+      if index is None or index >= len(self.spans) or threading.get_ident() != self.threadIdent:
+        return
+      record = self.spans[index]
+      record["duration"] = end - self._origin - record["start"]
+      record["attributes"].update(attributes)
+      if record["parent"] is None and self.topLevelSpanFinishedCallback is not None:
+        self.topLevelSpanFinishedCallback()
+
+    @contextlib.contextmanager
+    def resumedSpan(self, index):
+      """Context in which spans are nested in the span recorded at index (e.g. a task resumed by the event loop)."""
+      if index is None or index >= len(self.spans) or threading.get_ident() != self.threadIdent:
+        yield
+        return
+      self._stack.append(index)
+      try:
+        yield
+      finally:
+        self._stack.pop()
+
+    def toDict(self):
+      return {"spans": self.spans}
+
+    def writeJson(self, path):
+      with open(path, "w") as jsonFile:
+        json.dump(self.toDict(), jsonFile, indent=2, default=str)
+
+    def writeProfile(self, path):
+      """Write the combined cProfile statistics of all recorded top-level spans (for pstats or snakeviz)."""
+      if not self.profiles:
+        raise ValueError("no profile was captured")
+      stats = pstats.Stats(self.profiles[0])
+      for profile in self.profiles[1:]:
+        stats.add(profile)
+      stats.dump_stats(path)
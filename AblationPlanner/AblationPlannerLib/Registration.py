@@ -0,0 +1,48 @@
+import numpy as np
+
+#
+# Landmark registration
+#
+# Closed form least squares fit of corresponding points (Kabsch/Horn, with the scale of Umeyama for
+# similarity transforms). A handful of fiducials is solved in microseconds, so the tumor can follow
+# the fiducials while they are placed or dragged.
+#
+
+def registerPoints(movingPoints, fixedPoints, similarity=False):
+    """Return the 4x4 matrix of the rigid (or similarity) transform that best maps movingPoints onto
+    fixedPoints in the least squares sense. Points are (N,3) arrays of corresponding points, N >= 3.
+    """
+    movingPoints = np.asarray(movingPoints, dtype=float).reshape(-1, 3)
+    fixedPoints = np.asarray(fixedPoints, dtype=float).reshape(-1, 3)
+    if len(movingPoints) != len(fixedPoints):
+      raise ValueError("the point lists must have the same number of points")
+    if len(movingPoints) < 3:
+      raise ValueError("at least 3 corresponding points are required, found {0}".format(len(movingPoints)))
+
+    movingCenter = movingPoints.mean(axis=0)
+    fixedCenter = fixedPoints.mean(axis=0)
+    movingCentered = movingPoints - movingCenter
+    fixedCentered = fixedPoints - fixedCenter
+    u, singularValues, vt = np.linalg.svd(fixedCentered.T.dot(movingCentered))
+    if singularValues[1] < 1e-9 * max(singularValues[0], 1e-12):
+      raise ValueError("the points are collinear, the rotation is not defined")
+    # reflection correction, so that the result is a proper rotation
+    d = np.sign(np.linalg.det(u.dot(vt))) or 1.0
+    correction = np.diag([1.0, 1.0, d])
+    rotation = u.dot(correction).dot(vt)
+    scale = 1.0
+    if similarity:
+      scale = np.trace(np.diag(singularValues).dot(correction)) / np.sum(movingCentered ** 2)
+
+    matrix = np.eye(4)
+    matrix[:3,:3] = scale * rotation
+    matrix[:3,3] = fixedCenter - scale * rotation.dot(movingCenter)
+    return matrix
+
+def registrationErrors(matrix, movingPoints, fixedPoints):
+    """Return the fiducial registration error of each point pair (mm) and their root mean square."""
+    movingPoints = np.asarray(movingPoints, dtype=float).reshape(-1, 3)
+    fixedPoints = np.asarray(fixedPoints, dtype=float).reshape(-1, 3)
+    transformedPoints = movingPoints.dot(matrix[:3,:3].T) + matrix[:3,3]
+    errors = np.linalg.norm(transformedPoints - fixedPoints, axis=1)
+    return errors, float(np.sqrt(np.mean(errors ** 2)))
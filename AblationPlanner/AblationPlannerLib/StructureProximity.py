@@ -0,0 +1,54 @@
+import numpy as np
+
+#
+# Proximity of the ablation zone to organs at risk
+#
+# All structures (bowel, ureter, vessels, pleura...) are checked against the same ablation zone: the vertices of
+# every structure surface are concatenated, their signed distances to the zone (negative inside) are evaluated in
+# one pass, and the result is split back per structure. The intrusion volume of a structure is the part of it that
+# lies inside the zone, counted on binary masks of a common voxel grid.
+#
+
+class StructureProximity:
+    """Proximity of one structure to the ablation zone: its name, the smallest signed distance of its surface to the
+    zone (mm, negative if the zone reaches into the structure), the volume of the structure inside the zone (mm3) and
+    the number of surface vertices.
+    """
+
+    __slots__ = ("name", "minimumDistance", "intrusionVolume", "numberOfVertices")
+
+    def __init__(self, name, minimumDistance, intrusionVolume, numberOfVertices):
+      self.name = name
+      self.minimumDistance = minimumDistance
+      self.intrusionVolume = intrusionVolume
+      self.numberOfVertices = numberOfVertices
+
+    @property
+    def intruded(self):
+      return self.minimumDistance < 0 or self.intrusionVolume > 0
+
+    def toDict(self):
+      return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+      return "StructureProximity({0}: minimum distance {1:.2f} mm, intrusion {2:.1f} mm3)".format(
+        self.name, self.minimumDistance, self.intrusionVolume)
+
+def splitStructureValues(values, vertexCounts):
+    """Split per-vertex values of concatenated structure surfaces back into one array per structure."""
+    return np.split(np.asarray(values), np.cumsum(vertexCounts)[:-1])
+
+def structureProximities(names, vertexCounts, signedDistances, intrusionVoxelCounts, voxelVolume):
+    """Return a StructureProximity per structure, from the signed distances of the concatenated structure surface
+    vertices (in the order of names, vertexCounts vertices each) and the number of voxels of each structure inside
+    the zone. A structure without vertices is reported with an infinite distance.
+    """
+    if not (len(names) == len(vertexCounts) == len(intrusionVoxelCounts)):
+      raise ValueError("one vertex count and one intrusion voxel count are required per structure")
+    if len(signedDistances) != sum(vertexCounts):
+      raise ValueError("the number of distances does not match the number of structure vertices")
+    proximities = []
+    for name, distances, intrusionVoxelCount in zip(names, splitStructureValues(signedDistances, vertexCounts), intrusionVoxelCounts):
+      minimumDistance = float(distances.min()) if len(distances) else float("inf")
+      proximities.append(StructureProximity(name, minimumDistance, float(intrusionVoxelCount) * voxelVolume, len(distances)))
+    return proximities
@@ -0,0 +1,56 @@
+import json
+import os
+
+import numpy as np
+
+#
+# Per-vertex surface distance files
+#
+# Two compact binary formats, readable with NumPy only:
+# - "npz": a single compressed file (np.load)
+# - "raw": a directory with one little-endian raw file per array and a header.json describing them,
+#   so that thousands of evaluations can be memory-mapped without reading them (loadSurfaceDistances)
+#
+
+RAW_HEADER_FILE_NAME = "header.json"
+
+def surfaceDistanceArrays(points, signedDistances):
+    """Return the arrays stored for an evaluation: point IDs, coordinates, signed and absolute distances."""
+    signedDistances = np.asarray(signedDistances, dtype=np.float32).ravel()
+    return {
+      "pointIds": np.arange(signedDistances.size, dtype=np.int32),
+      "points": np.asarray(points, dtype=np.float32).reshape(-1, 3),
+      "signed": signedDistances,
+      "absolute": np.abs(signedDistances),
+      }
+
+def writeSurfaceDistances(path, points, signedDistances, fileFormat="npz"):
+    """Write per-vertex distances as an .npz file or as a directory of raw arrays (fileFormat "raw")."""
+    arrays = surfaceDistanceArrays(points, signedDistances)
+    if fileFormat == "npz":
+      with open(path, "wb") as npzFile:
+        np.savez_compressed(npzFile, **arrays)
+    elif fileFormat == "raw":
+      os.makedirs(path, exist_ok=True)
+      header = {"numberOfPoints": len(arrays["signed"]), "arrays": {}}
+      for name, array in arrays.items():
+        array = np.ascontiguousarray(array, dtype=array.dtype.newbyteorder("<"))
+        array.tofile(os.path.join(path, name + ".raw"))
+        header["arrays"][name] = {"fileName": name + ".raw", "dtype": array.dtype.str, "shape": list(array.shape)}
+      with open(os.path.join(path, RAW_HEADER_FILE_NAME), "w") as headerFile:
+        json.dump(header, headerFile, indent=2)
+    else:
+      raise ValueError("Unknown surface distance file format: " + str(fileFormat))
+    return path
+
+def loadSurfaceDistances(path):
+    """Load per-vertex distances written by writeSurfaceDistances as a dictionary of arrays.
+    Raw arrays are memory-mapped (read-only), so only the accessed values are read from disk.
+    """
+    if os.path.isdir(path):
+      with open(os.path.join(path, RAW_HEADER_FILE_NAME)) as headerFile:
+        header = json.load(headerFile)
+      return {name: np.memmap(os.path.join(path, description["fileName"]), dtype=np.dtype(description["dtype"]),
+        mode="r", shape=tuple(description["shape"])) for name, description in header["arrays"].items()}
+    with np.load(path) as npzFile:
+      return dict(npzFile)
@@ -0,0 +1,97 @@
+import numpy as np
+
+from .ProbePoses import probePosesFromEndPoints
+
+#
+# Probe trajectory search
+#
+# Plans are searched with the cross-entropy method: each iteration samples a population of plans
+# (a tip and an entry point per probe), scores them in batches and refits the sampling distributions
+# to the best ("elite") plans. Scoring only uses NumPy, so batches can be sent to worker processes.
+#
+
+def scorePlans(profile, tumorPoints, tips, entries, objective="margin", requiredMargin=5.0):
+    """Score plans of K probes each with the closed form distances of an EllipsoidProfile.
+    tips, entries: (P,K,3) arrays. Returns (scores, minimumMargins, coverages), each of shape (P,).
+    The minimum margin is the smallest distance from a tumor vertex to the outside of the ablation zone
+    (negative if part of the tumor is not ablated) and the coverage is the fraction of tumor vertices
+    with at least requiredMargin of margin.
+    """
+    tips = np.asarray(tips, dtype=float)
+    entries = np.asarray(entries, dtype=float)
+    planCount, probeCount = tips.shape[:2]
+    planProbePoses = probePosesFromEndPoints(tips.reshape(-1, 3), entries.reshape(-1, 3)).reshape(planCount, probeCount, 4, 4)
+    signedDistances = profile.signedDistancesForPlans(tumorPoints, planProbePoses)
+    minimumMargins = -signedDistances.max(axis=1)
+    coverages = np.mean(signedDistances <= -requiredMargin, axis=1)
+    if objective == "coverage":
+      # the margin only breaks ties between plans with the same coverage
+      scores = coverages + 1e-3 * np.tanh(minimumMargins)
+    elif objective == "margin":
+      scores = minimumMargins
+    else:
+      raise ValueError("Unknown objective: " + str(objective))
+    return scores, minimumMargins, coverages
+
+# Inputs shared by all batches of a worker process, set once by initializeWorker
+_workerInputs = None
+
+def initializeWorker(profile, tumorPoints, objective, requiredMargin):
+    global _workerInputs
+    _workerInputs = (profile, tumorPoints, objective, requiredMargin)
+
+def scorePlanBatch(tipsAndEntries):
+    """Score a (tips, entries) batch with the inputs given to initializeWorker."""
+    profile, tumorPoints, objective, requiredMargin = _workerInputs
+    return scorePlans(profile, tumorPoints, tipsAndEntries[0], tipsAndEntries[1], objective, requiredMargin)
+
+def optimizeTrajectories(profile, tumorPoints, candidateEntries, probeCount, mapBatches=None,
+                         objective="margin", requiredMargin=5.0, iterations=30, populationSize=256,
+                         eliteFraction=0.1, batchSize=32, numberOfPlans=1, randomSeed=None):
+    """Search tip and entry positions of probeCount probes that maximize the objective.
+    tumorPoints (N,3) are the tumor surface vertices, candidateEntries (E,3) the allowed entry points.
+    mapBatches(function, batches) evaluates scorePlanBatch on each batch; it defaults to a serial map
+    after calling initializeWorker in this process (pass e.g. a process pool executor's map instead).
+    Returns the numberOfPlans best plans as dictionaries, best first.
+    """
+    tumorPoints = np.asarray(tumorPoints, dtype=float).reshape(-1, 3)
+    candidateEntries = np.asarray(candidateEntries, dtype=float).reshape(-1, 3)
+    if len(tumorPoints) == 0 or len(candidateEntries) == 0:
+      raise ValueError("the tumor surface and the entry region must not be empty")
+    if mapBatches is None:
+      initializeWorker(profile, tumorPoints, objective, requiredMargin)
+      mapBatches = map
+    randomState = np.random.RandomState(randomSeed)
+
+    # start with tips spread over the tumor and uniformly distributed entry points
+    tipMeans = np.tile(tumorPoints.mean(axis=0), (probeCount, 1))
+    tipDeviations = np.tile(np.maximum(tumorPoints.std(axis=0), 1.0), (probeCount, 1))
+    entryProbabilities = np.full((probeCount, len(candidateEntries)), 1.0 / len(candidateEntries))
+    eliteCount = max(1, int(round(populationSize * eliteFraction)))
+
+    bestPlans = []
+    for iteration in range(iterations):
+      tips = tipMeans + tipDeviations * randomState.standard_normal((populationSize, probeCount, 3))
+      entryIndices = np.stack([randomState.choice(len(candidateEntries), populationSize, p=entryProbabilities[probeIndex])
+        for probeIndex in range(probeCount)], axis=1)
+      entries = candidateEntries[entryIndices]
+
+      batches = [(tips[start:start+batchSize], entries[start:start+batchSize]) for start in range(0, populationSize, batchSize)]
+      results = list(mapBatches(scorePlanBatch, batches))
+      scores, minimumMargins, coverages = [np.concatenate(values) for values in zip(*results)]
+
+      order = np.argsort(-scores)
+      for planIndex in order[:numberOfPlans]:
+        bestPlans.append({"score": float(scores[planIndex]), "minimumMargin": float(minimumMargins[planIndex]),
+          "coverage": float(coverages[planIndex]), "tips": tips[planIndex], "entries": entries[planIndex]})
+
+      # refit the sampling distributions to the elite plans, smoothed to avoid a premature collapse
+      elite = order[:eliteCount]
+      tipMeans = 0.7 * tips[elite].mean(axis=0) + 0.3 * tipMeans
+      tipDeviations = np.maximum(0.7 * tips[elite].std(axis=0) + 0.3 * tipDeviations, 0.25)
+      for probeIndex in range(probeCount):
+        eliteFrequencies = np.bincount(entryIndices[elite, probeIndex], minlength=len(candidateEntries)) / float(eliteCount)
+        entryProbabilities[probeIndex] = 0.7 * eliteFrequencies + 0.3 * entryProbabilities[probeIndex]
+
+    bestPlans.sort(key=lambda plan: -plan["score"])
+    return bestPlans[:numberOfPlans]
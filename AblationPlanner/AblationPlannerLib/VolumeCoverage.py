@@ -0,0 +1,52 @@
+import numpy as np
+
+#
+# Volumetric coverage
+#
+# Coverage of the tumor volume by the ablation zone, counted on binary masks of a common voxel grid
+# that covers the tumor and its margin shell. The margin shell is the tissue outside the tumor within
+# marginDistance of it; the distance from every voxel to the tumor comes from a Euclidean distance transform.
+#
+
+class VolumeCoverage:
+    """Coverage of the tumor and of its margin shell by the ablation zone. Volumes are in mm3, fractions in 0..1.
+    The shell fraction is 1 if the shell is empty (marginDistance smaller than a voxel).
+    """
+
+    __slots__ = ("tumorVolume", "coveredVolume", "uncoveredVolume", "coverageFraction", "marginDistance",
+                 "shellVolume", "shellUncoveredVolume", "shellCoverageFraction", "voxelVolume")
+
+    def toDict(self):
+      return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+      return "VolumeCoverage(tumor covered: {0:.1%}, uncovered: {1:.1f} mm3, {2:g} mm shell covered: {3:.1%})".format(
+        self.coverageFraction, self.uncoveredVolume, self.marginDistance, self.shellCoverageFraction)
+
+def computeVolumeCoverage(tumorMask, zoneMask, distanceToTumor, voxelVolume, marginDistance=5.0):
+    """Return the VolumeCoverage of boolean tumor and ablation zone masks of the same shape.
+    distanceToTumor (mm, same shape) is the distance from every voxel to the nearest tumor voxel (0 inside the tumor).
+    """
+    tumorMask = np.asarray(tumorMask, dtype=bool)
+    zoneMask = np.asarray(zoneMask, dtype=bool)
+    if tumorMask.shape != zoneMask.shape or tumorMask.shape != np.shape(distanceToTumor):
+      raise ValueError("the masks and the distance map must have the same shape")
+    tumorVoxelCount = np.count_nonzero(tumorMask)
+    if tumorVoxelCount == 0:
+      raise ValueError("the tumor mask is empty")
+    shellMask = (distanceToTumor <= marginDistance) & ~tumorMask
+    shellVoxelCount = np.count_nonzero(shellMask)
+    uncoveredTumorVoxelCount = np.count_nonzero(tumorMask & ~zoneMask)
+    uncoveredShellVoxelCount = np.count_nonzero(shellMask & ~zoneMask)
+
+    coverage = VolumeCoverage()
+    coverage.voxelVolume = float(voxelVolume)
+    coverage.marginDistance = float(marginDistance)
+    coverage.tumorVolume = tumorVoxelCount * coverage.voxelVolume
+    coverage.uncoveredVolume = uncoveredTumorVoxelCount * coverage.voxelVolume
+    coverage.coveredVolume = coverage.tumorVolume - coverage.uncoveredVolume
+    coverage.coverageFraction = 1.0 - float(uncoveredTumorVoxelCount) / tumorVoxelCount
+    coverage.shellVolume = shellVoxelCount * coverage.voxelVolume
+    coverage.shellUncoveredVolume = uncoveredShellVoxelCount * coverage.voxelVolume
+    coverage.shellCoverageFraction = 1.0 - float(uncoveredShellVoxelCount) / shellVoxelCount if shellVoxelCount else 1.0
+    return coverage
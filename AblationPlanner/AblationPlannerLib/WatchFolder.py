@@ -0,0 +1,110 @@
+import fnmatch
+import os
+import time
+
+#
+# Incoming scan folder
+#
+# Each new intra-procedure scan arrives as a file or a subdirectory of the watched folder (e.g. written by a
+# DICOM listener or copied by hand). An entry is reported once it stopped changing for settleTime seconds, so
+# that a series still being copied is not picked up half written, and reported again if it changes later.
+# Only the file names are looked at here: loading is left to the pipeline, which loads each file when it
+# needs it.
+#
+
+VOLUME_PATTERNS = ["*.nrrd", "*.nhdr", "*.nii", "*.nii.gz", "*.mha", "*.mhd", "*.dcm"]
+MARKUPS_PATTERNS = ["*.mrk.json", "*.fcsv"]
+IGNORED_PATTERNS = [".*", "*.partial", "*.tmp", "*~"]
+
+def matchesAny(fileName, patterns):
+    fileName = fileName.lower()
+    return any(fnmatch.fnmatch(fileName, pattern) for pattern in patterns)
+
+class Series:
+    """A new scan: its name, the path of the file or directory and the files it contains (sorted).
+    Series found in a DICOM database have their seriesInstanceUID instead of a path."""
+
+    def __init__(self, name, path, files, seriesInstanceUID=None):
+      self.name = name
+      self.path = path
+      self.files = files
+      self.seriesInstanceUID = seriesInstanceUID
+
+    def __repr__(self):
+      return "Series({0}, {1} files)".format(self.name, len(self.files))
+
+    def classify(self):
+      """Sort the files of the series by role: "endPoints" (a markups file with "endpoints" in its name), "fiducials"
+      (another markups file, the fiducials located on the new scan) and "volumes" (image files, DICOM files included;
+      files without extension are assumed to be DICOM). Returns a dictionary with these keys, a markups role is None
+      when the series has no such file."""
+      roles = {"endPoints": None, "fiducials": None, "volumes": []}
+      for path in self.files:
+        fileName = os.path.basename(path)
+        if matchesAny(fileName, MARKUPS_PATTERNS):
+          role = "endPoints" if "endpoint" in fileName.lower().replace("_", "").replace("-", "") else "fiducials"
+          if roles[role] is None:
+            roles[role] = path
+        elif matchesAny(fileName, VOLUME_PATTERNS) or "." not in fileName:
+          roles["volumes"].append(path)
+      return roles
+
+class FolderWatcher:
+    """Report the files and subdirectories of a directory that are new or changed (see poll)."""
+
+    def __init__(self, directory, settleTime=2.0, clock=time.time):
+      self.directory = directory
+      self.settleTime = settleTime
+      self.clock = clock
+      # path: (signature, time of the last change) of the entries that are not reported yet
+      self.pending = {}
+      # path: signature of the reported entries
+      self.reported = {}
+
+    def ignoreExisting(self):
+      """Mark the entries already in the directory as reported, so that only scans arriving from now on are processed."""
+      for path, files, signature in self._scan():
+        self.reported[path] = signature
+
+    def _scan(self):
+      if not os.path.isdir(self.directory):
+        return []
+      entries = []
+      for name in sorted(os.listdir(self.directory)):
+        if matchesAny(name, IGNORED_PATTERNS):
+          continue
+        path = os.path.join(self.directory, name)
+        if os.path.isdir(path):
+          files = []
+          for root, directoryNames, fileNames in os.walk(path):
+            directoryNames[:] = sorted(directoryName for directoryName in directoryNames if not matchesAny(directoryName, IGNORED_PATTERNS))
+            files += [os.path.join(root, fileName) for fileName in sorted(fileNames) if not matchesAny(fileName, IGNORED_PATTERNS)]
+        else:
+          files = [path]
+        try:
+          signature = tuple((filePath, os.path.getsize(filePath), os.path.getmtime(filePath)) for filePath in files)
+        except OSError:
+          # removed while scanning, it is seen again at the next poll if it comes back
+          continue
+        entries.append((path, files, signature))
+      return entries
+
+    def poll(self):
+      """Return the Series that are complete (unchanged for settleTime) and not reported yet, oldest first."""
+      now = self.clock()
+      ready = []
+      for path, files, signature in self._scan():
+        if not files or self.reported.get(path) == signature:
+          continue
+        pendingSignature, changeTime = self.pending.get(path, (None, None))
+        if pendingSignature != signature:
+          self.pending[path] = (signature, now)
+          if self.settleTime > 0:
+            continue
+          changeTime = now
+        if now - changeTime >= self.settleTime:
+          del self.pending[path]
+          self.reported[path] = signature
+          ready.append((changeTime, Series(os.path.basename(path), path, files)))
+      ready.sort(key=lambda item: item[0])
+      return [series for changeTime, series in ready]
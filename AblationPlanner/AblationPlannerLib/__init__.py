@@ -0,0 +1,2 @@
+# Helpers of the AblationPlanner module that only depend on NumPy, so that they can
+# also be imported in worker processes that do not run the Slicer application.
@@ -0,0 +1,291 @@
+"""Stage-level benchmark of the AblationPlanner pipeline.
+
+Times each stage of the planning pipeline on the bundled test case (Testing/tumor.seg.nrrd and
+Testing/Endpoints.mrk.json) and on synthetic workloads that vary the number of probes (1-16), the
+tumor mesh resolution and the ablation profile size, one factor at a time around a baseline.
+The margin evaluation is timed as a whole (logic.evaluateMargins) and stage by stage (updateModelFromSegment,
+computeSignedDistancesToSurface and computeMarginStatistics), with the same functions the module runs.
+Results are written to a JSON report with the wall time, the peak resident memory and the resident memory change
+of every stage.
+
+The benchmark is not registered as a test, it takes minutes and is run manually with Slicer:
+
+  Slicer --no-splash --no-main-window --python-script AblationPlannerBenchmark.py --output report.json
+
+Add --quick for a reduced set of workloads, --cli to also time the margin evaluation with the ModelToModelDistance
+CLI and --python-memory to also record the peak Python memory of each stage (in a second pass, so that tracing does
+not slow down the timed pass). With --compare previous.json, the stages that became slower than in a previous report
+by more than --threshold are listed and the script exits with code 1.
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import sys
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+import vtk
+import slicer
+from vtk.util import numpy_support
+
+import AblationPlanner
+from AblationPlannerLib.ParametricZones import EllipsoidProfile
+
+TESTING_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BASELINE = {"probeCount": 4, "tumorResolution": 64, "profileScale": 1.0}
+PROBE_COUNTS = [1, 2, 4, 8, 12, 16]
+TUMOR_RESOLUTIONS = [16, 32, 64, 128, 256]
+PROFILE_SCALES = [0.5, 1.0, 1.5, 2.0]
+BASE_PROFILE = EllipsoidProfile((15, 15, 20), 10)
+
+
+def resetPeakResidentMemory():
+  """Reset the resident memory high water mark (VmHWM) of the process. Returns False where this is not supported
+  (only Linux supports it)."""
+  try:
+    with open("/proc/self/clear_refs", "w") as clearRefsFile:
+      clearRefsFile.write("5")
+    return True
+  except OSError:
+    return False
+
+
+def peakResidentMemory():
+  """Resident memory high water mark (VmHWM) of the process in MB, None if it cannot be read."""
+  try:
+    with open("/proc/self/status") as statusFile:
+      for line in statusFile:
+        if line.startswith("VmHWM:"):
+          return int(line.split()[1]) / 1024.0
+  except (OSError, ValueError):
+    pass
+  return None
+
+
+class ResidentMemorySampler(threading.Thread):
+  """Sample the resident memory of the process every interval (s) until stopped and keep its peak (MB).
+  Used where the high water mark cannot be reset; peaks shorter than the interval can be missed."""
+
+  def __init__(self, interval=0.002):
+    threading.Thread.__init__(self, daemon=True)
+    self.interval = interval
+    self.peak = AblationPlanner.processMemoryUsage()
+    self.stopped = threading.Event()
+
+  def run(self):
+    while not self.stopped.wait(self.interval):
+      residentMemory = AblationPlanner.processMemoryUsage()
+      if residentMemory is not None and (self.peak is None or residentMemory > self.peak):
+        self.peak = residentMemory
+
+  def stop(self):
+    self.stopped.set()
+    self.join()
+    return self.peak
+
+
+def measureStage(results, workload, stage, function, *args, **kwargs):
+  """Run function, record its wall time and memory use in results and return its result.
+  peakResidentMemory is the peak resident memory of the process during the stage (MB), including the memory
+  allocated by VTK: on Linux the kernel's high water mark is reset before the stage and read after it, elsewhere a
+  thread samples the resident memory. peakResidentMemoryIncrease is that peak minus the resident memory at the start
+  of the stage, residentMemoryChange the change of the resident memory from the start to the end of the stage
+  (MB, None if they cannot be determined on this platform). While tracemalloc is tracing (see runWorkloads),
+  peakPythonMemory is the peak of memory allocated through Python during the stage (bytes, NumPy arrays included,
+  VTK excluded); the wall time of such a pass is slowed down by the tracing and must not be compared.
+  """
+  tracing = tracemalloc.is_tracing()
+  if tracing:
+    tracemalloc.reset_peak()
+    pythonMemoryBefore = tracemalloc.get_traced_memory()[0]
+  residentMemoryBefore = AblationPlanner.processMemoryUsage()
+  sampler = None
+  if not resetPeakResidentMemory():
+    sampler = ResidentMemorySampler()
+    sampler.start()
+  try:
+    startTime = time.perf_counter()
+    result = function(*args, **kwargs)
+    wallTime = time.perf_counter() - startTime
+  finally:
+    peakMemory = sampler.stop() if sampler is not None else peakResidentMemory()
+  residentMemoryAfter = AblationPlanner.processMemoryUsage()
+  record = dict(workload)
+  record.update(stage=stage, wallTime=wallTime, peakResidentMemory=peakMemory, peakResidentMemoryIncrease=None,
+    residentMemoryChange=None)
+  if residentMemoryBefore is not None and peakMemory is not None:
+    record["peakResidentMemoryIncrease"] = peakMemory - residentMemoryBefore
+  if residentMemoryBefore is not None and residentMemoryAfter is not None:
+    record["residentMemoryChange"] = residentMemoryAfter - residentMemoryBefore
+  if tracing:
+    record["peakPythonMemory"] = tracemalloc.get_traced_memory()[1] - pythonMemoryBefore
+  results.append(record)
+  logging.info("{0}: {1} {2:.3f} s".format(workload["name"], stage, wallTime))
+  return result
+
+
+def recordKey(record):
+  return (record["name"], record["stage"], record.get("distanceBackend"))
+
+
+def compareReports(previousReport, report, threshold=0.25, minimumWallTime=0.01):
+  """Return the stages of report that are slower than in previousReport by more than threshold (a fraction),
+  ignoring stages that take less than minimumWallTime (s) in both, as dictionaries sorted by slowdown."""
+  previousWallTimes = {recordKey(record): record["wallTime"] for record in previousReport["results"]}
+  regressions = []
+  for record in report["results"]:
+    previousWallTime = previousWallTimes.get(recordKey(record))
+    if previousWallTime is None or max(previousWallTime, record["wallTime"]) < minimumWallTime:
+      continue
+    if record["wallTime"] > previousWallTime * (1.0 + threshold):
+      regressions.append({"name": record["name"], "stage": record["stage"], "distanceBackend": record.get("distanceBackend"),
+        "previousWallTime": previousWallTime, "wallTime": record["wallTime"], "ratio": record["wallTime"] / max(previousWallTime, 1e-9)})
+  regressions.sort(key=lambda regression: -regression["ratio"])
+  return regressions
+
+
+def createSegmentationFromSurface(polyData, name):
+  segmentationNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode", name)
+  segmentationNode.CreateDefaultDisplayNodes()
+  segmentationNode.AddSegmentFromClosedSurfaceRepresentation(polyData, name)
+  return segmentationNode
+
+
+def createSphereTumor(resolution, radius=15.0):
+  """Synthetic spherical tumor at the origin with about 2*resolution**2 surface vertices."""
+  sphere = vtk.vtkSphereSource()
+  sphere.SetRadius(radius)
+  sphere.SetThetaResolution(resolution)
+  sphere.SetPhiResolution(resolution)
+  sphere.Update()
+  return createSegmentationFromSurface(sphere.GetOutput(), "tumor")
+
+
+def ringEndPointPairs(probeCount, radius=10.0, depth=100.0):
+  """Probes with tips on a ring around the origin, all inserted from above."""
+  angles = np.linspace(0, 2*np.pi, probeCount, endpoint=False)
+  tips = np.stack([radius*np.cos(angles), radius*np.sin(angles), np.zeros(probeCount)], axis=1)
+  return [(tip, tip + [0, 0, depth]) for tip in tips]
+
+
+def runPipeline(results, workload, tumorNode, profileNode, endPointPairs, distanceBackends, statisticsThresholds=(0, 5, 10)):
+  logic = AblationPlanner.AblationPlannerLogic()
+
+  probeNodeIDs = measureStage(results, workload, "placeProbes", logic.placeProbes, profileNode, endPointPairs)
+  combinedProbeNode = measureStage(results, workload, "convertSegmentsToSegment", logic.convertSegmentsToSegment, profileNode, probeNodeIDs)
+
+  # the stages of evaluateMargins one by one, on the output nodes it updates
+  probeModel = measureStage(results, workload, "updateModelFromSegment (zone)", AblationPlanner.updateModelFromSegment,
+    combinedProbeNode, logic.getOutputNode("ProbeModel", "vtkMRMLModelNode", "probe model"))
+  tumorModel = measureStage(results, workload, "updateModelFromSegment (tumor)", AblationPlanner.updateModelFromSegment,
+    tumorNode, logic.getOutputNode("TumorModel", "vtkMRMLModelNode", "tumor model"))
+  workload = dict(workload, tumorVertices=tumorModel.GetPolyData().GetNumberOfPoints(),
+    probeVertices=probeModel.GetPolyData().GetNumberOfPoints())
+  tumorPoints = numpy_support.vtk_to_numpy(AblationPlanner.getWorldPolyData(tumorModel).GetPoints().GetData())
+  measureStage(results, dict(workload, distanceBackend="InProcess"), "computeSignedDistancesToSurface",
+    AblationPlanner.computeSignedDistancesToSurface, AblationPlanner.getWorldPolyData(probeModel), tumorPoints)
+
+  # the whole margin evaluation, as run by "Evaluate Tumor Margins"
+  for distanceBackend in distanceBackends:
+    outputNode = measureStage(results, dict(workload, distanceBackend=distanceBackend), "evaluateMargins",
+      logic.evaluateMargins, tumorNode, combinedProbeNode, distanceBackend, statisticsThresholds=statisticsThresholds)[0]
+  measureStage(results, workload, "computeMarginStatistics", logic.computeMarginStatistics, outputNode, statisticsThresholds)
+  measureStage(results, workload, "changeColorsByMargin_", logic.changeColorsByMargin_, outputNode, -10, -5, -2)
+  measureStage(results, workload, "regenerateOriginalModelColors", logic.regenerateOriginalModelColors, outputNode)
+
+
+def runWorkloads(quick=False, distanceBackends=("InProcess",), tracePythonMemory=False):
+  """Run all workloads and return the records of their stages. With tracePythonMemory, the peak Python memory
+  of each stage is recorded as well, but the wall times are slowed down by the tracing."""
+  if tracePythonMemory:
+    tracemalloc.start()
+  try:
+    return runWorkloadStages(quick, distanceBackends)
+  finally:
+    if tracePythonMemory:
+      tracemalloc.stop()
+
+
+def runWorkloadStages(quick, distanceBackends):
+  results = []
+  probeCounts = [1, 4, 16] if quick else PROBE_COUNTS
+  tumorResolutions = [32, 128] if quick else TUMOR_RESOLUTIONS
+  profileScales = [1.0, 2.0] if quick else PROFILE_SCALES
+
+  # bundled test case: recorded tumor and end points
+  slicer.mrmlScene.Clear()
+  tumorNode = slicer.util.loadSegmentation(os.path.join(TESTING_DIRECTORY, "tumor.seg.nrrd"))
+  endPointsNode = slicer.util.loadMarkups(os.path.join(TESTING_DIRECTORY, "Endpoints.mrk.json"))
+  profileNode = createSegmentationFromSurface(AblationPlanner.createEllipsoidProfileSurface(BASE_PROFILE), "profile")
+  endPointPairs = AblationPlanner.AblationPlannerLogic().endPointPairsFromMarkups(endPointsNode)
+  workload = {"name": "bundled", "probeCount": len(endPointPairs), "tumorResolution": None, "profileScale": 1.0}
+  runPipeline(results, workload, tumorNode, profileNode, endPointPairs, distanceBackends)
+
+  # synthetic workloads, one factor at a time
+  workloads = [dict(BASELINE, probeCount=probeCount) for probeCount in probeCounts]
+  workloads += [dict(BASELINE, tumorResolution=resolution) for resolution in tumorResolutions]
+  workloads += [dict(BASELINE, profileScale=scale) for scale in profileScales]
+  for workload in workloads:
+    workload["name"] = "probes{probeCount}_tumor{tumorResolution}_profile{profileScale}".format(**workload)
+    slicer.mrmlScene.Clear()
+    profile = EllipsoidProfile(np.array(BASE_PROFILE.semiAxes) * workload["profileScale"], BASE_PROFILE.tipOffset * workload["profileScale"])
+    profileNode = createSegmentationFromSurface(AblationPlanner.createEllipsoidProfileSurface(profile), "profile")
+    tumorNode = createSphereTumor(workload["tumorResolution"])
+    runPipeline(results, workload, tumorNode, profileNode, ringEndPointPairs(workload["probeCount"]), distanceBackends)
+
+  slicer.mrmlScene.Clear()
+  return results
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description="Stage-level benchmark of the AblationPlanner pipeline")
+  parser.add_argument("--output", default="AblationPlannerBenchmark.json", help="path of the JSON report")
+  parser.add_argument("--quick", action="store_true", help="run a reduced set of workloads")
+  parser.add_argument("--cli", action="store_true", help="also time the margin evaluation with the ModelToModelDistance CLI (minutes per workload)")
+  parser.add_argument("--python-memory", action="store_true",
+    help="also record the peak Python memory of each stage, in a second pass that is not timed")
+  parser.add_argument("--compare", metavar="REPORT", help="list the stages that are slower than in this previous report")
+  parser.add_argument("--threshold", type=float, default=0.25,
+    help="slowdown (fraction of the previous wall time) reported as a regression by --compare")
+  args = parser.parse_args(argv)
+
+  distanceBackends = ["InProcess", "ModelToModelDistance"] if args.cli else ["InProcess"]
+  startTime = time.perf_counter()
+  results = runWorkloads(args.quick, distanceBackends)
+  totalWallTime = time.perf_counter() - startTime
+  if args.python_memory:
+    peakPythonMemories = {recordKey(record): record["peakPythonMemory"]
+      for record in runWorkloads(args.quick, distanceBackends, tracePythonMemory=True)}
+    for record in results:
+      record["peakPythonMemory"] = peakPythonMemories.get(recordKey(record))
+  report = {
+    "date": datetime.datetime.now().isoformat(),
+    "slicerVersion": slicer.app.applicationVersion,
+    "platform": platform.platform(),
+    "totalWallTime": totalWallTime,
+    "results": results,
+    }
+  exitCode = 0
+  if args.compare:
+    with open(args.compare) as previousReportFile:
+      previousReport = json.load(previousReportFile)
+    report["comparedTo"] = os.path.abspath(args.compare)
+    report["regressions"] = compareReports(previousReport, report, args.threshold)
+    for regression in report["regressions"]:
+      print("Regression: {name} {stage} {previousWallTime:.3f} s -> {wallTime:.3f} s ({ratio:.2f}x)".format(**regression))
+    print("{0} stages slower than in {1} by more than {2:.0%}".format(len(report["regressions"]), args.compare, args.threshold))
+    exitCode = 1 if report["regressions"] else 0
+  with open(args.output, "w") as reportFile:
+    json.dump(report, reportFile, indent=2)
+  print("Benchmark report written to " + os.path.abspath(args.output))
+  return exitCode
+
+
+if __name__ == "__main__":
+  slicer.util.exit(main(sys.argv[1:]))